@@ -8,7 +8,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import glob
+import logging
+import numpy
 import os, re, tempfile
+import select
+import shutil
+import struct
 import six
 import common
 import time
@@ -21,43 +32,431 @@ from autotest_lib.client.common_lib import error
 from autotest_lib.client.common_lib.cros import chrome
 from autotest_lib.client.cros.input_playback import input_playback
 
+import utils_ts
+import utils_ts_image
+
 
 _WAIT = 10
 #_TMP = '/tmp'
 DOWNLOADS = '/home/chronos/user/Downloads'
 SCREENSHOT = 'Screenshot*'
-ERROR = list()
+# Smallest size in bytes of a valid screenshot.
+MIN_SCREENSHOT_SIZE = 1024
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# inotify(7) constants and the fixed part of struct inotify_event.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class _Inotify(object):
+    """Minimal inotify watch of one directory through ctypes."""
+
+    def __init__(self, path, mask):
+        """Starts watching path.
+        @param path: Directory to watch.
+        @param mask: inotify event mask.
+        @raises: OSError if inotify is not available.
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self._fd, path.encode('utf-8'), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, 'inotify_add_watch %s failed' % path)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def read(self, timeout):
+        """Waits up to timeout seconds for events.
+        @returns: The list of file names of the events, empty on timeout.
+        """
+        readable, _, _ = select.select([self._fd], [], [], max(timeout, 0))
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            names.append(name.decode('utf-8', 'replace'))
+        return names
+
+
+class ScreenshotWatcher(object):
+    """Waits for new screenshot files in a directory.
+
+    The directory is watched with inotify, so a file is reported as soon as
+    it has been written and closed. Where inotify is not available, the
+    directory is polled and a file is reported once its size stopped
+    changing. Only files created after the watcher was started are reported.
+    """
+
+    def __init__(self, directory=DOWNLOADS, pattern=SCREENSHOT,
+                 poll_interval=0.05):
+        """Starts watching.
+        @param directory: Directory screenshots are saved to.
+        @param pattern: Shell pattern of the screenshot file names.
+        @param poll_interval: Seconds between two polls without inotify.
+        @raises: error.TestNAError if the directory does not exist.
+        """
+        if not os.path.isdir(directory):
+            raise error.TestNAError("%s folder is not found" % directory)
+        self.directory = directory
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self._known = set(self._list())
+        self._sizes = {}
+        self._pending = collections.deque()
+        try:
+            self._inotify = _Inotify(directory, _IN_CLOSE_WRITE | _IN_MOVED_TO)
+        except (OSError, AttributeError) as e:
+            logging.warning('inotify not available, polling %s: %s',
+                            directory, e)
+            self._inotify = None
+
+    def close(self):
+        """Stops watching."""
+        if self._inotify:
+            self._inotify.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _list(self):
+        return [name for name in os.listdir(self.directory)
+                if fnmatch.fnmatch(name, self.pattern)]
+
+    def _poll_new(self):
+        """Returns the new files whose size did not change since last poll."""
+        names = []
+        for name in self._list():
+            if name in self._known:
+                continue
+            try:
+                size = os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            if size and self._sizes.get(name) == size:
+                names.append(name)
+            self._sizes[name] = size
+        return names
 
+    def read(self, timeout=0):
+        """Waits up to timeout seconds for new screenshots.
+        @param timeout: Seconds to wait for the first one.
+        @returns: The list of (path, seen) tuples of the new files, with seen
+                  the time.time() the file was complete on disk, empty if
+                  there was none in time.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if self._inotify:
+                names = self._inotify.read(remaining)
+            else:
+                names = self._poll_new()
+            seen = time.time()
+            new = []
+            for name in names:
+                if fnmatch.fnmatch(name, self.pattern) and name not in self._known:
+                    self._known.add(name)
+                    new.append((os.path.join(self.directory, name), seen))
+            if new or remaining <= 0:
+                return new
+            if not self._inotify:
+                time.sleep(min(self.poll_interval, remaining))
 
+    def wait(self, timeout=_WAIT):
+        """Waits for the next new screenshot.
+        @param timeout: Seconds to wait.
+        @returns: A tuple (path, seen) with seen the time.time() the file was
+                  complete on disk.
+        @raises: error.TestFail if no screenshot was saved in time.
+        """
+        deadline = time.time() + timeout
+        while not self._pending:
+            new = self.read(deadline - time.time())
+            if not new:
+                raise error.TestFail('Screenshot was not found under:%s'
+                                     % self.directory)
+            self._pending.extend(new)
+        return self._pending.popleft()
 
-def screenshot():
-    """Test setup."""
-    # Emulate keyboard.
+
+def check_png(path, min_size=MIN_SCREENSHOT_SIZE, expected_size=None):
+    """Checks that a file is a PNG image of a plausible screenshot.
+    @param path: Path of the file.
+    @param min_size: Smallest valid file size in bytes.
+    @param expected_size: Tuple (width, height) the image must have, None
+                          to accept any non-empty image.
+    @returns: A tuple (width, height, size) with the file size in bytes.
+    @raises: error.TestFail if the file is not a valid PNG image.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    size = os.path.getsize(path)
+    if header[:8] != _PNG_SIGNATURE or header[12:16] != b'IHDR':
+        raise error.TestFail('%s is not a PNG image' % path)
+    width, height = struct.unpack('>II', header[16:24])
+    if not width or not height:
+        raise error.TestFail('%s is empty: %dx%d' % (path, width, height))
+    if expected_size and (width, height) != tuple(expected_size):
+        raise error.TestFail('%s is %dx%d, expected %dx%d'
+                             % ((path, width, height) + tuple(expected_size)))
+    if size < min_size:
+        raise error.TestFail('%s is only %d bytes' % (path, size))
+    return width, height, size
+
+
+def _create_keyboard():
+    """Creates an emulated keyboard to play back shortcuts."""
     # See input_playback. The keyboard is used to play back shortcuts.
     player = input_playback.InputPlayback()
     player.emulate(input_type='keyboard')
     player.find_connected_inputs()
-    player.blocking_playback_of_default_file(
-            input_type='keyboard', filename='keyboard_ctrl+f5')
-    time.sleep(_WAIT)
-    
-    
+    return player
+
+
+def screenshot(timeout=_WAIT, directory=DOWNLOADS, expected_size=None):
+    """Takes a screenshot with ctrl+f5 and waits for it to be saved.
+    @param timeout: Seconds to wait for the file.
+    @param directory: Directory screenshots are saved to.
+    @param expected_size: Tuple (width, height) of the screen, None to
+                          accept any size.
+    @returns: A tuple (path, latency) with the seconds from the start of the
+              key press playback to the file being complete on disk.
+    @raises: error.TestFail if no valid screenshot was saved in time.
+    """
+    with ScreenshotWatcher(directory) as watcher:
+        player = _create_keyboard()
+        try:
+            start = time.time()
+            player.blocking_playback_of_default_file(
+                    input_type='keyboard', filename='keyboard_ctrl+f5')
+            path, seen = watcher.wait(start + timeout - time.time())
+        finally:
+            player.close()
+    check_png(path, expected_size=expected_size)
+    logging.info('Screenshot %s saved after %.3f s', path, seen - start)
+    return path, seen - start
+
+
+def _match_in_order(presses, files, timeout, latency):
+    """In-order pairing of presses and files closest to a latency.
+    @returns: A tuple (cost, captures) with the sum of the latency
+              deviations, an unmatched file costing timeout.
+    """
+    # cost[i][j]: best cost of the first i presses and the first j files.
+    inf = float('inf')
+    cost = [[inf] * (len(files) + 1) for _ in range(len(presses) + 1)]
+    step = [[None] * (len(files) + 1) for _ in range(len(presses) + 1)]
+    cost[0][0] = 0.0
+    for i in range(len(presses) + 1):
+        for j in range(len(files) + 1):
+            if i and cost[i - 1][j] < cost[i][j]:
+                cost[i][j], step[i][j] = cost[i - 1][j], 'drop'
+            if j and cost[i][j - 1] + timeout < cost[i][j]:
+                cost[i][j], step[i][j] = cost[i][j - 1] + timeout, 'extra'
+            if i and j:
+                delay = files[j - 1][1] - presses[i - 1]
+                if 0 <= delay <= timeout:
+                    total = cost[i - 1][j - 1] + abs(delay - latency)
+                    if total < cost[i][j]:
+                        cost[i][j], step[i][j] = total, 'match'
+    captures = [None] * len(presses)
+    i, j = len(presses), len(files)
+    while i or j:
+        move = step[i][j]
+        if move == 'match':
+            captures[i - 1] = files[j - 1]
+            i, j = i - 1, j - 1
+        elif move == 'drop':
+            i -= 1
+        else:
+            j -= 1
+    return cost[-1][-1], captures
+
+
+def _match_captures(presses, files, timeout, candidates=21):
+    """Pairs key presses with the screenshots they saved.
+    Screenshots are saved in the order of the presses. When they take longer
+    than the press interval, a dropped capture can not be told from the
+    order alone, so the in-order pairing with the most uniform latency is
+    chosen among candidate latencies.
+    @param presses: time.time() of each press, in order.
+    @param files: List of (path, seen) of the saved screenshots.
+    @param timeout: Longest latency of a capture.
+    @param candidates: Number of candidate latencies tried.
+    @returns: A list with the (path, seen) of each press, None if dropped.
+    """
+    files = sorted(files, key=lambda f: f[1])
+    if not files:
+        return [None] * len(presses)
+    delays = numpy.array([seen - press for _, seen in files for press in presses])
+    delays = delays[(delays >= 0) & (delays <= timeout)]
+    if not len(delays):
+        return [None] * len(presses)
+    best = None
+    for latency in numpy.unique(numpy.percentile(
+            delays, numpy.linspace(0, 100, candidates))):
+        cost, captures = _match_in_order(presses, files, timeout, latency)
+        if best is None or cost < best[0]:
+            best = cost, captures
+    matched = set(capture[0] for capture in best[1] if capture)
+    for path, _ in files:
+        if path not in matched:
+            logging.warning('Screenshot %s matches no key press', path)
+    return best[1]
+
+
+def screenshot_burst(count=10, rate=2.0, timeout=_WAIT, directory=DOWNLOADS,
+                     expected_size=None):
+    """Takes screenshots at a fixed rate with one emulated keyboard.
+    @param count: Number of screenshots.
+    @param rate: Key presses per second.
+    @param timeout: Seconds after a press its screenshot is considered
+                    dropped.
+    @param directory: Directory screenshots are saved to.
+    @param expected_size: Tuple (width, height) of the screen, None to
+                          accept any size.
+    @returns: A dict with the 'requested' and the 'captured' counts, the
+              indices of the 'dropped' presses, the 'invalid' files, the
+              'latency' percentiles in seconds, the per press 'latencies'
+              (None if dropped), the 'achieved_rate' of the presses and the
+              'files'.
+    """
+    interval = 1.0 / rate
+    presses = []
+    files = []
+    with ScreenshotWatcher(directory) as watcher:
+        player = _create_keyboard()
+        try:
+            start = time.time()
+            for index in range(count):
+                delay = start + index * interval - time.time()
+                if delay > 0:
+                    # Collect the files saved meanwhile instead of sleeping.
+                    files.extend(watcher.read(delay))
+                    delay = start + index * interval - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                presses.append(time.time())
+                player.blocking_playback_of_default_file(
+                        input_type='keyboard', filename='keyboard_ctrl+f5')
+            deadline = presses[-1] + timeout
+            while len(files) < count and time.time() < deadline:
+                files.extend(watcher.read(deadline - time.time()))
+        finally:
+            player.close()
+    captures = _match_captures(presses, files, timeout)
+    latencies = []
+    invalid = []
+    for press, capture in zip(presses, captures):
+        if capture is None:
+            latencies.append(None)
+            continue
+        latencies.append(capture[1] - press)
+        try:
+            check_png(capture[0], expected_size=expected_size)
+        except error.TestFail as e:
+            logging.warning('%s', e)
+            invalid.append(capture[0])
+    dropped = [i for i, capture in enumerate(captures) if capture is None]
+    result = {
+        'requested': count,
+        'captured': count - len(dropped),
+        'dropped': dropped,
+        'invalid': invalid,
+        'latency': utils_ts.get_percentiles(
+                [latency for latency in latencies if latency is not None]),
+        'latencies': latencies,
+        'achieved_rate': ((count - 1) / (presses[-1] - presses[0])
+                          if count > 1 and presses[-1] > presses[0] else None),
+        'files': [capture[0] for capture in captures if capture],
+    }
+    logging.info('Screenshot burst: %d of %d captured, latency %s',
+                 result['captured'], count, result['latency'])
+    return result
+
+
+def verify_screenshot(path, golden_path, masks=utils_ts_image.DEFAULT_MASKS,
+                      hash_threshold=utils_ts_image.HASH_THRESHOLD,
+                      region_threshold=utils_ts_image.REGION_THRESHOLD):
+    """Compares a screenshot to a golden image.
+    A missing golden is created from the screenshot, so the first run of a
+    test records it.
+    @param path: Path of the screenshot.
+    @param golden_path: Path of the golden PNG.
+    @param masks: (left, top, right, bottom) rectangles in fractions of the
+                  screen that are ignored, the status tray by default.
+    @param hash_threshold: Perceptual hash distance above which the screen
+                           changed.
+    @param region_threshold: Mean difference in [0, 1] above which a region
+                             of the screen changed.
+    @returns: The result of utils_ts_image.GoldenImage.compare, None if the
+              golden was created.
+    @raises: error.TestFail if the screenshot differs from the golden.
+    """
+    if not os.path.exists(golden_path):
+        logging.warning('Golden %s not found, saving %s as golden',
+                        golden_path, path)
+        shutil.copyfile(path, golden_path)
+        return None
+    golden = utils_ts_image.GoldenImage.from_file(golden_path, masks=masks)
+    try:
+        result = golden.compare(utils_ts_image.read_png(path),
+                                hash_threshold=hash_threshold,
+                                region_threshold=region_threshold)
+    except ValueError as e:
+        raise error.TestFail('Can not compare %s to %s: %s'
+                             % (path, golden_path, e))
+    if not result['match']:
+        raise error.TestFail('%s differs from %s: hash distance %d, changed '
+                             'regions %s' % (path, golden_path,
+                                             result['hash_distance'],
+                                             result['changed_regions']))
+    return result
+
+
 def confirm_file_exist(filepath):
     """Check if screenshot file can be found and with minimum size.
 
     @param filepath file path.
 
-    @raises: error.TestFail if screenshot file does not exist.
+    @returns: The path of the newest screenshot.
+
+    @raises: error.TestNAError if the folder does not exist.
+    @raises: error.TestFail if screenshot file does not exist or is invalid.
 
    """
     if not os.path.isdir(filepath):
         raise error.TestNAError("%s folder is not found" % filepath)
 
-    if not (utils.system_output('sync; sleep 2; find %s -name "%s"'
-                                    % (filepath, SCREENSHOT))):
-        ERROR.append('Screenshot was not found under:%s' % filepath)
+    paths = glob.glob(os.path.join(filepath, SCREENSHOT))
+    if not paths:
+        raise error.TestFail('Screenshot was not found under:%s' % filepath)
 
-    filesize = utils.system_output('ls -l %s/%s | cut -d" " -f5'
-                                       % (filepath, SCREENSHOT))
-    
-    
\ No newline at end of file
+    path = max(paths, key=os.path.getmtime)
+    check_png(path)
+    return path
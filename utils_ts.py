@@ -11,24 +11,33 @@ Convenience functions for use by tests or whomever.
 
 import base64
 import collections
+import contextlib
 import errno
 import glob
+import hashlib
 import json
 import logging
 import math
+import mmap
 import multiprocessing
+import multiprocessing.pool
+import numpy
 import os
 import platform
 import re
+import select
 import shutil
 import string
 import subprocess
+import tempfile
+import threading
 import time
 import uuid
 import six
 from six.moves import map
 from six.moves import range
 from six.moves import zip
+from six.moves import shlex_quote
 from telemetry.internal.actions import scroll
 from autotest_lib.client.common_lib import error
 from autotest_lib.client.common_lib import magic
@@ -43,18 +52,25 @@ from autotest_lib.client.cros.graphics import graphics_utils
 from autotest_lib.client.common_lib.utils import *
 from autotest_lib.client.common_lib import utils
 import py_utils
+import utils_ts_image
+import utils_ts_webm
+from utils_ts_netperf import get_percentiles
 WAIT = 5
 _WAKETIME = 8
 _URL_WAKEUP_TIME = 10
 Delay_time = 8
 BUTTON_ROLE = "button"
 STATUS_TRAY_REGEXP = "/Status tray, /i"
+DOWNLOADS = '/home/chronos/user/Downloads'
+# Directory of the media fixture store in the directory the fixtures are
+# provisioned into, so they are on the same mount and can be hard linked.
+# In Downloads it lives in the cryptohome and is provisioned per user.
+MEDIA_STORE = '.ts_media_store'
 current_scaling_governor = 'cat /sys/devices/system/cpu/cpufreq/policy*/scaling_governor'
 current_scaling_freq = 'cat /sys/devices/system/cpu/cpufreq/policy*/scaling_cur_freq'
 min_frequency = 'cat /sys/devices/system/cpu/cpufreq/policy*/cpuinfo_max_freq'
 max_frequency = 'cat /sys/devices/system/cpu/cpufreq/policy*/cpuinfo_min_freq'
 _CPUINFO_RE = re.compile(r'^(?P<key>[^\t]*)\t*: ?(?P<value>.*)$')
-_MEMINFO_RE = re.compile('^(\w+)(\(\w+\))?:\s+(\d+)')
 
 def command_exe(cmd, file_name, folder=None):
     """
@@ -222,6 +238,143 @@ def read_dmesg_log(host=None):
         ret_out = utils.run('dmesg').stdout
         return ret_out
 
+# A record of the kernel log. timestamp is in seconds since boot.
+KernelLogRecord = collections.namedtuple('KernelLogRecord',
+                                         ['sequence', 'timestamp', 'message'])
+# /dev/kmsg format: "<priority>,<sequence>,<usec>,<flags>;<message>".
+_KMSG_RE = re.compile(r'^\d+,(\d+),(\d+),[^;]*;(.*)$')
+# dmesg format: "[   12.345678] <message>".
+_DMESG_RE = re.compile(r'^\[\s*(\d+\.\d+)\]\s?(.*)$')
+
+class KernelLogCursor(object):
+    """Streams new kernel log records as they are logged.
+
+    The cursor reads /dev/kmsg in-process, starting at the end of the log by
+    default, so only records logged after it was opened are seen and the
+    log never has to be dumped and searched as a whole. A file with records
+    in /dev/kmsg or dmesg format can be given instead, which replays it from
+    the start and makes users testable offline.
+    """
+
+    def __init__(self, path='/dev/kmsg', from_start=False):
+        """Opens the cursor.
+        @param path: /dev/kmsg or a log file to replay.
+        @param from_start: True to also read the records logged before the
+                           cursor was opened. Replayed files always start
+                           at the beginning.
+        """
+        self._pending = collections.deque()
+        self._sequence = 0
+        self._fd = None
+        self._replay = os.path.isfile(path)
+        if self._replay:
+            with open(path) as f:
+                self._add_lines(f.read().splitlines())
+            return
+        self._fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        if not from_start:
+            os.lseek(self._fd, 0, os.SEEK_END)
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+
+    def close(self):
+        """Closes the cursor."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _add_lines(self, lines):
+        for line in lines:
+            match = _KMSG_RE.match(line)
+            if match:
+                self._pending.append(KernelLogRecord(
+                        int(match.group(1)), int(match.group(2)) / 1e6,
+                        match.group(3)))
+                continue
+            match = _DMESG_RE.match(line)
+            if match:
+                self._sequence += 1
+                self._pending.append(KernelLogRecord(
+                        self._sequence, float(match.group(1)),
+                        match.group(2)))
+
+    def _fill(self, timeout):
+        """Reads the available records, waiting up to timeout for one."""
+        if self._replay or not self._poll.poll(timeout * 1000):
+            return
+        while True:
+            try:
+                # Every read returns exactly one record.
+                data = os.read(self._fd, 8192)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                if e.errno == errno.EPIPE:
+                    # Records were overwritten before being read.
+                    continue
+                raise
+            if not data:
+                break
+            self._add_lines(data.decode('utf-8', 'replace').split('\n')[:1])
+
+    def read(self, timeout=0):
+        """Returns the records logged since the last read.
+        @param timeout: Seconds to wait if no record is available.
+        @returns: A list of KernelLogRecord, empty if none arrived.
+        """
+        if not self._pending:
+            self._fill(timeout)
+        records = list(self._pending)
+        self._pending.clear()
+        return records
+
+    def wait_for(self, pattern, timeout):
+        """Reads records until one matches pattern.
+        Records after the match stay available for the next call.
+        @param pattern: A regular expression searched in the messages.
+        @param timeout: Seconds to wait.
+        @returns: The matching KernelLogRecord, None on timeout.
+        """
+        compiled = re.compile(pattern)
+        deadline = time.time() + timeout
+        while True:
+            while self._pending:
+                record = self._pending.popleft()
+                if compiled.search(record.message):
+                    return record
+            remaining = deadline - time.time()
+            if remaining <= 0 or self._replay:
+                return None
+            self._fill(remaining)
+
+def collect_devcoredump(results_dir, name='coredump'):
+    """
+    Saves the pending device coredumps and frees them.
+    @param results_dir: Folder the dumps are copied to.
+    @param name: Prefix of the saved files.
+    @returns: Total size in bytes of the saved dumps, None if there was none.
+    """
+    paths = sorted(glob.glob('/sys/class/devcoredump/devcd*/data'))
+    if not paths:
+        return None
+    size = 0
+    for index, path in enumerate(paths):
+        dest = os.path.join(results_dir, '%s.%d.%d' % (name, int(time.time()),
+                                                       index))
+        with open(path, 'rb') as src, open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+            size += dst.tell()
+        # Any write to data releases the dump.
+        with open(path, 'w') as f:
+            f.write('1')
+    return size
+
 def read_cbmem_log(host=None):
     """
     This function will return cbmem logs of last reboot
@@ -430,12 +583,40 @@ def cpu_online_map():
     return cpus
 # Returns total memory in kb
 
+_MEMINFO_LINES_RE = re.compile(r'^(\w+)(?:\((\w+)\))?:\s+(\d+)', re.M)
+# The MemInfo type, created at the first read of /proc/meminfo since its
+# fields depend on the kernel.
+_MEMINFO_TYPE = None
+
+def _read_meminfo_values(path='/proc/meminfo'):
+    """Reads /proc/meminfo at once.
+    @returns: A list of (name, value in kB) in file order, 'Active(anon)'
+              being named 'Active_anon'.
+    """
+    with open(path) as f:
+        text = f.read()
+    return [(name + '_' + sub if sub else name, int(value))
+            for name, sub, value in _MEMINFO_LINES_RE.findall(text)]
+
+def get_meminfo_type():
+    """Returns the MemInfo namedtuple type of this kernel."""
+    global _MEMINFO_TYPE
+    if _MEMINFO_TYPE is None:
+        _MEMINFO_TYPE = collections.namedtuple(
+                'MemInfo', [name for name, _ in _read_meminfo_values()])
+    return _MEMINFO_TYPE
+
 def read_from_meminfo(key):
     """
-    Check out the system memory information@ by using regex search expression
+    Returns the value in kB of a /proc/meminfo key, e.g. 'MemTotal' or
+    'Active(anon)'.
+    @raises: KeyError if there is no such key.
     """
-    meminfo = utils.system_output('grep %s /proc/meminfo' % key)
-    return int(re.search(r'\d+', meminfo).group(0))
+    name = key.replace('(', '_').replace(')', '')
+    for field, value in _read_meminfo_values():
+        if field == name:
+            return value
+    raise KeyError(key)
 
 def memtotal():
     """
@@ -443,12 +624,13 @@ def memtotal():
     """
     try:
         return read_from_meminfo('MemTotal')
-    except:
+    except KeyError:
         logging.info("Not Found")
         return -1
 
 def get_meminfo():
     """Returns a namedtuple of pairs from /proc/meminfo.
+    The MemInfo type is created once and reused by all the calls.
     Example /proc/meminfo snippets:
         MemTotal:        2048000 kB
         Active(anon):     409600 kB
@@ -456,17 +638,161 @@ def get_meminfo():
         meminfo = utils.get_meminfo()
         print meminfo.Active_anon
     """
-    info = {}
-    with open('/proc/meminfo') as f:
-        for line in f:
-            m = _MEMINFO_RE.match(line)
-            if m:
-                if m.group(2):
-                    name = m.group(1) + '_' + m.group(2)[1:-1]
-                else:
-                    name = m.group(1)
-                info[name] = int(m.group(3))
-    return collections.namedtuple('MemInfo', list(info.keys()))(**info)
+    meminfo_type = get_meminfo_type()
+    values = _read_meminfo_values()
+    if tuple(name for name, _ in values) == meminfo_type._fields:
+        return meminfo_type._make(value for _, value in values)
+    # A field appeared, went away or moved, keep the fields of the type.
+    info = dict(values)
+    return meminfo_type._make(info.get(field, 0)
+                              for field in meminfo_type._fields)
+
+class _Sampler(object):
+    """Base of the samplers, sampling on demand or in a background thread.
+
+    Subclasses take one sample in _sample, numbered by count. A test step
+    is a (name, row) pair, row being the sample taken when it was marked,
+    and ends at the row of the next step, the last one at the last sample.
+    sample, mark and stop hold a lock, so steps can be marked while the
+    thread samples.
+    """
+
+    def __init__(self, interval):
+        """@param interval: Seconds between two samples of the thread."""
+        self.interval = interval
+        self.count = 0
+        self.steps = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        raise NotImplementedError
+
+    def sample(self):
+        """Takes a sample.
+        @returns: The result of _sample.
+        """
+        with self._lock:
+            return self._sample()
+
+    def mark(self, name):
+        """Samples and starts a test step at that sample.
+        @param name: Name of the step, None to only end the previous one.
+        """
+        with self._lock:
+            self._sample()
+            self.steps.append((name, self.count - 1))
+
+    def _get_step_rows(self):
+        """Returns a list of (name, start row, end row) of the named steps."""
+        ends = [row for _, row in self.steps[1:]] + [self.count - 1]
+        return [(name, start, end)
+                for (name, start), end in zip(self.steps, ends)
+                if name is not None]
+
+    @contextlib.contextmanager
+    def step(self, name):
+        """Wraps a test step, e.g. with sampler.step('open tabs'): ..."""
+        self.mark(name)
+        try:
+            yield
+        finally:
+            self.mark(None)
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.time()
+            self.sample()
+            self._stop.wait(max(0, self.interval - (time.time() - start)))
+
+    def start(self):
+        """Samples in a background thread until stop."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the thread and takes a last sample, ending the last step."""
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.sample()
+
+class MemInfoSeries(_Sampler):
+    """Samples /proc/meminfo into a numpy array for leak checks.
+
+    Each sample is a row and each MemInfo field a column. Test steps are
+    marked so the changes of every field can be compared per step, e.g.
+    MemAvailable over many iterations of opening and closing tabs.
+    """
+
+    def __init__(self, capacity=256, interval=1.0):
+        """@param capacity: Initial number of samples of the array.
+        @param interval: Seconds between two samples of the thread.
+        """
+        super(MemInfoSeries, self).__init__(interval)
+        self.fields = get_meminfo_type()._fields
+        self._index = dict((field, i) for i, field in enumerate(self.fields))
+        self.times = numpy.full(capacity, numpy.nan)
+        self.values = numpy.zeros((capacity, len(self.fields)),
+                                  dtype=numpy.int64)
+
+    def _sample(self):
+        """Adds a sample.
+        @returns: The MemInfo of the sample.
+        """
+        if self.count == len(self.times):
+            self.times = numpy.concatenate(
+                    [self.times, numpy.full(len(self.times), numpy.nan)])
+            self.values = numpy.vstack([self.values,
+                                        numpy.zeros_like(self.values)])
+        meminfo = get_meminfo()
+        self.times[self.count] = time.time()
+        self.values[self.count] = meminfo
+        self.count += 1
+        return meminfo
+
+    def get_field(self, field):
+        """Returns the samples of a field as a numpy array in kB."""
+        return self.values[:self.count, self._index[field]]
+
+    def get_step_deltas(self, fields=None):
+        """Changes of the fields over each step.
+        A step ends where the next one starts, the last one at the last
+        sample.
+        @param fields: Fields to report, all by default.
+        @returns: A list of (step, dict of field to dict with the 'delta' in
+                  kB and the 'rate' in kB/s).
+        """
+        columns = [self._index[field] for field in fields or self.fields]
+        result = []
+        for name, start, end in self._get_step_rows():
+            deltas = self.values[end, columns] - self.values[start, columns]
+            elapsed = self.times[end] - self.times[start]
+            result.append((name, dict(
+                    (self.fields[column], {
+                            'delta': int(delta),
+                            'rate': float(delta / elapsed) if elapsed > 0 else None})
+                    for column, delta in zip(columns, deltas))))
+        return result
+
+    def get_leak_slope(self, field='MemAvailable', skip=1):
+        """Trend of a field across the steps, by a least squares line.
+        @param field: MemInfo field.
+        @param skip: Number of first steps left out as warm up.
+        @returns: The change of the field in kB per step, None with less
+                  than two steps. A steadily negative MemAvailable slope
+                  over identical steps points to a leak.
+        """
+        rows = [row for _, row, _ in self._get_step_rows()[skip:]]
+        if len(rows) < 2:
+            return None
+        values = self.values[rows, self._index[field]]
+        return float(numpy.polyfit(numpy.arange(len(rows)), values, 1)[0])
 
 def usb_devices():
     """
@@ -516,6 +842,260 @@ def list_mount_devices():
         devices.append(line.split()[0])
     return devices
 
+def find_pids(name):
+    """Finds the processes with the given name by reading /proc.
+    @param name: Process name as shown in /proc/<pid>/comm, e.g. 'cras'.
+    @returns: A sorted list of pids.
+    """
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/comm' % entry) as f:
+                if f.read().strip() == name:
+                    pids.append(int(entry))
+        except (IOError, OSError):
+            # The process exited while scanning.
+            continue
+    return sorted(pids)
+
+def get_process_cpu_ticks(pid):
+    """Returns the CPU time used by a process in clock ticks.
+    @param pid: Process id.
+    @returns: The sum of user and system time from /proc/<pid>/stat.
+    """
+    with open('/proc/%d/stat' % pid) as f:
+        # The command name may contain spaces, fields start after ')'.
+        fields = f.read().rsplit(')', 1)[1].split()
+    return int(fields[11]) + int(fields[12])
+
+_SMAPS_ROLLUP_RE = re.compile(r'^(Rss|Pss|Swap):\s+(\d+) kB', re.M)
+
+def _read_again(fd, size):
+    """Reads a /proc file kept open from its start."""
+    os.lseek(fd, 0, os.SEEK_SET)
+    return os.read(fd, size)
+
+class ProcessSampler(_Sampler):
+    """Samples the CPU and memory use of processes into numpy arrays.
+
+    The processes are found by name, their /proc stat, statm and
+    smaps_rollup files are opened once and read again at every sample, and
+    the values are stored column by column, one column per process. Chrome
+    processes are labeled with their --type, e.g. 'chrome:renderer'. A
+    process is told apart from a later one reusing its pid by its start
+    time, and gets its own column.
+    """
+
+    FIELDS = ('cpu_ticks', 'rss_kb', 'pss_kb', 'swap_kb')
+
+    def __init__(self, names=('chrome', 'cras', 'shill'), interval=1.0,
+                 rescan_interval=5.0, pss=True, capacity=1024):
+        """@param names: Process names as in /proc/<pid>/comm.
+        @param interval: Seconds between two samples of the thread.
+        @param rescan_interval: Seconds between two searches of new processes.
+        @param pss: False to skip smaps_rollup, which is slower to read.
+        @param capacity: Initial number of samples of the arrays.
+        """
+        super(ProcessSampler, self).__init__(interval)
+        self.names = names
+        self.rescan_interval = rescan_interval
+        self.pss = pss
+        self.page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+        self.ticks_per_second = float(os.sysconf('SC_CLK_TCK'))
+        self.pids = []
+        self.labels = []
+        self.times = numpy.full(capacity, numpy.nan)
+        self.data = dict((field, numpy.full((capacity, 0), numpy.nan))
+                         for field in self.FIELDS)
+        self._fds = {}
+        self._columns = {}
+        self._last_scan = None
+
+    def _label(self, name, pid):
+        if name != 'chrome':
+            return name
+        try:
+            with open('/proc/%d/cmdline' % pid) as f:
+                args = f.read().split('\0')
+        except (IOError, OSError):
+            return name
+        for arg in args:
+            if arg.startswith('--type='):
+                return 'chrome:' + arg[len('--type='):]
+        return 'chrome:browser'
+
+    def _open(self, pid):
+        fds = []
+        try:
+            for name in ('stat', 'statm', 'smaps_rollup')[:3 if self.pss else 2]:
+                fds.append(os.open('/proc/%d/%s' % (pid, name), os.O_RDONLY))
+        except OSError:
+            for fd in fds:
+                os.close(fd)
+            return None
+        return fds
+
+    def _read_stat(self, fds):
+        stat = _read_again(fds[0], 4096).decode('ascii', 'replace')
+        # The command name may contain spaces, fields start after ')'.
+        return stat.rsplit(')', 1)[1].split()
+
+    def _scan(self):
+        for name in self.names:
+            for pid in find_pids(name):
+                if pid in self._fds:
+                    continue
+                fds = self._open(pid)
+                if fds is None:
+                    continue
+                try:
+                    # Field 22 of stat, the start time, tells a reused pid.
+                    key = (pid, int(self._read_stat(fds)[19]))
+                except (OSError, IndexError, ValueError):
+                    for fd in fds:
+                        os.close(fd)
+                    continue
+                if key not in self._columns:
+                    self._columns[key] = len(self.pids)
+                    self.pids.append(pid)
+                    self.labels.append(self._label(name, pid))
+                    for field in self.FIELDS:
+                        self.data[field] = numpy.hstack([
+                                self.data[field],
+                                numpy.full((len(self.times), 1), numpy.nan)])
+                self._fds[pid] = (fds, self._columns[key])
+        self._last_scan = time.time()
+
+    def _close(self, pid):
+        for fd in self._fds.pop(pid)[0]:
+            os.close(fd)
+
+    def _read(self, fds):
+        fields = self._read_stat(fds)
+        statm = _read_again(fds[1], 256).split()
+        values = [int(fields[11]) + int(fields[12]),
+                  int(statm[1]) * self.page_kb, numpy.nan, numpy.nan]
+        if len(fds) > 2:
+            rollup = dict(_SMAPS_ROLLUP_RE.findall(
+                    _read_again(fds[2], 4096).decode('ascii', 'replace')))
+            values[2] = int(rollup.get('Pss', 0))
+            values[3] = int(rollup.get('Swap', 0))
+        return values
+
+    def _sample(self):
+        if (self._last_scan is None or
+                time.time() - self._last_scan >= self.rescan_interval):
+            self._scan()
+        if self.count == len(self.times):
+            self.times = numpy.concatenate(
+                    [self.times, numpy.full(len(self.times), numpy.nan)])
+            for field in self.FIELDS:
+                self.data[field] = numpy.vstack([
+                        self.data[field],
+                        numpy.full(self.data[field].shape, numpy.nan)])
+        row = self.count
+        self.times[row] = time.time()
+        for pid, (fds, column) in list(self._fds.items()):
+            try:
+                values = self._read(fds)
+            except (OSError, IndexError, ValueError):
+                # The process exited.
+                self._close(pid)
+                continue
+            for field, value in zip(self.FIELDS, values):
+                self.data[field][row, column] = value
+        self.count += 1
+
+    def stop(self):
+        """Stops the thread, takes a last sample and closes the files."""
+        super(ProcessSampler, self).stop()
+        with self._lock:
+            for pid in list(self._fds):
+                self._close(pid)
+
+    def _by_label(self, field, rows):
+        """Sums the columns of a field per label, NaN where no process ran."""
+        values = self.data[field][rows]
+        result = {}
+        for label in sorted(set(self.labels)):
+            columns = [i for i, other in enumerate(self.labels) if other == label]
+            block = values[:, columns]
+            summed = numpy.nansum(block, axis=1)
+            summed[numpy.isnan(block).all(axis=1)] = numpy.nan
+            result[label] = summed
+        return result
+
+    def _delta_by_label(self, field, start, end):
+        """Sums the changes of a field per label over the processes that ran
+        at both rows, NaN where none did."""
+        values = self.data[field][[start, end]]
+        both = ~numpy.isnan(values).any(axis=0)
+        change = values[1] - values[0]
+        result = {}
+        for label in sorted(set(self.labels)):
+            columns = [i for i, other in enumerate(self.labels)
+                       if other == label and both[i]]
+            result[label] = (float(change[columns].sum()) if columns
+                             else numpy.nan)
+        return result
+
+    def get_step_deltas(self):
+        """Changes of every label from the start to the end of each step.
+        A step ends where the next one starts, the last one at the last
+        sample.
+        @returns: A list of (step, dict of label to dict with the 'rss_kb',
+                  'pss_kb' and 'swap_kb' deltas and the mean 'cpu_percent').
+                  Only processes running at both ends of a step are
+                  counted, those started or exited in the step are left out.
+        """
+        with self._lock:
+            return self._get_step_deltas()
+
+    def _get_step_deltas(self):
+        deltas = []
+        for name, start, end in self._get_step_rows():
+            step = {}
+            elapsed = self.times[end] - self.times[start]
+            for field in self.FIELDS:
+                for label, delta in self._delta_by_label(
+                        field, start, end).items():
+                    if field == 'cpu_ticks':
+                        step.setdefault(label, {})['cpu_percent'] = (
+                                100 * delta / self.ticks_per_second / elapsed
+                                if elapsed > 0 else numpy.nan)
+                    else:
+                        step.setdefault(label, {})[field] = delta
+            deltas.append((name, step))
+        return deltas
+
+    def get_peak_report(self):
+        """Peak memory of every label and of its largest process.
+        @returns: A dict of label to dict with the peak summed 'rss_kb' and
+                  'pss_kb', the 'processes' seen and the largest process
+                  'peak_pid' with its 'peak_process_rss_kb'.
+        """
+        rows = slice(0, self.count)
+        report = {}
+        for field in ('rss_kb', 'pss_kb'):
+            for label, values in self._by_label(field, rows).items():
+                report.setdefault(label, {})[field] = (
+                        float(numpy.nanmax(values))
+                        if not numpy.isnan(values).all() else None)
+        rss = self.data['rss_kb'][rows]
+        for label in report:
+            columns = [i for i, other in enumerate(self.labels) if other == label]
+            peaks = numpy.array([numpy.nanmax(rss[:, i])
+                                 if not numpy.isnan(rss[:, i]).all() else -1
+                                 for i in columns])
+            largest = columns[int(peaks.argmax())]
+            report[label].update({
+                    'processes': len(columns),
+                    'peak_pid': self.pids[largest],
+                    'peak_process_rss_kb': float(peaks.max())})
+        return report
+
 def _get_thermal_zone_temperatures():
     """
     Returns the maximum currently observered temperature in thermal_zones.
@@ -532,34 +1112,374 @@ def _get_thermal_zone_temperatures():
             continue
     return temperatures
 
+def get_root_block_device():
+    """Finds the disk holding the root file system through sysfs.
+    Partitions are mapped to their disk and device mapper devices, like
+    the verified root of dm-0, to the disk below them.
+    @returns: The disk name, e.g. 'mmcblk0', None if it was not found.
+    """
+    st = os.stat('/')
+    path = os.path.realpath('/sys/dev/block/%d:%d' % (os.major(st.st_dev),
+                                                      os.minor(st.st_dev)))
+    for _ in range(8):
+        if not os.path.exists(path):
+            return None
+        slaves = glob.glob(os.path.join(path, 'slaves', '*'))
+        if slaves:
+            path = os.path.realpath(slaves[0])
+            continue
+        if os.path.exists(os.path.join(path, 'partition')):
+            path = os.path.dirname(path)
+            continue
+        return os.path.basename(path)
+    return None
+
 def get_root_device():
     """
     Return root device.
     Will return correct disk device even system boot from /dev/dm-0
     Example: return /dev/sdb for falco booted from usb
     """
+    device = get_root_block_device()
+    if device:
+        return '/dev/' + device
     return utils.system_output('rootdev -s -d')
-'''
-def read_from_storage(block_size,count):
+
+# Fields of /sys/block/<dev>/stat and of /proc/diskstats after the device
+# name, see Documentation/block/stat.rst.
+DISK_STAT_FIELDS = ('read_ios', 'read_merges', 'read_sectors', 'read_ticks',
+                    'write_ios', 'write_merges', 'write_sectors',
+                    'write_ticks', 'in_flight', 'io_ticks', 'time_in_queue')
+
+def read_diskstats():
+    """Returns a dict of device name to its DISK_STAT_FIELDS counters."""
+    stats = {}
+    with open('/proc/diskstats') as f:
+        for line in f:
+            fields = line.split()
+            stats[fields[2]] = [int(value) for value in
+                                fields[3:3 + len(DISK_STAT_FIELDS)]]
+    return stats
+
+def _get_disk_rates(deltas, elapsed):
+    """Rates of DISK_STAT_FIELDS counter changes.
+    @param deltas: Float array of counter changes, DISK_STAT_FIELDS last.
+    @param elapsed: Seconds of the changes, NaN where none elapsed.
+    @returns: A dict of numpy arrays: 'read_mb_s', 'write_mb_s',
+              'read_iops', 'write_iops', 'util_percent' (time the device
+              was busy) and 'queue_depth' (average requests in flight).
+    """
+    index = dict((field, i) for i, field in enumerate(DISK_STAT_FIELDS))
+    return {'read_mb_s': deltas[..., index['read_sectors']] * 512 /
+                         elapsed / 1e6,
+            'write_mb_s': deltas[..., index['write_sectors']] * 512 /
+                          elapsed / 1e6,
+            'read_iops': deltas[..., index['read_ios']] / elapsed,
+            'write_iops': deltas[..., index['write_ios']] / elapsed,
+            'util_percent': deltas[..., index['io_ticks']] / 10.0 / elapsed,
+            'queue_depth': deltas[..., index['time_in_queue']] / 1000.0 /
+                           elapsed}
+
+class DiskSampler(_Sampler):
+    """Samples block device counters into ring buffers.
+
+    One device is read from its /sys/block/<dev>/stat file kept open,
+    several from one read of /proc/diskstats. The last capacity samples
+    are kept. Test steps are marked, or wrapped with step(), to tell which
+    of them are I/O bound.
     """
+
+    def __init__(self, devices=None, interval=1.0, capacity=3600):
+        """@param devices: Disk names, the root disk by default.
+        @param interval: Seconds between two samples of the thread.
+        @param capacity: Number of samples kept.
+        @raises error.TestError: if no devices are given and the root disk
+                                 is not found.
+        """
+        if not devices:
+            device = get_root_block_device()
+            if device is None:
+                raise error.TestError('Root block device not found, '
+                                      'pass the devices to sample')
+            devices = [device]
+        super(DiskSampler, self).__init__(interval)
+        self.devices = list(devices)
+        self.capacity = capacity
+        self.times = numpy.zeros(capacity)
+        self.counters = numpy.zeros((capacity, len(self.devices),
+                                     len(DISK_STAT_FIELDS)), dtype=numpy.int64)
+        self._fd = None
+        if len(self.devices) == 1:
+            self._fd = os.open('/sys/block/%s/stat' % self.devices[0],
+                               os.O_RDONLY)
+
+    def _sample(self):
+        """Adds a sample, overwriting the oldest once the buffer is full."""
+        if self._fd is not None:
+            fields = _read_again(self._fd, 512).split()
+            values = [[int(value) for value in
+                       fields[:len(DISK_STAT_FIELDS)]]]
+        else:
+            stats = read_diskstats()
+            values = [stats[device] for device in self.devices]
+        row = self.count % self.capacity
+        self.times[row] = time.time()
+        self.counters[row] = values
+        self.count += 1
+
+    def stop(self):
+        """Stops the thread, takes a last sample and closes the stat file."""
+        super(DiskSampler, self).stop()
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _get_rows(self, start, end):
+        """Returns the kept times and counters of rows start to end."""
+        rows = numpy.arange(start, end + 1) % self.capacity
+        return self.times[rows], self.counters[rows]
+
+    def get_intervals(self):
+        """Activity of every device between two consecutive samples.
+        @returns: A dict with the interval 'start' and 'end' times and, per
+                  device, the _get_disk_rates dict of numpy arrays.
+        """
+        with self._lock:
+            times, counters = self._get_rows(
+                    max(0, self.count - self.capacity), self.count - 1)
+        elapsed = numpy.diff(times)
+        elapsed[elapsed <= 0] = numpy.nan
+        deltas = numpy.diff(counters, axis=0).astype(numpy.float64)
+        result = {'start': times[:-1], 'end': times[1:]}
+        for column, device in enumerate(self.devices):
+            result[device] = _get_disk_rates(deltas[:, column], elapsed)
+        return result
+
+    def get_step_report(self, io_bound_util=80.0):
+        """Disk activity of every marked step.
+        The rates of a step are its counter changes over its duration, so
+        short and long sample intervals weigh by their length, and its
+        'util_percent_max' is the highest of its sample intervals.
+        @param io_bound_util: Utilization percentage of an I/O bound step.
+        @returns: A list of (step, dict of device to dict with every
+                  _get_disk_rates metric, 'util_percent_max', 'io_bound'
+                  and 'truncated'), steps named None are left out. A step
+                  is truncated when its first samples were overwritten,
+                  its metrics then cover only the kept part, None if less
+                  than two of its samples were kept.
+        """
+        with self._lock:
+            oldest = max(0, self.count - self.capacity)
+            steps = [(name, start, end) + self._get_rows(max(start, oldest),
+                                                         end)
+                     for name, start, end in self._get_step_rows()]
+        report = []
+        truncated_steps = 0
+        for name, start, _, times, counters in steps:
+            truncated = start < oldest
+            truncated_steps += truncated
+            elapsed = times[-1] - times[0] if len(times) > 1 else 0
+            step = {}
+            for column, device in enumerate(self.devices):
+                counts = counters[:, column].astype(numpy.float64)
+                if elapsed > 0:
+                    stats = dict((metric, float(value)) for metric, value in
+                                 _get_disk_rates(counts[-1] - counts[0],
+                                                 elapsed).items())
+                    intervals = numpy.diff(times)
+                    intervals[intervals <= 0] = numpy.nan
+                    util = _get_disk_rates(numpy.diff(counts, axis=0),
+                                           intervals)['util_percent']
+                    util = util[~numpy.isnan(util)]
+                    stats['util_percent_max'] = (float(util.max()) if util.size
+                                                 else None)
+                else:
+                    stats = dict.fromkeys(_get_disk_rates(counts, 1.0))
+                    stats['util_percent_max'] = None
+                stats['io_bound'] = bool(stats['util_percent'] is not None and
+                                         stats['util_percent'] >= io_bound_util)
+                stats['truncated'] = truncated
+                step[device] = stats
+            report.append((name, step))
+        if truncated_steps:
+            logging.warning('Disk samples of %d steps were overwritten, '
+                            'raise the capacity to keep them all',
+                            truncated_steps)
+        return report
+
+# Storage benchmark. Every worker thread keeps one request in flight, so the
+# number of workers is the queue depth. The buffers are anonymous mmaps,
+# which are page aligned as O_DIRECT requires.
+STORAGE_MODES = ('read', 'write', 'randread', 'randwrite')
+_SIZE_SUFFIXES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+def _parse_size(size):
+    """Returns a size in bytes from an int or a dd style string like '4k'."""
+    if isinstance(size, six.string_types):
+        size = size.strip().lower()
+        if size[-1:] in _SIZE_SUFFIXES:
+            return int(size[:-1]) * _SIZE_SUFFIXES[size[-1]]
+        return int(size)
+    return int(size)
+
+def get_mount_of_path(path):
+    """Returns the mounts() entry of the file system holding path."""
+    path = os.path.realpath(path)
+    best = None
+    for mount in mounts():
+        dest = mount['dest']
+        if (path == dest or path.startswith(dest.rstrip('/') + '/')) and (
+                best is None or len(dest) > len(best['dest'])):
+            best = mount
+    return best
+
+def _open_benchmark_file(path, flags, direct):
+    """Opens path with O_DIRECT if asked and supported.
+    @returns: A tuple (fd, direct) telling if O_DIRECT is used.
     """
-    read_out = utils.run('dd if=/dev/zero of=/home/user/read_file bs=%s count=%s'%().stdout.strip('\n').replace(',', ' ')
-'''
+    if direct and hasattr(os, 'O_DIRECT') and hasattr(os, 'preadv'):
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            logging.warning('O_DIRECT not supported on %s, using the page '
+                            'cache', path)
+    return os.open(path, flags), False
+
+def _create_benchmark_file(path, size, chunk=1 << 20):
+    buf = mmap.mmap(-1, chunk)
+    buf.write(os.urandom(chunk))
+    with open(path, 'wb') as f:
+        for _ in range(size // chunk):
+            f.write(buf)
+        f.write(buf[:size % chunk])
+        f.flush()
+        os.fsync(f.fileno())
+    buf.close()
+
+def run_storage_benchmark(directory='/usr/local', mode='randread',
+                          block_size=4096, count=4096, queue_depth=1,
+                          file_size='256m', direct=True, keep_file=False):
+    """Measures storage throughput, IOPS and latency in-process.
+    @param directory: Directory on the mount to test, a tmpfs or loop mount
+                      works for testing.
+    @param mode: One of STORAGE_MODES.
+    @param block_size: Bytes per request, an int or a size like '4k'.
+    @param count: Number of requests.
+    @param queue_depth: Number of requests in flight.
+    @param file_size: Size of the test file, an int or a size like '256m'.
+    @param direct: True to bypass the page cache with O_DIRECT where the
+                   file system supports it.
+    @param keep_file: True to keep the test file.
+    @returns: A dict with the 'mode', the 'mount' entry, 'direct' telling
+              if O_DIRECT was used, the 'bytes', 'seconds', 'mb_per_s' and
+              'iops', and the request 'latency_ms' percentiles.
+    @raises: error.TestError on an invalid mode or sizes.
+    """
+    if mode not in STORAGE_MODES:
+        raise error.TestError('Unknown storage benchmark mode %s' % mode)
+    block_size = _parse_size(block_size)
+    file_size = _parse_size(file_size)
+    blocks = file_size // block_size
+    if not blocks or block_size % mmap.PAGESIZE:
+        raise error.TestError('Block size %d must be a multiple of %d and '
+                              'smaller than the file' % (block_size,
+                                                         mmap.PAGESIZE))
+    path = os.path.join(directory, 'ts_storage_benchmark.dat')
+    if not os.path.exists(path) or os.path.getsize(path) < file_size:
+        _create_benchmark_file(path, blocks * block_size)
+    writing = mode.endswith('write')
+    if mode.startswith('rand'):
+        offsets = numpy.random.randint(0, blocks, count) * block_size
+    else:
+        offsets = (numpy.arange(count) % blocks) * block_size
+    latencies = numpy.zeros(count)
+    fd, used_direct = _open_benchmark_file(
+            path, os.O_RDWR if writing else os.O_RDONLY, direct)
+    errors = []
+
+    def worker(index):
+        buf = mmap.mmap(-1, block_size)
+        view = memoryview(buf)
+        if writing:
+            buf.write(os.urandom(block_size))
+        try:
+            # Worker i takes requests i, i + queue_depth, ... so sequential
+            # modes still walk the file in order.
+            for request in range(index, count, queue_depth):
+                offset = int(offsets[request])
+                start = time.time()
+                if writing:
+                    done = os.pwrite(fd, view, offset)
+                elif used_direct:
+                    done = os.preadv(fd, [view], offset)
+                else:
+                    done = len(os.pread(fd, block_size, offset))
+                latencies[request] = time.time() - start
+                if done != block_size:
+                    raise IOError('Short transfer of %d bytes at %d'
+                                  % (done, offset))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            view.release()
+            buf.close()
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(queue_depth)]
+    try:
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if writing:
+            os.fsync(fd)
+        seconds = time.time() - start
+    finally:
+        os.close(fd)
+        if not keep_file:
+            os.remove(path)
+    if errors:
+        raise error.TestError('Storage benchmark failed: %s' % errors[0])
+    total = count * block_size
+    result = {'mode': mode, 'mount': get_mount_of_path(directory),
+              'direct': used_direct, 'block_size': block_size,
+              'queue_depth': queue_depth, 'bytes': total,
+              'seconds': seconds, 'mb_per_s': total / seconds / 1e6,
+              'iops': count / seconds,
+              'latency_ms': get_percentiles(latencies * 1000)}
+    logging.info('Storage %s bs=%d qd=%d on %s: %.1f MB/s, %.0f IOPS, '
+                 'p99 %.3f ms', mode, block_size, queue_depth, directory,
+                 result['mb_per_s'], result['iops'],
+                 result['latency_ms']['p99'])
+    return result
+
+def read_from_storage(block_size, count, directory='/usr/local'):
+    """Measures sequential reads of count blocks of block_size bytes.
+    @param block_size: Bytes per read, an int or a dd style size like '4k'.
+    @param count: Number of reads.
+    @param directory: Directory on the storage to test.
+    @returns: The run_storage_benchmark result.
+    """
+    block_size = _parse_size(block_size)
+    return run_storage_benchmark(directory, 'read', block_size, count,
+                                 file_size=block_size * count)
 
 def disconnect_from_wifi_network(SSID):
     """
         This function is to disconnect from SSID
         @params SSID name of the Network
-    """
-    Disconnect_cmd="./wifi disconnect "+ SSID
-    get_output=subprocess.Popen(Disconnect_cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE,shell=True)
-    print("output ",get_output.stderr.readlines())
-    for ele in get_output.stderr.readlines():
-        if "already connected" in ele:
-            return True
-        else:
-            raise error.TestError("Failed to DisConnect from SSID ")
-    time.sleep(Delay_time)
+        @returns dict with success, duration and state of the service
+    """
+    # utils_ts_wifi imports this module, so it is imported on use.
+    import utils_ts_wifi
+    result = utils_ts_wifi.WifiConnectionManager().disconnect(SSID)
+    if not result['success']:
+        raise error.TestError("Failed to DisConnect from SSID ")
+    return result
 
 def connect_to_wifi_network(SSID,Passphrase,security_mode):
     """
@@ -567,28 +1487,144 @@ def connect_to_wifi_network(SSID,Passphrase,security_mode):
     @params SSID --name of the network
     @params Passphrase --password
     @params security_mode -- security property
-    """
-    read_outputDict={}
-    read_outputDict["status"]=''
-    #default path to connect wifi
-    script_path="/usr/local/autotest/cros/scripts"
-    # os.chdir() is used to change dir to wifi script path
-    change_dir = os.chdir(script_path)
-    #cmd is used to connect to SSID with/without passphrase
-    connect_cmd="./wifi connect "+ SSID +" "+Passphrase +" "+ security_mode +" >" + "status.txt"
-    #Popen then cmd and get th output to validate whether is connected or not
-    get_output=subprocess.Popen(connect_cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE,shell=True) 
-    """if get_output.stderr:
-        raise error.TestFail("Failed to connect to network",SSID)
-    else:
-        print("Error ",get_output.stderr.readlines()) """   
-    time.sleep(Delay_time)
+    @returns WifiConnectRecord with the duration of every connection phase
+    """
+    import utils_ts_wifi
+    record = utils_ts_wifi.WifiConnectionManager().connect(
+            SSID, Passphrase, security_mode)
+    if not record.success:
+        raise error.TestFail('Failed to connect to %s: %s' %
+                             (SSID, record.reason))
+    return record
 
 def copy_file_to_server():
     """Copy the recorded file to log location"""
     utils.system_output('mv /home/chronos/user/Downloads/* /usr/local/autotest/results/default/',ignore_status=True)
     logging.info("Video Copied to Log location")
 
+def hash_file(path, block_size=1 << 20):
+    """Returns the sha256 hex digest of a file.
+    @param path: Path of the file.
+    @param block_size: Number of bytes read at once.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_media_hashes(files, manifest_file=None):
+    """Returns the content hashes of local media files.
+    Hashes are cached in manifest_file together with the size and mtime of
+    every file, so unchanged fixtures are not hashed again.
+    @param files: A list of local file paths.
+    @param manifest_file: Path of the JSON manifest. None to not cache.
+    @returns: A dict from file path to sha256 hex digest.
+    """
+    manifest = {}
+    if manifest_file and os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    hashes = {}
+    for path in files:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = manifest.get(key)
+        if (not entry or entry['size'] != stat.st_size or
+                entry['mtime'] != stat.st_mtime):
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                     'sha256': hash_file(path)}
+            manifest[key] = entry
+        hashes[path] = entry['sha256']
+    if manifest_file:
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    return hashes
+
+def provision_media_fixtures(host, files, dest_dir=DOWNLOADS,
+                             store_dir=None, manifest_file=None, workers=4):
+    """Makes media fixtures available in dest_dir on the DUT.
+    The DUT keeps a content addressed store of fixtures, named by their
+    sha256. Only files whose hash is missing from the store are sent, in
+    parallel, and verified on the DUT. All fixtures are then hard linked
+    into dest_dir under their original names. Re-running on the same DUT
+    and user transfers nothing.
+    @param host: The DUT host object.
+    @param files: A list of local paths of media fixtures.
+    @param dest_dir: Directory on the DUT the fixtures are linked into.
+    @param store_dir: Directory of the store on the DUT, MEDIA_STORE in
+                      dest_dir by default. A store on another mount than
+                      dest_dir cannot be linked from, the fixtures are then
+                      copied, which is logged.
+    @param manifest_file: Local JSON file caching the fixture hashes.
+    @param workers: Number of parallel transfers.
+    @returns: A dict with the 'transferred' and 'cached' file lists, the
+              number of 'bytes_transferred', the number of fixtures
+              'copied' instead of linked and the elapsed 'seconds'.
+    @raises: error.TestError if a transferred file is corrupted.
+    """
+    start = time.time()
+    store_dir = store_dir or os.path.join(dest_dir, MEDIA_STORE)
+    hashes = get_media_hashes(files, manifest_file)
+    stored_names = {}
+    for path in files:
+        stored_names[path] = (hashes[path] +
+                              os.path.splitext(path)[1].lower())
+    host.run('mkdir -p %s %s' % (shlex_quote(store_dir),
+                                 shlex_quote(dest_dir)))
+    present = set(host.run('ls -1 %s' % shlex_quote(store_dir),
+                           ignore_status=True).stdout.split())
+    missing = [path for path in files if stored_names[path] not in present]
+    missing = list(collections.OrderedDict(
+            (stored_names[path], path) for path in missing).values())
+
+    def send(path):
+        temp_path = os.path.join(store_dir,
+                                 '.%s.part' % stored_names[path])
+        host.send_file(path, temp_path)
+        return temp_path
+
+    if missing:
+        pool = multiprocessing.pool.ThreadPool(min(workers, len(missing)))
+        try:
+            temp_paths = pool.map(send, missing)
+        finally:
+            pool.close()
+        checks = host.run('sha256sum %s' % ' '.join(
+                shlex_quote(p) for p in temp_paths)).stdout.splitlines()
+        received = dict((line.split()[1], line.split()[0])
+                        for line in checks if line.strip())
+        for path, temp_path in zip(missing, temp_paths):
+            if received.get(temp_path) != hashes[path]:
+                host.run('rm -f %s' % shlex_quote(temp_path))
+                raise error.TestError('Corrupted transfer of %s' % path)
+            host.run('mv -f %s %s' % (
+                    shlex_quote(temp_path),
+                    shlex_quote(os.path.join(store_dir,
+                                             stored_names[path]))))
+    link_commands = []
+    for path in files:
+        source = shlex_quote(os.path.join(store_dir, stored_names[path]))
+        target = shlex_quote(os.path.join(dest_dir, os.path.basename(path)))
+        link_commands.append(
+                'ln -f %s %s 2>/dev/null || (cp -f %s %s && echo copied)' %
+                (source, target, source, target))
+    output = host.run(' && '.join('(%s)' % command
+                                  for command in link_commands)).stdout
+    copied = output.split().count('copied')
+    if copied:
+        logging.warning('%d media fixtures copied, %s and %s are on '
+                        'different mounts', copied, store_dir, dest_dir)
+    result = {'transferred': missing,
+              'cached': [path for path in files if path not in missing],
+              'bytes_transferred': sum(os.path.getsize(path)
+                                       for path in missing),
+              'copied': copied,
+              'seconds': time.time() - start}
+    logging.info('Provisioned %d media fixtures, %d transferred (%d bytes)',
+                 len(files), len(missing), result['bytes_transferred'])
+    return result
+
 def scrolling(URL1,URL2,Scroll_Speed,Scroll_Distance,cr):
     """Perform scroll action on URLs given to the specified distance with specified speed
     @param URL1,URL2 : URLs to perform scroll operation
@@ -642,6 +1678,137 @@ def warmup():
     _player.find_connected_inputs()
     return _player
 
+# Test page of measure_input_latency. It turns white on keydown and records
+# the event time in ms since the epoch. event.timeStamp is the time the
+# input event was generated.
+_INPUT_LATENCY_PAGE = ('data:text/html,<html><body style="margin:0;'
+                       'height:100vh;background:%23000"><script>'
+                       'window.__keyTimes=[];'
+                       'document.addEventListener("keydown",function(e){'
+                       'window.__keyTimes.push(performance.timeOrigin+e.timeStamp);'
+                       'document.body.style.background="%23fff";});'
+                       'window.__reset=function(){window.__keyTimes=[];'
+                       'document.body.style.background="%23000";};'
+                       '</script></body></html>')
+
+def _grab_frames(directory, box, stop, frames):
+    """Takes screenshots until stop is set.
+    Appends (start, end, path) of every screenshot to frames.
+    """
+    while not stop.is_set():
+        path = os.path.join(directory, 'frame%04d.png' % len(frames))
+        start = time.time()
+        graphics_utils.take_screenshot_crop(path, box)
+        frames.append((start, time.time(), path))
+
+def _load_frame(path, factor):
+    """Decodes and reduces a screenshot to a gray (1, h, w) array."""
+    return utils_ts_image.to_gray(utils_ts_image.downscale(
+            utils_ts_image.read_png(path), factor))[numpy.newaxis]
+
+def _find_changed_frame(paths, factor):
+    """Finds the first screenshot which changed from the first one.
+    The test page changes once per trial, so the frames are bisected and
+    only about log2(len(paths)) of them are decoded.
+    @returns: The index in paths, None if no frame changed.
+    """
+    baseline = _load_frame(paths[0], factor)[0]
+
+    def changed(index):
+        return utils_ts_image.find_first_changed_frame(
+                _load_frame(paths[index], factor), baseline)[0] is not None
+
+    low, high = 1, len(paths) - 1
+    if high < low or not changed(high):
+        return None
+    while low < high:
+        middle = (low + high) // 2
+        if changed(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+def measure_input_latency(cr, trials=20, key='a', window=0.5, box=None,
+                          factor=8, settle=0.3):
+    """Measures the time from a key press to its change on the screen.
+    A test page turning white on keydown is opened, the key is pressed with
+    an emulated keyboard while screenshots are taken back to back, and the
+    first screenshot showing the change is bisected once the trial is over,
+    so decoding the frames does not delay the screenshots.
+    @param cr: Chrome object.
+    @param trials: Number of key presses.
+    @param key: Key to press, see input_playback keyboard.
+    @param window: Seconds screenshots are taken after the press.
+    @param box: Area of the screenshots as given to
+                graphics_utils.take_screenshot_crop, the whole screen
+                by default. It must be inside the test page.
+    @param factor: Reduction factor of the frames before the comparison.
+    @param settle: Seconds to let the reset page be displayed.
+    @returns: A dict with the 'latency' percentiles in seconds, the
+              per trial 'latencies' (NaN if no change was seen), the
+              number of 'missed' trials and the mean 'grab_period', which
+              bounds the resolution of the measurement.
+    @raises: error.TestError if no screenshot could be taken in a trial.
+    """
+    tab = cr.browser.tabs.New()
+    tab.Navigate(_INPUT_LATENCY_PAGE)
+    tab.WaitForDocumentReadyStateToBeComplete()
+    tab.Activate()
+    kbd = keyboard.Keyboard()
+    latencies = numpy.full(trials, numpy.nan)
+    periods = []
+    directory = tempfile.mkdtemp()
+    try:
+        for trial in range(trials):
+            tab.ExecuteJavaScript('window.__reset();')
+            time.sleep(settle)
+            frames = []
+            stop = threading.Event()
+            grabber = threading.Thread(target=_grab_frames,
+                                       args=(directory, box, stop, frames))
+            grabber.start()
+            try:
+                # Let the first frames show the reset page.
+                while len(frames) < 2 and grabber.is_alive():
+                    time.sleep(0.005)
+                kbd.press_key(key)
+                time.sleep(window)
+            finally:
+                stop.set()
+                grabber.join()
+            if not frames:
+                raise error.TestError('Trial %d: no screenshot taken' % trial)
+            # Reset with the page, so they are the times of this trial only.
+            key_times = tab.EvaluateJavaScript('window.__keyTimes')
+            index = _find_changed_frame([path for _, _, path in frames],
+                                        factor)
+            if len(frames) > 1:
+                periods.append((frames[-1][0] - frames[0][0]) /
+                               (len(frames) - 1))
+            if not key_times:
+                logging.warning('Trial %d: the key press was not received',
+                                trial)
+            elif index is None:
+                logging.warning('Trial %d: no change on the screen', trial)
+            else:
+                start, end, _ = frames[index]
+                # The frame was read from the screen during its screenshot.
+                latencies[trial] = (start + end) / 2 - key_times[0] / 1000
+            for _, _, path in frames:
+                os.remove(path)
+    finally:
+        kbd.close()
+        shutil.rmtree(directory, ignore_errors=True)
+        tab.Close()
+    result = {'latency': get_percentiles(latencies),
+              'latencies': latencies,
+              'missed': int(numpy.isnan(latencies).sum()),
+              'grab_period': float(numpy.mean(periods)) if periods else None}
+    logging.info('Key to photon latency: %s, grab period %s s',
+                 result['latency'], result['grab_period'])
+    return result
+
 def launch_an_app(appname,ui):
     """Launch an app from Launcher
     @param appname - Application name which needs to be minimized
@@ -734,41 +1901,259 @@ def open_status_tray(cr):
     list=ui.get_name_role_list()
     return ui
 
+# GPU load files, busy percentage of AMD and Adreno GPUs and current
+# frequency of Intel GPUs, the first one present is sampled.
+_GPU_BUSY_FILES = ('/sys/class/drm/card0/device/gpu_busy_percent',
+                   '/sys/class/kgsl/kgsl-3d0/gpu_busy_percentage')
+_GPU_FREQ_FILES = ('/sys/class/drm/card0/gt_act_freq_mhz',
+                   '/sys/class/drm/card0/gt_cur_freq_mhz')
+
+def get_cpu_times():
+    """Returns (busy, total) CPU time of all the CPUs in clock ticks."""
+    with open('/proc/stat') as f:
+        fields = [int(field) for field in f.readline().split()[1:]]
+    # idle and iowait are the 4th and 5th fields.
+    return sum(fields) - fields[3] - fields[4], sum(fields)
+
+def _read_first_number(paths):
+    for path in paths:
+        try:
+            with open(path) as f:
+                return float(f.read().split()[0].rstrip('%'))
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+    return None
+
+class _LoadSampler(_Sampler):
+    """Samples the system CPU and the GPU load in a background thread."""
+
+    def __init__(self, interval=1.0):
+        super(_LoadSampler, self).__init__(interval)
+        self._samples = collections.defaultdict(list)
+        self._cpu_times = None
+
+    def _sample(self):
+        busy, total = get_cpu_times()
+        if self._cpu_times and total > self._cpu_times[1]:
+            self._samples['cpu_percent'].append(
+                    100.0 * (busy - self._cpu_times[0]) /
+                    (total - self._cpu_times[1]))
+        self._cpu_times = busy, total
+        for name, paths in (('gpu_busy_percent', _GPU_BUSY_FILES),
+                            ('gpu_freq_mhz', _GPU_FREQ_FILES)):
+            value = _read_first_number(paths)
+            if value is not None:
+                self._samples[name].append(value)
+        self.count += 1
+
+    def stop(self):
+        """Stops sampling.
+        @returns: A dict of sample name to numpy array.
+        """
+        super(_LoadSampler, self).stop()
+        with self._lock:
+            return dict((name, numpy.array(values))
+                        for name, values in self._samples.items())
+
+class ScreenRecorder(object):
+    """Drives the full screen recording of the screen capture tool.
+
+    The recording started and stopped states are confirmed by the stop
+    button appearing and disappearing in the shelf, each transition is
+    timed, and the system load is sampled while the recording runs.
+    """
+
+    STOP_BUTTON = '/Stop screen recording/i'
+
+    def __init__(self, cr, sample_interval=1.0, timeout=_URL_WAKEUP_TIME):
+        """@param cr: Chrome object.
+        @param sample_interval: Seconds between two load samples.
+        @param timeout: Seconds to wait for each UI element.
+        """
+        self.ui = ui_utils.UI_Handler()
+        self.ui.start_ui_root(cr)
+        self.sample_interval = sample_interval
+        self.timeout = timeout
+        self.timings = {}
+        self.baseline = None
+        self._player = None
+        self._sampler = None
+        self._recordings = set()
+
+    def _click(self, name, role):
+        self.ui.wait_for_ui_obj(name, True, role=role, timeout=self.timeout)
+        self.ui.doDefault_on_obj(name, True, role=role)
+
+    def _press(self, filename):
+        if self._player is None:
+            self._player = warmup()
+        self._player.blocking_playback_of_default_file(input_type='keyboard',
+                                                       filename=filename)
+
+    def measure_baseline(self, duration=5):
+        """Samples the load without recording, to compare with it.
+        @returns: A dict of sample name to percentiles.
+        """
+        sampler = _LoadSampler(self.sample_interval).start()
+        time.sleep(duration)
+        self.baseline = dict((name, get_percentiles(values)) for name, values
+                             in sampler.stop().items())
+        return self.baseline
+
+    def start(self, open_tab=True):
+        """Starts a full screen recording and waits until it runs.
+        @param open_tab: True to open a new tab once recording, so the
+                         recording has content. The tab is opened before
+                         the load is sampled, so its cost is not counted
+                         as overhead of the recording, like in
+                         measure_baseline.
+        @returns: The seconds from the start request to the recording state.
+        @raises: error.TestFail if the recording did not start.
+        """
+        self._recordings = set(glob.glob(os.path.join(DOWNLOADS,
+                                                      SCREEN_RECORDING)))
+        start = time.time()
+        logging.info("Opening status tray")
+        self._click(STATUS_TRAY_REGEXP, 'button')
+        if self.ui.item_present('/Close/i', True, role='button'):
+            self.ui.doDefault_on_obj('/Close/i', True, role='button')
+        self._click('/Screen capture/i', 'button')
+        self._click('/Screen record/i', 'toggleButton')
+        self._click('/Record full screen/i', 'toggleButton')
+        self.timings['ui'] = time.time() - start
+        requested = time.time()
+        self._press('keyboard_enter')
+        try:
+            self.ui.wait_for_ui_obj(self.STOP_BUTTON, True, role='button',
+                                    timeout=self.timeout)
+        except Exception as e:
+            raise error.TestFail('Screen recording did not start: %s' % e)
+        self.timings['start'] = time.time() - requested
+        if open_tab:
+            self._press('keyboard_ctrl+t')
+        self._sampler = _LoadSampler(self.sample_interval).start()
+        logging.info("Recording Started after %.2f s", self.timings['start'])
+        return self.timings['start']
+
+    def _wait_for_recording(self, timeout):
+        """Returns the new recording once its size stopped changing."""
+        sizes = {}
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for path in glob.glob(os.path.join(DOWNLOADS, SCREEN_RECORDING)):
+                if path in self._recordings:
+                    continue
+                size = os.path.getsize(path)
+                if size and sizes.get(path) == size:
+                    return path
+                sizes[path] = size
+            time.sleep(0.2)
+        raise error.TestFail('Screen recording was not saved in %s'
+                             % DOWNLOADS)
+
+    def stop(self, save_timeout=60):
+        """Stops the recording and waits until it is saved.
+        @param save_timeout: Seconds to wait for the file.
+        @returns: A dict with the 'timings' of the transitions in seconds,
+                  the 'load' percentiles while recording, the 'overhead',
+                  the difference of the mean load to measure_baseline, and
+                  the recording 'path'.
+        @raises: error.TestFail if the recording did not stop or was not
+                 saved.
+        """
+        requested = time.time()
+        self._click(self.STOP_BUTTON, 'button')
+        try:
+            self.ui.wait_for_ui_obj(self.STOP_BUTTON, True, remove=True,
+                                    role='button', timeout=self.timeout)
+        except Exception as e:
+            raise error.TestFail('Screen recording did not stop: %s' % e)
+        self.timings['stop'] = time.time() - requested
+        samples = self._sampler.stop() if self._sampler else {}
+        self._sampler = None
+        path = self._wait_for_recording(save_timeout)
+        self.timings['save'] = time.time() - requested
+        load = dict((name, get_percentiles(values))
+                    for name, values in samples.items())
+        overhead = {}
+        for name, stats in load.items():
+            if self.baseline and name in self.baseline and stats['mean'] is not None:
+                overhead[name] = stats['mean'] - self.baseline[name]['mean']
+        logging.info("Recording Stopped: %s, load %s, overhead %s",
+                     self.timings, load, overhead)
+        return {'timings': dict(self.timings), 'load': load,
+                'overhead': overhead, 'path': path}
+
+    def close(self):
+        if self._sampler:
+            self._sampler.stop()
+            self._sampler = None
+        if self._player:
+            self._player.close()
+            self._player = None
+
 def start_record(cr):
-    """Emulate the Keyboard,get ui elements and start screen recording
+    """Starts a full screen recording.
     @ param cr: Creating Chrome instance
-    @ return cr object """
-    """Emulate the keyboard    """
-    _player = input_playback.InputPlayback()
-    _player.emulate(input_type='keyboard')
-    _player.find_connected_inputs()
-    """To get list of UI elements"""
-    ui = ui_utils.UI_Handler()
-    ui.start_ui_root(cr)
-    list=ui.get_name_role_list()
-    """To Open status tray and click on Screen Recording option"""
-    logging.info("Opening status tray")
-    ui.doDefault_on_obj(STATUS_TRAY_REGEXP, True, role='button')
-    time.sleep(WAIT)
-    ui.doDefault_on_obj('/Close/i', True, role='button')
-    ui.doDefault_on_obj('/Screen capture/i', True, role='button')
-    ui.doDefault_on_obj('/Screen record/i', True,role='toggleButton')
-    ui.doDefault_on_obj('/Record full screen/i', True,role='toggleButton')
-    _player.blocking_playback_of_default_file(input_type='keyboard', filename='keyboard_enter')
-    """To open Chrome Page"""
-    _player.blocking_playback_of_default_file(input_type='keyboard', filename='keyboard_ctrl+t')
-    time.sleep(WAIT)
-    logging.info("Recording Started")
-    return ui
+    @ return ScreenRecorder to pass to stop_record, its ui attribute is the
+      UI handler returned before """
+    recorder = ScreenRecorder(cr)
+    try:
+        recorder.start()
+    except Exception:
+        recorder.close()
+        raise
+    return recorder
 
 def stop_record(ui):
     """stop the screen recording to save the file to Downloads
-       @ param ui- to get ui objects"""
+       @ param ui- ScreenRecorder from start_record, or a UI handler
+       @ return the ScreenRecorder.stop result, None for a UI handler"""
+    if isinstance(ui, ScreenRecorder):
+        try:
+            return ui.stop()
+        finally:
+            ui.close()
     # To stop screen recording
-    ui.WAIT_for_ui_obj('/Stop screen recording/i', True, role='button')
+    ui.wait_for_ui_obj('/Stop screen recording/i', True, role='button')
     ui.doDefault_on_obj('/Stop screen recording/i',True,role='button')
     time.sleep(WAIT)
-    logging.info("Recording Stopped")  
+    logging.info("Recording Stopped")
+    return None
+
+SCREEN_RECORDING = 'Screen recording*.webm'
+
+def verify_screen_recording(path=None, min_duration=1.0, max_drop_rate=0.05,
+                            expected_fps=None):
+    """Checks a screen recording from its container, without decoding it.
+    @param path: Path of the WebM recording, the newest recording in
+                 DOWNLOADS by default.
+    @param min_duration: Shortest valid duration in seconds.
+    @param max_drop_rate: Largest valid fraction of dropped frames.
+    @param expected_fps: Frame rate of the recording, estimated from the
+                         frame intervals by default.
+    @returns: The utils_ts_webm.get_video_stats dict, with the 'path'.
+    @raises: error.TestFail if there is no recording or it is not valid.
+    """
+    if path is None:
+        paths = glob.glob(os.path.join(DOWNLOADS, SCREEN_RECORDING))
+        if not paths:
+            raise error.TestFail('No screen recording in %s' % DOWNLOADS)
+        path = max(paths, key=os.path.getmtime)
+    try:
+        stats = utils_ts_webm.get_video_stats(path, expected_fps)
+    except (ValueError, IOError, OSError) as e:
+        raise error.TestFail('Invalid screen recording %s: %s' % (path, e))
+    stats['path'] = path
+    logging.info('Screen recording %s: %s', path, stats)
+    if stats['duration'] < min_duration:
+        raise error.TestFail('Screen recording lasts %.2f s, expected %.2f s'
+                             % (stats['duration'], min_duration))
+    if stats['drop_rate'] > max_drop_rate:
+        raise error.TestFail('Screen recording dropped %d frames (%.1f%%)'
+                             % (stats['dropped_frames'],
+                                stats['drop_rate'] * 100))
+    return stats
 
 def copyFile(source,destination):
     """ To copy a file from source location to destination.
@@ -17,6 +17,7 @@ from autotest_lib.client.cros.input_playback import keyboard
 from autotest_lib.client.cros.audio import cras_utils
 from autotest_lib.client.common_lib.utils import *
 from autotest_lib.client.bin import utils_ts
+from autotest_lib.client.bin import utils_ts_audio_analysis
 import base64
 import collections
 import errno
@@ -25,14 +26,19 @@ import json
 import logging
 import math
 import multiprocessing
+import numpy
 import os
 import platform
 import re
+import select
 import shutil
 import string
 import subprocess
+import tempfile
 import time
 import uuid
+import six
+from six.moves import range
 WAIT = 10
 def get_cras_nodes_cmd():
     """Gets a command to query the nodes from Cras.
@@ -86,6 +92,115 @@ def node_type_is_plugged(node_type, nodes_info):
     match = re.search(r'string "Type"\s+variant\s+string "%s"' % node_type,
                       nodes_info)
     return True if match else False
+
+# A dict entry of the dbus-send --print-reply output of GetNodes, e.g.
+#   dict entry(
+#      string "NodeVolume"
+#      variant             uint32 100
+#   )
+# Every node is printed as an "array [" of such dict entries.
+_DBUS_DICT_ENTRY_RE = re.compile(
+        r'string "([^"]+)"\s+variant\s+(\w+) ("[^"]*"|\S+)')
+_DBUS_VALUE_PARSERS = {
+        'boolean': lambda value: value == 'true',
+        'double': float,
+        'string': lambda value: value[1:-1],
+}
+_DBUS_VALUE_PARSERS.update(dict.fromkeys(
+        ('byte', 'int16', 'uint16', 'int32', 'uint32', 'int64', 'uint64'),
+        int))
+
+def parse_cras_nodes_output(nodes_info):
+    """Parses the output of get_cras_nodes_cmd into node records.
+    Every node becomes a dict with the same keys as the nodes returned by
+    get_cras_nodes, e.g. 'Id', 'Type', 'IsInput', 'Active' and 'NodeVolume'.
+    This does not need python-dbus so it can be executed on autotest server.
+    The result can be passed to get_selected_node_types,
+    get_plugged_node_types and get_filtered_node_types to answer the
+    queries for all node types from a single parse.
+    @param nodes_info: A str containing output of command get_nodes_cmd.
+    @returns: A list of dicts containing information of each node.
+    """
+    nodes = []
+    for block in nodes_info.split('array [')[1:]:
+        node = dict((key, _DBUS_VALUE_PARSERS.get(value_type, str)(value))
+                    for key, value_type, value
+                    in _DBUS_DICT_ENTRY_RE.findall(block))
+        if node:
+            nodes.append(node)
+    return nodes
+
+def format_cras_nodes_output(nodes):
+    """Formats node records the way dbus-send prints the GetNodes reply.
+    This is the inverse of parse_cras_nodes_output and is used to build
+    stand-in outputs for tests and benchmarks.
+    @param nodes: A list of dicts containing information of each node.
+    @returns: A str in the format of the output of get_cras_nodes_cmd.
+    """
+    lines = ['method return time=0.0 sender=:1.0 -> destination=:1.1 '
+             'serial=1 reply_serial=2']
+    for node in nodes:
+        lines.append('   array [')
+        for key, value in node.items():
+            if isinstance(value, bool):
+                printed = 'boolean %s' % ('true' if value else 'false')
+            elif isinstance(value, six.integer_types):
+                printed = 'uint64 %d' % value
+            elif isinstance(value, float):
+                printed = 'double %r' % value
+            else:
+                printed = 'string "%s"' % value
+            lines.append('      dict entry(')
+            lines.append('         string "%s"' % key)
+            lines.append('         variant             %s' % printed)
+            lines.append('      )')
+        lines.append('   ]')
+    return '\n'.join(lines) + '\n'
+
+def benchmark_cras_nodes_parsing(num_nodes=1000, iterations=10):
+    """Compares per-type regex lookups with a single structured parse.
+    A stand-in GetNodes output with num_nodes nodes is generated, then the
+    plugged state of every type in CRAS_NODE_TYPES is computed both with
+    node_type_is_plugged and from one parse_cras_nodes_output call.
+    @param num_nodes: Number of nodes in the generated output.
+    @param iterations: Number of times each approach is repeated.
+    @returns: A dict with the average seconds per full query of both
+              approaches and the speedup of the structured parse.
+    @raises: error.TestError if both approaches disagree.
+    """
+    nodes = []
+    for index in range(num_nodes):
+        is_input = bool(index % 2)
+        types = CRAS_INPUT_NODE_TYPES if is_input else CRAS_OUTPUT_NODE_TYPES
+        nodes.append({'IsInput': is_input,
+                      'Id': ((index + 1) << 32) + index,
+                      'DeviceName': 'Device %d' % index,
+                      'Type': types[(index // 2) % len(types)],
+                      'Name': 'Node %d' % index,
+                      'Active': index < 2,
+                      'NodeVolume': 100})
+    # Drop every node of the last type so the regex has to scan everything.
+    nodes = [node for node in nodes if node['Type'] != CRAS_NODE_TYPES[-1]]
+    nodes_info = format_cras_nodes_output(nodes)
+    start = time.time()
+    for _ in range(iterations):
+        regex_plugged = set(node_type for node_type in CRAS_NODE_TYPES
+                            if node_type_is_plugged(node_type, nodes_info))
+    regex_time = (time.time() - start) / iterations
+    start = time.time()
+    for _ in range(iterations):
+        parsed_nodes = parse_cras_nodes_output(nodes_info)
+        parsed_plugged = set(node['Type'] for node in parsed_nodes)
+    parse_time = (time.time() - start) / iterations
+    if regex_plugged != parsed_plugged:
+        raise error.TestError('Parsed node types %s differ from %s' %
+                              (sorted(parsed_plugged), sorted(regex_plugged)))
+    logging.info('GetNodes with %d nodes: regex %.6fs, parse %.6fs',
+                 len(nodes), regex_time, parse_time)
+    return {'num_nodes': len(nodes),
+            'regex_seconds': regex_time,
+            'parse_seconds': parse_time,
+            'speedup': regex_time / parse_time if parse_time else None}
 # Cras node types reported from Cras DBus control API.
 CRAS_OUTPUT_NODE_TYPES = ['HEADPHONE', 'INTERNAL_SPEAKER', 'HDMI', 'USB',
                           'BLUETOOTH', 'LINEOUT', 'UNKNOWN', 'ALSA_LOOPBACK']
@@ -95,8 +210,10 @@ CRAS_INPUT_NODE_TYPES = ['MIC', 'INTERNAL_MIC', 'USB', 'BLUETOOTH',
                          'ECHO_REFERENCE']
 CRAS_NODE_TYPES = CRAS_OUTPUT_NODE_TYPES + CRAS_INPUT_NODE_TYPES
 
-def get_selected_node_types():
+def get_selected_node_types(nodes=None):
     """Returns the pair of active output node types and input node types.
+    @param nodes: A list of nodes, e.g. from parse_cras_nodes_output. None to
+                  query Cras.
     @returns: A tuple (output_node_types, input_node_types) where each
               field is a list of selected node types defined in CRAS_NODE_TYPES.
     """
@@ -106,10 +223,12 @@ def get_selected_node_types():
         @returns: True is a node is selected, False otherwise.
         """
         return node['Active']
-    return get_filtered_node_types(is_selected)
+    return get_filtered_node_types(is_selected, nodes)
 
-def get_plugged_node_types():
+def get_plugged_node_types(nodes=None):
     """Returns the pair of plugged output node types and input node types.
+    @param nodes: A list of nodes, e.g. from parse_cras_nodes_output. None to
+                  query Cras.
     @returns: A tuple (output_node_types, input_node_types) where each
               field is a list of plugged node types defined in CRAS_NODE_TYPES.
     """
@@ -123,19 +242,22 @@ def get_plugged_node_types():
         @returns: True if a node is plugged and is not an UNKNOWN node.
         """
         return node['Type'] != 'UNKNOWN'
-    return get_filtered_node_types(is_plugged)
+    return get_filtered_node_types(is_plugged, nodes)
 
-def get_filtered_node_types(callback):
+def get_filtered_node_types(callback, nodes=None):
     """Returns the pair of filtered output node types and input node types.
     @param callback: A callback function which takes a node as input parameter
                      and filter the node based on its return value.
+    @param nodes: A list of nodes, e.g. from parse_cras_nodes_output. None to
+                  query Cras.
     @returns: A tuple (output_node_types, input_node_types) where each
               field is a list of node types defined in CRAS_NODE_TYPES,
               and their 'attribute_name' is True.
     """
     output_node_types = []
     input_node_types = []
-    nodes = get_cras_nodes()
+    if nodes is None:
+        nodes = get_cras_nodes()
     for node in nodes:
         if callback(node):
             node_type = str(node['Type'])
@@ -275,7 +397,7 @@ def get_node_id_from_node_type(node_type, is_input):
         if node['Type'] == node_type and node['IsInput'] == is_input:
             find_ids.append(node['Id'])
     if len(find_ids) != 1:
-        raise CrasUtilsError(
+        raise cras_utils.CrasUtilsError(
                 'Can not find unique node id from node type %s' % node_type)
     return find_ids[0]
 
@@ -289,7 +411,7 @@ def get_device_id_of(node_id):
     """
     device_id = str(int(node_id) >> 32)
     if device_id == "0":
-        raise CrasUtilsError('Got invalid device_id: 0')
+        raise cras_utils.CrasUtilsError('Got invalid device_id: 0')
     return device_id
 
 def get_device_id_from_node_type(node_type, is_input):
@@ -349,7 +471,7 @@ def get_active_node_volume():
     for node in nodes:
         if node['Active'] == 1 and node['IsInput'] == 0:
             return int(node['NodeVolume'])
-    raise CrasUtilsError('Cannot find active node volume from nodes.')
+    raise cras_utils.CrasUtilsError('Cannot find active node volume from nodes.')
 
 def get_selected_output_device_type():
     """Returns the device type of the active output node.
@@ -375,7 +497,9 @@ def audio_playback_defaultplayer(cr,Files,test_Files):
     """ Playsback audio file using default audio player.
     @ cr: creating Chrome instance for getting ui elements
     @Files: App name to launch from Launcher and to open Downloads
-    @ test_Files: Audio test files to push into device"""
+    @ test_Files: Audio test file to play from Downloads. Push it from the
+    server with utils_ts.provision_media_fixtures, which only transfers
+    files missing from the media store of the device."""
     player1= utils_ts.warmup()
     ui = ui_utils.UI_Handler()
     ui.start_ui_root(cr)
@@ -385,7 +509,7 @@ def audio_playback_defaultplayer(cr,Files,test_Files):
     ui.doDefault_on_obj('Downloads', False, 'treeItem')
     time.sleep(WAIT) 
     '''To Play the Test file'''
-    ui.doDefault_on_obj(file, False, 'inlineTextBox')
+    ui.doDefault_on_obj(os.path.basename(test_Files), False, 'inlineTextBox')
     player1.blocking_playback_of_default_file(input_type='keyboard', filename='keyboard_enter')
     time.sleep(WAIT)
 
@@ -408,35 +532,138 @@ def default_player_seek_forward_backward(seek_forward_time,seek_backward_time,ui
     for backward_time in range(seek_backward_time):
         _player.blocking_playback_of_default_file(input_type='keyboard', filename='keyboard_down')
 
+# Connection of _get_cras_signal_bus, kept between volume sweeps.
+_CRAS_SIGNAL_BUS = None
+
+def _get_cras_signal_bus(reconnect=False):
+    """Gets a private system bus which can receive Cras signals.
+    The connection is made on the first call and reused afterwards.
+    @param reconnect: True to drop the kept connection, e.g. after Cras
+                      restarted, and connect again.
+    @returns: A tuple (bus, interface, context) of the dbus.SystemBus, the
+              Cras Control interface on it and the GLib main context which
+              dispatches its signals.
+    @raises: ImportError if this is not called on Cros device.
+    """
+    global _CRAS_SIGNAL_BUS
+    if reconnect and _CRAS_SIGNAL_BUS:
+        _CRAS_SIGNAL_BUS[0].close()
+        _CRAS_SIGNAL_BUS = None
+    if _CRAS_SIGNAL_BUS:
+        return _CRAS_SIGNAL_BUS
+    try:
+        import dbus
+        from dbus.mainloop.glib import DBusGMainLoop
+        from gi.repository import GLib
+    except ImportError as e:
+        logging.exception(
+                'Can not import dbus: %s. This method should only be '
+                'called on Cros device.', e)
+        raise
+    bus = dbus.SystemBus(private=True, mainloop=DBusGMainLoop())
+    cras_object = bus.get_object('org.chromium.cras', '/org/chromium/cras')
+    interface = dbus.Interface(cras_object, 'org.chromium.cras.Control')
+    _CRAS_SIGNAL_BUS = bus, interface, GLib.MainContext.default()
+    return _CRAS_SIGNAL_BUS
+
+def sweep_output_volume(volumes, node_types=None, hold=0, timeout=2):
+    """Steps the volume of the selected output nodes through volumes.
+    All steps and sweeps use one Cras connection. Every step is confirmed by the
+    OutputNodeVolumeChanged signal of Cras, and the time from the set call
+    to the signal is recorded. When no signal arrives within timeout, for
+    example because the node already had that volume, the volume is read
+    back from GetNodes and the latency is NaN.
+    @param volumes: A list of volumes (0-100) to set in order.
+    @param node_types: A list of output node types to select first. None to
+                       use the currently selected output nodes.
+    @param hold: Seconds to wait after each step.
+    @param timeout: Seconds to wait for the signal of a step.
+    @returns: A dict with 'node_ids', 'volumes', 'latencies' (a numpy array
+              of seconds, one row per step and one column per node),
+              'mismatches' (a list of (step, node_id, requested, applied)
+              where Cras applied another volume) and the percentiles of the
+              latencies from utils_ts.get_percentiles.
+    @raises: cras_utils.CrasUtilsError if no output node is selected.
+    """
+    if node_types:
+        set_selected_output_nodes(node_types)
+    bus, interface, context = _get_cras_signal_bus()
+    try:
+        nodes = interface.GetNodes()
+    except Exception:
+        logging.info('Cras connection lost, connecting again')
+        bus, interface, context = _get_cras_signal_bus(reconnect=True)
+        nodes = interface.GetNodes()
+    node_ids = [int(node['Id']) for node in nodes
+                if node['Active'] and not node['IsInput']]
+    if not node_ids:
+        raise cras_utils.CrasUtilsError('No selected output node to sweep.')
+    applied = {}
+
+    def on_volume_changed(node_id, volume):
+        applied[int(node_id)] = (time.time(), int(volume))
+
+    bus.add_signal_receiver(on_volume_changed,
+                            signal_name='OutputNodeVolumeChanged',
+                            dbus_interface='org.chromium.cras.Control')
+    latencies = numpy.full((len(volumes), len(node_ids)), numpy.nan)
+    mismatches = []
+    try:
+        for step, volume in enumerate(volumes):
+            for column, node_id in enumerate(node_ids):
+                applied.pop(node_id, None)
+                start = time.time()
+                interface.SetOutputNodeVolume(node_id, volume)
+                deadline = start + timeout
+                while node_id not in applied and time.time() < deadline:
+                    if not context.iteration(False):
+                        time.sleep(0.001)
+                if node_id in applied:
+                    signal_time, applied_volume = applied[node_id]
+                    latencies[step, column] = signal_time - start
+                else:
+                    logging.warning('No volume signal of node %d for %d',
+                                    node_id, volume)
+                    applied_volume = [int(node['NodeVolume']) for node
+                                      in interface.GetNodes()
+                                      if int(node['Id']) == node_id][0]
+                if applied_volume != volume:
+                    mismatches.append((step, node_id, volume,
+                                       applied_volume))
+            if hold:
+                time.sleep(hold)
+    finally:
+        bus.remove_signal_receiver(on_volume_changed,
+                                   signal_name='OutputNodeVolumeChanged',
+                                   dbus_interface='org.chromium.cras.Control')
+    result = utils_ts.get_percentiles(latencies.ravel())
+    result.update({'node_ids': node_ids,
+                   'volumes': list(volumes),
+                   'latencies': latencies,
+                   'mismatches': mismatches})
+    logging.info('Volume sweep of %d steps: p50 %s s, %d mismatches',
+                 len(volumes), result['p50'], len(mismatches))
+    return result
+
 def mute_unmute():
     """ To Mute/Unmute the volume during Audio file playback in Default player"""
-    '''To set the output node volume to 0'''
-    set_selected_output_node_volume(0)
-    '''Get the Current Volume'''
-    current_volume = get_active_node_volume()
-    time.sleep(WAIT)
-    if (current_volume==0):
-        logging.info("Current volume is set")
-    else:
-        raise error.TestError("Volume didnt change as expected")
-    '''To set the output node volume to 100'''
-    set_selected_output_node_volume(100)
-    '''Get the Current Volume'''
-    current_volume = get_active_node_volume()
-    if (current_volume==100):
-        logging.info("Current volume is set" )
-    else:
-        raise error.TestError("Volume didnt change as expected") 
+    '''To set the output node volume to 0 and then back to 100'''
+    result = sweep_output_volume([0, 100], hold=WAIT)
+    if result['mismatches']:
+        raise error.TestError("Volume didnt change as expected: %s" %
+                              result['mismatches'])
+    logging.info("Current volume is set")
+    return result
 
 def volume_change(volume):
     """To set thevolume to the required number
     @volume : Volume to set on device;Value Ranges from (0 - 100)"""
-    set_selected_output_node_volume(volume)
-    current_volume = get_active_node_volume()
-    if (volume==current_volume):
-        logging.info("Current volume is" ,current_volume)
-    else:
-        raise error.TestError("Volume didnt change")
+    result = sweep_output_volume([volume])
+    if result['mismatches']:
+        raise error.TestError("Volume didnt change: %s" %
+                              result['mismatches'])
+    logging.info("Current volume is %d", volume)
+    return result
 
 def validate_audio_based_on_time_interval(ui_elements):
                 time_intv=[]
@@ -461,20 +688,417 @@ def validate_audio_based_on_time_interval(ui_elements):
                 status["status"]=var
                 return current_time
 
-def check_audio_playing(ui):
-    '''To get the current ui elements'''
-                ui_elements=ui.get_name_role_list()
-                old_var=validate_audio_based_on_time_interval(ui_elements)
-                time.sleep(10)
-    '''To get the current ui elements'''
-                ui_elements_new=ui.get_name_role_list()
-                new_var=validate_audio_based_on_time_interval(ui_elements_new)
-                logging.info("audio file time",old_var, new_var)
-    '''Compare old player time with new time'''
-                if old_var < new_var:
-                                logging.info("audio file is being played")
+def capture_audio(duration, node_type='POST_MIX_LOOPBACK', channels=2,
+                  rate=48000, wav_file=None):
+    """Captures audio from an input node of the given type.
+    @param duration: Capture duration in seconds.
+    @param node_type: Input node type to pin the capture to, e.g.
+                      POST_MIX_LOOPBACK to record what is being played.
+    @param channels: Number of channels to capture.
+    @param rate: Sampling rate in Hz.
+    @param wav_file: A WAV file to read instead of capturing, used as a
+                     stand-in when no device is available.
+    @returns: A tuple (samples, rate) where samples is a float numpy array
+              of shape (frames, channels).
+    """
+    if wav_file:
+        return utils_ts_audio_analysis.read_wav_file(wav_file)
+    pin_device = get_device_id_from_node_type(node_type, True)
+    capture_file = tempfile.NamedTemporaryFile(suffix='.raw', delete=False)
+    capture_file.close()
+    try:
+        cras_utils.capture(capture_file.name, duration=duration,
+                           channels=channels, rate=rate,
+                           pin_device=pin_device)
+        samples = utils_ts_audio_analysis.read_raw_file(capture_file.name,
+                                                        channels)
+    finally:
+        os.remove(capture_file.name)
+    return samples, rate
+
+def verify_audio_playing(expected_frequency=None, duration=1,
+                         wav_file=None):
+    """Checks from the played signal whether audio is being played.
+    Audio is captured from the POST_MIX_LOOPBACK node, so the result does
+    not depend on the layout of the player UI.
+    @param expected_frequency: Expected tone in Hz. None to only check
+                               that something is playing.
+    @param duration: Capture window in seconds.
+    @param wav_file: A WAV file to analyze instead of capturing.
+    @returns: A dict with the signal levels, the dominant frequency and a
+              'confidence' between 0 and 1 that the audio is playing.
+    """
+    samples, rate = capture_audio(duration, wav_file=wav_file)
+    result = utils_ts_audio_analysis.get_playback_confidence(
+            samples, rate, expected_frequency)
+    logging.info('Audio playing with confidence %.2f (%.1f dBFS, %.1f Hz)',
+                 result['confidence'], result['rms_dbfs'],
+                 result['dominant_frequency'])
+    return result
+
+def monitor_audio_glitches(duration, node_type='POST_MIX_LOOPBACK',
+                           channels=2, rate=48000, block_size=4800,
+                           wav_file=None, max_events=1000, timeout=10,
+                           **kwargs):
+    """Streams captured audio through a GlitchDetector.
+    Audio is captured into a named pipe and analyzed while it is recorded,
+    so long playback runs can be checked for dropouts, clicks and level
+    changes in constant memory.
+    @param duration: Capture duration in seconds.
+    @param node_type: Input node type to pin the capture to.
+    @param channels: Number of channels to capture.
+    @param rate: Sampling rate in Hz.
+    @param block_size: Number of frames analyzed at once.
+    @param wav_file: A WAV file to analyze instead of capturing.
+    @param max_events: Number of most recent events kept in the result.
+    @param timeout: Seconds to wait for the capture beyond its duration.
+    @param kwargs: Passed to utils_ts_audio_analysis.GlitchDetector.
+    @returns: A dict with the analyzed seconds, the count of every event
+              kind and the most recent events.
+    @raises: error.TestError if no audio was captured.
+    """
+    samples = None
+    if wav_file:
+        samples, rate = utils_ts_audio_analysis.read_wav_file(wav_file)
+        channels = samples.shape[1]
+    # The detector windows are sized from the rate, which is only known
+    # here for WAV files.
+    detector = utils_ts_audio_analysis.GlitchDetector(rate, **kwargs)
+    ring = utils_ts_audio_analysis.PcmRingBuffer(block_size, channels)
+    events = collections.deque(maxlen=max_events)
+    counts = collections.Counter()
+
+    def analyze():
+        block = ring.read_block()
+        while block is not None:
+            for event in detector.process(block):
+                logging.info('Audio %s at %.3fs: %.3f', event.kind,
+                             event.time, event.value)
+                counts[event.kind] += 1
+                events.append(event)
+            block = ring.read_block()
+
+    if samples is not None:
+        for start in range(0, len(samples), block_size):
+            ring.write_samples(samples[start:start + block_size])
+            analyze()
+    else:
+        fifo_dir = tempfile.mkdtemp()
+        fifo = os.path.join(fifo_dir, 'capture.raw')
+        os.mkfifo(fifo)
+        command = cras_utils.capture_cmd(
+                fifo, duration=duration, channels=channels, rate=rate,
+                pin_device=get_device_id_from_node_type(node_type, True))
+        process = subprocess.Popen(command)
+        # Opening the pipe does not wait for the writer, so a capture client
+        # which dies before opening its end cannot block the test.
+        fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            read_size = block_size * ring.channels * 2
+            deadline = time.time() + duration + timeout
+            received = False
+            while time.time() < deadline:
+                if not select.select([fd], [], [], 0.5)[0]:
+                    if process.poll() is not None:
+                        break
+                    continue
+                try:
+                    data = os.read(fd, read_size)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    continue
+                if data:
+                    received = True
+                    ring.write(data)
+                    analyze()
+                elif received or process.poll() is not None:
+                    break
                 else:
-                                raise error.TestFail("Audio file is not being played")
+                    # No writer yet.
+                    time.sleep(0.05)
+            if not received:
+                raise error.TestError('No audio captured from %s' % node_type)
+        finally:
+            os.close(fd)
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+    for event in detector.flush():
+        counts[event.kind] += 1
+        events.append(event)
+    if ring.overflows:
+        logging.warning('Glitch analysis fell behind, %d frames dropped',
+                        ring.overflows)
+    return {'seconds': detector.elapsed,
+            'counts': dict(counts),
+            'events': list(events),
+            'overflows': ring.overflows}
+
+def _capture_probe(probe, rate, input_node_type, lead_time=0.2,
+                   max_latency=0.5, channels=2):
+    """Plays probe on the selected output while capturing the input.
+    @param probe: The signal to play, a numpy array of shape (frames,).
+    @param rate: Sampling rate in Hz.
+    @param input_node_type: Input node type to pin the capture to.
+    @param lead_time: Seconds the capture runs before the playback starts.
+    @param max_latency: Longest latency in seconds that can be measured.
+    @param channels: Number of channels played and captured.
+    @returns: A tuple (recorded, offset) where recorded is a float numpy
+              array of shape (frames, channels) and offset is the time in
+              seconds between the start of the capture and the playback.
+    """
+    work_dir = tempfile.mkdtemp()
+    playback_file = os.path.join(work_dir, 'probe.raw')
+    capture_file = os.path.join(work_dir, 'capture.raw')
+    samples = numpy.repeat(probe[:, numpy.newaxis], channels, axis=1)
+    with open(playback_file, 'wb') as f:
+        f.write((samples * 2 ** 15).astype('<i2').tobytes())
+    duration = lead_time + len(probe) / float(rate) + max_latency
+    try:
+        capture_start = time.time()
+        capture = subprocess.Popen(cras_utils.capture_cmd(
+                capture_file, duration=duration, channels=channels,
+                rate=rate,
+                pin_device=get_device_id_from_node_type(input_node_type,
+                                                        True)))
+        time.sleep(lead_time)
+        playback_start = time.time()
+        cras_utils.playback(playback_file=playback_file, channels=channels,
+                            rate=rate)
+        capture.wait()
+        recorded = utils_ts_audio_analysis.read_raw_file(capture_file,
+                                                         channels)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return recorded, playback_start - capture_start
+
+def measure_audio_latency(output_node_type,
+                          input_node_type='POST_MIX_LOOPBACK', trials=10,
+                          probe_type='chirp', rate=48000, min_quality=10.0,
+                          wav_files=None):
+    """Measures the latency from an output node to an input node.
+    A known probe is played on the output while the input is captured, and
+    the delay of the probe in the capture is found by FFT cross
+    correlation. The latency is counted from the start of the playback
+    client, so it includes the stream setup of Cras.
+    @param output_node_type: Output node type defined in CRAS_NODE_TYPES.
+    @param input_node_type: Input node type defined in CRAS_NODE_TYPES.
+    @param trials: Number of measurements.
+    @param probe_type: 'chirp' for a sine sweep or 'mls' for a maximum
+                       length sequence.
+    @param rate: Sampling rate in Hz.
+    @param min_quality: Lowest correlation quality of a valid trial.
+    @param wav_files: WAV files used instead of playing and capturing, each
+                      recorded from the start of the playback. They are
+                      used in turn for the trials.
+    @returns: A dict with the node types, the latencies in seconds of all
+              trials as a numpy array (NaN for failed trials), and the
+              percentiles from utils_ts.get_percentiles.
+    """
+    if probe_type == 'mls':
+        probe = utils_ts_audio_analysis.generate_mls()
+    else:
+        probe = utils_ts_audio_analysis.generate_chirp(rate=rate)
+    if not wav_files:
+        set_selected_node_types([output_node_type], [input_node_type])
+    latencies = numpy.full(trials, numpy.nan)
+    for trial in range(trials):
+        if wav_files:
+            recorded, rate = utils_ts_audio_analysis.read_wav_file(
+                    wav_files[trial % len(wav_files)])
+            offset = 0.0
+        else:
+            recorded, offset = _capture_probe(probe, rate, input_node_type)
+        delay, quality = utils_ts_audio_analysis.estimate_delay(
+                probe, recorded, rate)
+        if quality < min_quality:
+            logging.warning('Probe not found in trial %d (quality %.1f)',
+                            trial, quality)
+            continue
+        latencies[trial] = delay - offset
+        logging.info('Latency %s -> %s: %.2f ms', output_node_type,
+                     input_node_type, latencies[trial] * 1000)
+    result = utils_ts.get_percentiles(latencies)
+    result.update({'output_node_type': output_node_type,
+                   'input_node_type': input_node_type,
+                   'latencies': latencies})
+    return result
+
+def measure_audio_latency_pairs(node_type_pairs, trials=10, **kwargs):
+    """Measures latency distributions of several output/input pairs.
+    @param node_type_pairs: A list of (output_node_type, input_node_type).
+    @param trials: Number of measurements per pair.
+    @param kwargs: Passed to measure_audio_latency.
+    @returns: A dict from (output_node_type, input_node_type) to the result
+              of measure_audio_latency.
+    """
+    results = {}
+    for output_node_type, input_node_type in node_type_pairs:
+        results[(output_node_type, input_node_type)] = measure_audio_latency(
+                output_node_type, input_node_type, trials, **kwargs)
+    return results
+
+_AUDIO_DEV_RE = re.compile(r'^\s*((?:Input|Output) dev: .*?)\s*$')
+_UNDERRUN_RE = re.compile(
+        r'^\s*(underrun_count|severe_underrun_count):\s*(\d+)')
+
+def get_underrun_counts():
+    """Returns the underrun counters of the open Cras devices.
+    @returns: A dict of device, e.g. 'Output dev: HDA Intel PCH: ...', to a
+              dict with its 'underrun_count' and 'severe_underrun_count'
+              from cras_test_client --dump_audio_thread.
+    """
+    counts = {}
+    device = None
+    dump = utils.system_output('cras_test_client --dump_audio_thread',
+                               ignore_status=True)
+    for line in dump.splitlines():
+        match = _AUDIO_DEV_RE.match(line)
+        if match:
+            device = match.group(1)
+            counts[device] = {'underrun_count': 0,
+                              'severe_underrun_count': 0}
+            continue
+        match = _UNDERRUN_RE.match(line)
+        if match and device:
+            counts[device][match.group(1)] = int(match.group(2))
+    return counts
+
+def get_underrun_deltas(before, after):
+    """Sums the underruns between two get_underrun_counts results.
+    The counters of a device start at 0 when it opens, so a device opened
+    after before, like the device of a stream just started, counts all its
+    underruns, and so does a device whose counters went back, which was
+    closed and opened again. Devices closed before after, e.g. an output
+    unplugged during the run, are left out since their last counters are
+    unknown.
+    @returns: A dict with the 'underrun_count' and
+              'severe_underrun_count' deltas.
+    """
+    deltas = {'underrun_count': 0, 'severe_underrun_count': 0}
+    for device in set(before) - set(after):
+        logging.warning('%s was closed during the run', device)
+    for device, counts in after.items():
+        start = before.get(device, {})
+        for name in deltas:
+            previous = start.get(name, 0)
+            deltas[name] += (counts[name] - previous
+                             if counts[name] >= previous else counts[name])
+    return deltas
+
+def stress_multi_output_playback(node_type_sets, duration=30,
+                                 sample_interval=1.0, rate=48000,
+                                 channels=2):
+    """Plays on several active output nodes at once and samples Cras.
+    For every set of output node types, the nodes are made active together
+    and one playback stream is pinned to each of them for duration seconds.
+    Meanwhile the CPU use of the cras process and the underrun counters of
+    the open devices are sampled.
+    @param node_type_sets: A list of lists of output node types, e.g.
+                           [['INTERNAL_SPEAKER'],
+                            ['INTERNAL_SPEAKER', 'HDMI'],
+                            ['INTERNAL_SPEAKER', 'HDMI', 'USB']].
+    @param duration: Playback duration in seconds for every set.
+    @param sample_interval: Seconds between two CPU samples.
+    @param rate: Sampling rate in Hz.
+    @param channels: Number of channels of every stream.
+    @returns: A dict with 'runs', one dict per set with the node types,
+              the 'cpu_percent' samples as a numpy array and their
+              percentiles, and the underruns during the run; and
+              'cpu_percent_per_node', the slope of the mean CPU use over
+              the number of active nodes (None with less than two sets).
+    @raises: error.TestError if cras is not running.
+    """
+    pids = utils_ts.find_pids('cras')
+    if not pids:
+        raise error.TestError('cras is not running')
+    ticks_per_second = float(os.sysconf('SC_CLK_TCK'))
+    work_dir = tempfile.mkdtemp()
+    tone_file = os.path.join(work_dir, 'tone.raw')
+    # A quiet tone, mixing costs the same whatever the level. One second
+    # holds whole periods of 440 Hz and is written over and over, so long
+    # runs do not build the whole tone in memory.
+    times = numpy.arange(rate) / float(rate)
+    tone = 0.05 * numpy.sin(2 * numpy.pi * 440 * times)
+    second = (numpy.repeat(tone[:, numpy.newaxis], channels, axis=1) *
+              2 ** 15).astype('<i2').tobytes()
+    frame_size = 2 * channels
+    remaining = int(duration * rate) * frame_size
+    with open(tone_file, 'wb') as f:
+        while remaining > 0:
+            f.write(second[:remaining])
+            remaining -= len(second)
+    runs = []
+    try:
+        for node_types in node_type_sets:
+            set_selected_output_nodes(node_types)
+            streams = [subprocess.Popen(cras_utils.playback_cmd(
+                    tone_file, duration=duration, channels=channels,
+                    rate=rate,
+                    pin_device=get_device_id_from_node_type(node_type,
+                                                            False)))
+                       for node_type in node_types]
+            cpu_percent = []
+            try:
+                # The counters belong to the open devices, so they are read
+                # while the streams keep the devices open. The devices the
+                # streams have not opened yet count from 0.
+                before = after = get_underrun_counts()
+                last_time = time.time()
+                last_ticks = utils_ts.get_process_cpu_ticks(pids[0])
+                while any(stream.poll() is None for stream in streams):
+                    time.sleep(sample_interval)
+                    now = time.time()
+                    ticks = utils_ts.get_process_cpu_ticks(pids[0])
+                    cpu_percent.append(100 * (ticks - last_ticks) /
+                                       ticks_per_second / (now - last_time))
+                    last_time, last_ticks = now, ticks
+                    if any(stream.poll() is None for stream in streams):
+                        after = get_underrun_counts()
+            finally:
+                for stream in streams:
+                    if stream.poll() is None:
+                        stream.kill()
+            underruns = get_underrun_deltas(before, after)
+            run = utils_ts.get_percentiles(cpu_percent)
+            run.update({
+                    'node_types': list(node_types),
+                    'cpu_percent': numpy.array(cpu_percent),
+                    'underruns': underruns['underrun_count'],
+                    'severe_underruns': underruns['severe_underrun_count']})
+            logging.info('%d active outputs %s: cras CPU mean %s%%, '
+                         '%d underruns', len(node_types), node_types,
+                         run['mean'], run['underruns'])
+            runs.append(run)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    slope = None
+    points = [(len(run['node_types']), run['mean']) for run in runs
+              if run['mean'] is not None]
+    if len(set(count for count, _ in points)) > 1:
+        slope = float(numpy.polyfit([count for count, _ in points],
+                                    [mean for _, mean in points], 1)[0])
+    return {'runs': runs, 'cpu_percent_per_node': slope}
+
+def check_audio_playing(ui=None, expected_frequency=None,
+                        min_confidence=0.5, wav_file=None):
+    """Verifies that audio is being played.
+    @param ui: Not used. The check is based on the played signal, the
+               parameter is kept for the existing callers.
+    @param expected_frequency: Expected tone in Hz. None to only check
+                               that something is playing.
+    @param min_confidence: Lowest confidence accepted as playing.
+    @param wav_file: A WAV file to analyze instead of capturing.
+    @returns: The result of verify_audio_playing.
+    @raises: error.TestFail if the confidence is below min_confidence.
+    """
+    result = verify_audio_playing(expected_frequency, wav_file=wav_file)
+    if result['confidence'] < min_confidence:
+        raise error.TestFail('Audio file is not being played: %s' % result)
+    logging.info("audio file is being played")
+    return result
 
 def close_default_audio_player():
     """To close the default audio player"""
@@ -508,7 +1132,7 @@ def switching_from_speaker_to_other_peripheral(peripheral):
         '''To set Jack as output node'''       
         set_selected_output_nodes('HEADPHONE')
         time.sleep(10)
-         '''Returns the device type of the active output node'''
+        '''Returns the device type of the active output node'''
         current_node = get_selected_output_device_type()      
         if current_node != 'HEADPHONE':
             raise error.TestFail("Device Switch not happened from Speaker to JACK")
@@ -702,21 +1326,167 @@ def switching_from_USB_to_other_peripheral(peripheral):
 def connect_bluetooth_headset(ui,name_bt_headset):
     utils_ts.click_UI(ui,([["/Status tray, /i",True,"button"],["Show Bluetooth settings. Bluetooth is on",False,"button"],[name_bt_headset,False,"button"]]))
 
-def audio_playback_browser(tab, test_file):
+# Installed once into the media test page. It buffers the events of the
+# page's player element, with timestamps, until the harness drains them.
+_MEDIA_MONITOR_JS = """
+(function(player) {
+  if (window.__tsMediaMonitor) {
+    return;
+  }
+  var monitor = {events: [], maxEvents: %(max_events)d};
+  monitor.record = function(type) {
+    if (monitor.events.length >= monitor.maxEvents) {
+      monitor.events.shift();
+    }
+    monitor.events.push({type: type, time: performance.now(),
+                         currentTime: player.currentTime});
+  };
+  monitor.drain = function() {
+    return monitor.events.splice(0, monitor.events.length);
+  };
+  ['play', 'playing', 'waiting', 'stalled', 'timeupdate', 'pause', 'ended',
+   'error'].forEach(function(type) {
+    player.addEventListener(type, function() { monitor.record(type); });
+  });
+  window.__tsMediaMonitor = monitor;
+})(%(player)s);
+"""
+
+class MediaMonitor(object):
+    """Event driven progress monitor of a media element in a tab.
+
+    A small listener is injected into the page once. It buffers the
+    timeupdate, playing, waiting and stalled events of the player with
+    timestamps, and the harness collects them with one evaluation per
+    interval instead of polling player.currentTime. Only the most recent
+    events are kept, the playback metrics are updated as events arrive.
+    """
+
+    def __init__(self, tab, player='player', max_events=10000,
+                 history=10000):
+        """Initializes the monitor.
+        @param tab: The tab playing the media.
+        @param player: JavaScript expression of the media element.
+        @param max_events: Size of the event buffer in the page.
+        @param history: Number of most recent events kept in events.
+        """
+        self._tab = tab
+        self._player = player
+        self._max_events = max_events
+        self.events = collections.deque(maxlen=history)
+        self.event_count = 0
+        self._first_times = {}
+        self._stalled_since = None
+        self._stall_count = 0
+        self._resume_latencies = []
+
+    def install(self):
+        """Injects the listener into the page. Does nothing if present."""
+        self._tab.ExecuteJavaScript(_MEDIA_MONITOR_JS % {
+                'player': self._player, 'max_events': self._max_events})
+
+    def mark(self, name):
+        """Records a named marker, e.g. before starting the playback.
+        @param name: Name of the marker event.
+        """
+        self._tab.ExecuteJavaScript(
+                'window.__tsMediaMonitor.record(%s)' % json.dumps(name))
+
+    def drain(self):
+        """Collects the buffered events of the page.
+        @returns: The list of new events. Each event is a dict with 'type',
+                  'time' in ms from the page's performance clock and the
+                  'currentTime' of the player.
+        """
+        new_events = self._tab.EvaluateJavaScript(
+                'window.__tsMediaMonitor.drain()') or []
+        for event in new_events:
+            self._add_event(event)
+        return new_events
+
+    def _add_event(self, event):
+        self.events.append(event)
+        self.event_count += 1
+        self._first_times.setdefault(event['type'], event['time'])
+        if event['type'] == 'playing':
+            if self._stalled_since is not None:
+                self._resume_latencies.append(
+                        event['time'] - self._stalled_since)
+                self._stalled_since = None
+        elif (event['type'] in ('waiting', 'stalled') and
+              'playing' in self._first_times and
+              self._stalled_since is None):
+            self._stall_count += 1
+            self._stalled_since = event['time']
+
+    def wait_for_event(self, types, timeout=30, interval=0.5):
+        """Waits until an event of one of the given types is buffered.
+        @param types: A list of event types.
+        @param timeout: Seconds to wait.
+        @param interval: Seconds between two drains of the page buffer.
+        @returns: The first matching event.
+        @raises: error.TestError if no such event arrives within timeout.
+        """
+        found = []
+
+        def has_event():
+            found.extend(event for event in self.drain()
+                         if event['type'] in types)
+            return bool(found)
+
+        utils.poll_for_condition(
+                condition=has_event,
+                exception=error.TestError('No %s event until timeout.' %
+                                          '/'.join(types)),
+                timeout=timeout, sleep_interval=interval)
+        return found[0]
+
+    def get_stats(self, start_marker='play_requested'):
+        """Computes playback metrics from the collected events.
+        @param start_marker: Name of the marker recorded before playing.
+        @returns: A dict with 'time_to_first_play' (ms from the marker to
+                  the first playing event), 'stall_count', 'resume_latencies'
+                  (ms from every stall to the next playing event),
+                  'position' (last currentTime) and 'event_count'. They
+                  cover all collected events, also those no longer kept.
+        """
+        start = self._first_times.get(start_marker)
+        first_play = self._first_times.get('playing')
+        time_to_first_play = None
+        if start is not None and first_play is not None:
+            time_to_first_play = first_play - start
+        return {'time_to_first_play': time_to_first_play,
+                'stall_count': self._stall_count,
+                'resume_latencies': list(self._resume_latencies),
+                'position': (self.events[-1]['currentTime']
+                             if self.events else None),
+                'event_count': self.event_count}
+
+def audio_playback_browser(tab, test_file, timeout=30):
     """Plays a media file in Chromium.
+    @param tab: The tab of the media test page, which defines play() and
+                the player element.
     @param test_file: Media file to test.
-    @param vlaue: Index of the loop
+    @param timeout: Seconds to wait for the playback to start.
+    @returns: The MediaMonitor of the playback, which keeps collecting the
+              player events for get_stats.
+    @raises: error.TestError if the player does not start until timeout.
     """
+    monitor = MediaMonitor(tab)
+    monitor.install()
+    monitor.mark('play_requested')
     tab.EvaluateJavaScript('play("%s")' % test_file)
-    def get_current_time():
-        return tab.EvaluateJavaScript('player.currentTime')
     '''Make sure the audio is being played'''
-    old_time = get_current_time()
-    utils.poll_for_condition(condition=lambda: get_current_time() > old_time,exception=error.TestError('Player never start until timeout.'))
-    tab.EvaluateJavaScript('player.currentTime = %d' % get_current_time())
+    try:
+        monitor.wait_for_event(['playing'], timeout)
+    except error.TestError:
+        raise error.TestError('Player never start until timeout.')
+    logging.info('Playback started after %s ms',
+                 monitor.get_stats()['time_to_first_play'])
+    return monitor
 
-def browser_player_pause_resume():
-     """ To pause and resume the audio playback in default audio player
+def browser_player_pause_resume(ui):
+    """ To pause and resume the audio playback in the browser player
     @ ui : To click on the Pause/Resume ui elemnts"""
     utils_ts.click_UI(ui,([["Pause",False,"button"]]))
     time.sleep(WAIT)
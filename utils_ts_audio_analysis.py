@@ -0,0 +1,593 @@
+# Lint as: python2, python3
+"""
+Signal analysis helpers for audio tests.
+
+These functions only work on sample arrays, so they can run on captured
+PCM from the DUT as well as on WAV files used as offline stand-ins.
+"""
+# pylint: disable=missing-docstring
+import collections
+import logging
+import time
+import wave
+
+import numpy
+
+# Sample formats produced by cras_test_client and their numpy types.
+_SAMPLE_FORMATS = {
+    'S16_LE': ('<i2', 2 ** 15),
+    'S32_LE': ('<i4', 2 ** 31),
+}
+_WAV_SAMPLE_WIDTHS = {
+    2: ('<i2', 2 ** 15),
+    4: ('<i4', 2 ** 31),
+}
+# RMS levels in dBFS used to turn the level into a confidence score.
+SILENCE_DBFS = -60.0
+FULL_CONFIDENCE_DBFS = -40.0
+# Smallest value used instead of zero before taking a logarithm.
+_EPSILON = 1e-12
+
+
+def read_wav_file(wav_file):
+    """Reads a PCM WAV file into normalized samples.
+    @param wav_file: Path of the WAV file.
+    @returns: A tuple (samples, rate) where samples is a float numpy array
+              of shape (frames, channels) in the range [-1, 1).
+    @raises: ValueError if the sample width is not supported.
+    """
+    reader = wave.open(wav_file, 'rb')
+    try:
+        width = reader.getsampwidth()
+        channels = reader.getnchannels()
+        rate = reader.getframerate()
+        data = reader.readframes(reader.getnframes())
+    finally:
+        reader.close()
+    if width not in _WAV_SAMPLE_WIDTHS:
+        raise ValueError('Unsupported WAV sample width %d' % width)
+    dtype, scale = _WAV_SAMPLE_WIDTHS[width]
+    samples = numpy.frombuffer(data, dtype=dtype).reshape(-1, channels)
+    return samples.astype(numpy.float64) / scale, rate
+
+
+def write_wav_file(wav_file, samples, rate):
+    """Writes normalized samples to a 16 bit PCM WAV file.
+    @param wav_file: Path of the WAV file.
+    @param samples: A numpy array of shape (frames,) or (frames, channels)
+                    in the range [-1, 1).
+    @param rate: Sampling rate in Hz.
+    """
+    samples = numpy.atleast_2d(numpy.asarray(samples).T).T
+    data = numpy.clip(samples * 2 ** 15, -2 ** 15, 2 ** 15 - 1)
+    writer = wave.open(wav_file, 'wb')
+    try:
+        writer.setnchannels(samples.shape[1])
+        writer.setsampwidth(2)
+        writer.setframerate(rate)
+        writer.writeframes(data.astype('<i2').tobytes())
+    finally:
+        writer.close()
+
+
+def read_raw_file(raw_file, channels=2, sample_format='S16_LE'):
+    """Reads a raw interleaved PCM file captured by cras_test_client.
+    @param raw_file: Path of the raw file.
+    @param channels: Number of interleaved channels.
+    @param sample_format: A sample format in _SAMPLE_FORMATS.
+    @returns: A float numpy array of shape (frames, channels) in the range
+              [-1, 1).
+    """
+    with open(raw_file, 'rb') as f:
+        data = f.read()
+    return pcm_to_samples(data, channels, sample_format)
+
+
+def pcm_to_samples(data, channels=2, sample_format='S16_LE'):
+    """Converts interleaved PCM bytes into normalized samples.
+    Trailing bytes which do not form a full frame are dropped.
+    @param data: PCM bytes.
+    @param channels: Number of interleaved channels.
+    @param sample_format: A sample format in _SAMPLE_FORMATS.
+    @returns: A float numpy array of shape (frames, channels).
+    """
+    dtype, scale = _SAMPLE_FORMATS[sample_format]
+    frame_size = numpy.dtype(dtype).itemsize * channels
+    usable = len(data) - len(data) % frame_size
+    samples = numpy.frombuffer(data[:usable], dtype=dtype)
+    return samples.reshape(-1, channels).astype(numpy.float64) / scale
+
+
+def get_rms(samples):
+    """Returns the RMS level of samples over all channels.
+    @param samples: A numpy array of normalized samples.
+    @returns: The RMS level as a float, 0 for empty input.
+    """
+    if not samples.size:
+        return 0.0
+    return float(numpy.sqrt(numpy.mean(numpy.square(samples))))
+
+
+def to_dbfs(level):
+    """Converts a linear level to dBFS.
+    @param level: Linear level where 1.0 is full scale.
+    @returns: The level in dBFS.
+    """
+    return 20 * numpy.log10(numpy.maximum(level, _EPSILON))
+
+
+def get_spectrum(samples, rate):
+    """Returns the magnitude spectrum of the channel average of samples.
+    A Hann window is applied to reduce leakage between bins.
+    @param samples: A numpy array of shape (frames, channels).
+    @param rate: Sampling rate in Hz.
+    @returns: A tuple (frequencies, magnitudes) of numpy arrays.
+    """
+    mono = numpy.mean(numpy.atleast_2d(samples.T).T, axis=1)
+    window = numpy.hanning(len(mono))
+    magnitudes = numpy.abs(numpy.fft.rfft(mono * window))
+    frequencies = numpy.fft.rfftfreq(len(mono), 1.0 / rate)
+    return frequencies, magnitudes
+
+
+def get_dominant_frequency(samples, rate):
+    """Returns the frequency with most energy in samples.
+    The peak bin is refined with parabolic interpolation, so the result is
+    accurate to a fraction of a bin even for short windows.
+    @param samples: A numpy array of shape (frames, channels).
+    @param rate: Sampling rate in Hz.
+    @returns: The dominant frequency in Hz, 0 if there is no signal.
+    """
+    if len(samples) < 3:
+        return 0.0
+    frequencies, magnitudes = get_spectrum(samples, rate)
+    # Skip the DC bin.
+    peak = int(numpy.argmax(magnitudes[1:])) + 1
+    if not magnitudes[peak]:
+        return 0.0
+    offset = 0.0
+    if peak + 1 < len(magnitudes):
+        left, center, right = numpy.log(
+                magnitudes[peak - 1:peak + 2] + _EPSILON)
+        denominator = left - 2 * center + right
+        if denominator:
+            offset = 0.5 * (left - right) / denominator
+    return float(frequencies[peak] + offset * frequencies[1])
+
+
+def get_band_energy_ratio(samples, rate, frequency, tolerance):
+    """Returns the share of the spectral energy around frequency.
+    @param samples: A numpy array of shape (frames, channels).
+    @param rate: Sampling rate in Hz.
+    @param frequency: Center frequency in Hz.
+    @param tolerance: Half width of the band in Hz.
+    @returns: A float between 0 and 1.
+    """
+    frequencies, magnitudes = get_spectrum(samples, rate)
+    energy = numpy.square(magnitudes)
+    total = numpy.sum(energy[1:])
+    if not total:
+        return 0.0
+    band = numpy.abs(frequencies - frequency) <= tolerance
+    band[0] = False
+    return float(numpy.sum(energy[band]) / total)
+
+
+def get_playback_confidence(samples, rate, expected_frequency=None,
+                            frequency_tolerance=None):
+    """Scores how likely samples contain the expected audio playback.
+    The level score grows linearly from SILENCE_DBFS to
+    FULL_CONFIDENCE_DBFS. When expected_frequency is given, the level score
+    is scaled by how much of the energy lies around that frequency, twice
+    the band share being treated as full confidence.
+    @param samples: A numpy array of shape (frames, channels).
+    @param rate: Sampling rate in Hz.
+    @param expected_frequency: Expected tone in Hz. None to only check
+                               that something is playing.
+    @param frequency_tolerance: Allowed deviation in Hz. Defaults to 2% of
+                                expected_frequency.
+    @returns: A dict with 'rms', 'rms_dbfs', 'dominant_frequency',
+              'band_energy_ratio' and 'confidence' between 0 and 1.
+    """
+    rms = get_rms(samples)
+    rms_dbfs = float(to_dbfs(rms))
+    level_score = numpy.clip((rms_dbfs - SILENCE_DBFS) /
+                             (FULL_CONFIDENCE_DBFS - SILENCE_DBFS), 0, 1)
+    result = {'rms': rms,
+              'rms_dbfs': rms_dbfs,
+              'dominant_frequency': get_dominant_frequency(samples, rate),
+              'band_energy_ratio': None}
+    confidence = float(level_score)
+    if expected_frequency:
+        if frequency_tolerance is None:
+            frequency_tolerance = max(expected_frequency * 0.02,
+                                      rate / float(max(len(samples), 1)))
+        ratio = get_band_energy_ratio(samples, rate, expected_frequency,
+                                      frequency_tolerance)
+        result['band_energy_ratio'] = ratio
+        confidence *= min(1.0, 2 * ratio)
+    result['confidence'] = confidence
+    logging.debug('Playback analysis: %s', result)
+    return result
+
+
+# An event found by GlitchDetector. time is in seconds from the start of the
+# stream, kind is one of the GLITCH_* constants and value gives the size of
+# the event: the duration in seconds of a dropout, the jump of a click and
+# the change in dB of a level change.
+AudioEvent = collections.namedtuple('AudioEvent', ['time', 'kind', 'value'])
+GLITCH_DROPOUT = 'dropout'
+GLITCH_CLICK = 'click'
+GLITCH_LEVEL_CHANGE = 'level_change'
+
+
+class PcmRingBuffer(object):
+    """Fixed size ring buffer turning PCM chunks into fixed size blocks.
+
+    Captured audio arrives in chunks of any size. The chunks are copied into
+    a preallocated array and handed out as blocks of block_size frames, so
+    the memory use does not depend on how long the capture runs.
+    """
+
+    def __init__(self, block_size, channels=2, capacity_blocks=8,
+                 sample_format='S16_LE'):
+        """Initializes the ring buffer.
+        @param block_size: Number of frames in a block.
+        @param channels: Number of interleaved channels.
+        @param capacity_blocks: Number of blocks the buffer can hold.
+        @param sample_format: A sample format in _SAMPLE_FORMATS.
+        """
+        self._dtype, self._scale = _SAMPLE_FORMATS[sample_format]
+        self.block_size = block_size
+        self.channels = channels
+        self._frame_size = numpy.dtype(self._dtype).itemsize * channels
+        self._buffer = numpy.zeros((block_size * capacity_blocks, channels),
+                                   dtype=numpy.float64)
+        self._read = 0
+        self._count = 0
+        self._partial = b''
+        self.overflows = 0
+
+    def __len__(self):
+        return self._count
+
+    def write(self, data):
+        """Appends PCM bytes to the buffer.
+        Oldest frames are overwritten when the buffer is full, and the
+        number of lost frames is added to overflows.
+        @param data: PCM bytes, a partial trailing frame is kept for the
+                     next call.
+        """
+        data = self._partial + data
+        usable = len(data) - len(data) % self._frame_size
+        self._partial = data[usable:]
+        frames = numpy.frombuffer(data[:usable], dtype=self._dtype)
+        self.write_samples(frames.reshape(-1, self.channels) / self._scale)
+
+    def write_samples(self, samples):
+        """Appends normalized samples to the buffer.
+        @param samples: A numpy array of shape (frames, channels).
+        """
+        capacity = len(self._buffer)
+        if len(samples) > capacity:
+            self.overflows += len(samples) - capacity
+            samples = samples[-capacity:]
+        lost = max(0, self._count + len(samples) - capacity)
+        if lost:
+            self.overflows += lost
+            self._read = (self._read + lost) % capacity
+            self._count -= lost
+        start = (self._read + self._count) % capacity
+        first = min(len(samples), capacity - start)
+        self._buffer[start:start + first] = samples[:first]
+        self._buffer[:len(samples) - first] = samples[first:]
+        self._count += len(samples)
+
+    def read_block(self):
+        """Removes the oldest block from the buffer.
+        @returns: A numpy array of shape (block_size, channels), or None if
+                  less than a block is buffered.
+        """
+        if self._count < self.block_size:
+            return None
+        indexes = (numpy.arange(self.block_size) + self._read) % len(
+                self._buffer)
+        block = self._buffer[indexes]
+        self._read = (self._read + self.block_size) % len(self._buffer)
+        self._count -= self.block_size
+        return block
+
+
+class GlitchDetector(object):
+    """Streaming detector of dropouts, clicks and level changes.
+
+    Blocks are analyzed one by one with vectorized operations, and only a
+    fixed number of past block levels and the last samples of the previous
+    block are kept, so the detector can run for hours in constant memory.
+    """
+
+    def __init__(self, rate=48000, window=0.005, dropout_dbfs=-70.0,
+                 min_dropout=0.01, click_factor=10.0, min_click=0.05,
+                 level_change_db=10.0, history_blocks=20):
+        """Initializes the detector.
+        @param rate: Sampling rate in Hz.
+        @param window: Length in seconds of the windows checked for silence.
+        @param dropout_dbfs: Window level under which audio is missing.
+        @param min_dropout: Shortest silence in seconds reported as dropout.
+        @param click_factor: A sample is a click when its second difference
+                             is this many times the block average.
+        @param min_click: Smallest second difference reported as click.
+        @param level_change_db: Change of the block level from the recent
+                                average which is reported.
+        @param history_blocks: Number of past block levels kept.
+        """
+        self.rate = rate
+        self._window = max(1, int(window * rate))
+        self._dropout_dbfs = dropout_dbfs
+        self._min_dropout = min_dropout
+        self._click_factor = click_factor
+        self._min_click = min_click
+        self._level_change_db = level_change_db
+        self._levels = numpy.full(history_blocks, numpy.nan)
+        self._level_index = 0
+        self._tail = None
+        self._frames = 0
+        self._dropout_start = None
+        self._played = False
+
+    @property
+    def elapsed(self):
+        """Seconds of audio analyzed so far."""
+        return self._frames / float(self.rate)
+
+    def process(self, block):
+        """Analyzes the next block of the stream.
+        @param block: A numpy array of shape (frames, channels) following
+                      the previously processed block.
+        @returns: A list of AudioEvent found in the block.
+        """
+        block = numpy.atleast_2d(block.T).T
+        events = []
+        events.extend(self._find_dropouts(block))
+        events.extend(self._find_clicks(block))
+        events.extend(self._find_level_change(block))
+        self._tail = block[-2:]
+        self._frames += len(block)
+        events.sort()
+        return events
+
+    def flush(self):
+        """Reports a dropout still running at the end of the stream.
+        @returns: A list of AudioEvent.
+        """
+        if self._dropout_start is None:
+            return []
+        duration = self.elapsed - self._dropout_start
+        start, self._dropout_start = self._dropout_start, None
+        if duration < self._min_dropout:
+            return []
+        return [AudioEvent(start, GLITCH_DROPOUT, duration)]
+
+    def _find_dropouts(self, block):
+        windows = len(block) // self._window
+        if not windows:
+            return []
+        framed = block[:windows * self._window].reshape(
+                windows, self._window, -1)
+        levels = to_dbfs(numpy.sqrt(numpy.mean(numpy.square(framed),
+                                               axis=(1, 2))))
+        silent = levels < self._dropout_dbfs
+        if not self._played:
+            # Silence before the first sound is not a dropout.
+            if silent.all():
+                return []
+            first = int(numpy.argmin(silent))
+            self._played = True
+            silent[:first] = False
+        events = []
+        was_silent = numpy.concatenate(
+                ([self._dropout_start is not None], silent))
+        changes = numpy.flatnonzero(was_silent[1:] != was_silent[:-1])
+        for index in changes:
+            event_time = float(self._frames + index * self._window) / self.rate
+            if silent[index]:
+                self._dropout_start = event_time
+            else:
+                duration = event_time - self._dropout_start
+                if duration >= self._min_dropout:
+                    events.append(AudioEvent(self._dropout_start,
+                                             GLITCH_DROPOUT, float(duration)))
+                self._dropout_start = None
+        return events
+
+    def _find_clicks(self, block):
+        if self._tail is not None:
+            signal = numpy.concatenate((self._tail, block))
+            offset = len(self._tail) - 2
+        else:
+            signal = block
+            offset = -2
+        if len(signal) < 3:
+            return []
+        jumps = numpy.max(numpy.abs(numpy.diff(signal, n=2, axis=0)), axis=1)
+        threshold = max(self._min_click,
+                        self._click_factor * float(numpy.mean(jumps)))
+        indexes = numpy.flatnonzero(jumps > threshold)
+        if not len(indexes):
+            return []
+        # A discontinuity shows up in neighbouring second differences, only
+        # report the first sample of every group.
+        indexes = indexes[numpy.concatenate(
+                ([True], numpy.diff(indexes) > self._window))]
+        times = (self._frames + indexes - offset) / float(self.rate)
+        return [AudioEvent(float(event_time), GLITCH_CLICK,
+                           float(jumps[index]))
+                for event_time, index in zip(times, indexes)]
+
+    def _find_level_change(self, block):
+        level = float(to_dbfs(get_rms(block)))
+        events = []
+        if level >= self._dropout_dbfs:
+            recent = self._levels[~numpy.isnan(self._levels)]
+            if len(recent):
+                change = level - float(numpy.mean(recent))
+                if abs(change) >= self._level_change_db:
+                    events.append(AudioEvent(self.elapsed,
+                                             GLITCH_LEVEL_CHANGE, change))
+                    # Start over so a lasting change is reported once.
+                    self._levels.fill(numpy.nan)
+            self._levels[self._level_index % len(self._levels)] = level
+            self._level_index += 1
+        return events
+
+
+def benchmark_glitch_detector(duration=60, rate=48000, channels=2,
+                              block_size=4800, read_size=1024):
+    """Measures how fast GlitchDetector analyzes a generated stream.
+    A tone with a dropout and a click every few seconds is fed through
+    PcmRingBuffer and GlitchDetector in reads of read_size frames, the same
+    way a capture is analyzed.
+    @param duration: Seconds of audio to analyze.
+    @param rate: Sampling rate in Hz.
+    @param channels: Number of channels.
+    @param block_size: Number of frames in a block.
+    @param read_size: Number of frames written to the ring buffer at once.
+    @returns: A dict with the processing time, the realtime factor (audio
+              seconds analyzed per second of processing) and the events.
+    """
+    # One second of a tone with a whole number of periods, so consecutive
+    # seconds join without a discontinuity.
+    tone = 0.3 * numpy.sin(2 * numpy.pi * 1000 * numpy.arange(rate) /
+                           float(rate))
+    second = (numpy.repeat(tone[:, numpy.newaxis], channels, axis=1) *
+              2 ** 15).astype('<i2')
+    dropout = second.copy()
+    dropout[rate // 2:rate // 2 + rate // 20] = 0
+    click = second.copy()
+    click[rate // 3] = 2 ** 15 - 1
+    seconds = [second.tobytes(), dropout.tobytes(), second.tobytes(),
+               click.tobytes()]
+    read_bytes = read_size * channels * 2
+    ring = PcmRingBuffer(block_size, channels)
+    detector = GlitchDetector(rate)
+    events = []
+    start = time.time()
+    for index in range(int(duration)):
+        data = seconds[index % len(seconds)]
+        for offset in range(0, len(data), read_bytes):
+            ring.write(data[offset:offset + read_bytes])
+            block = ring.read_block()
+            while block is not None:
+                events.extend(detector.process(block))
+                block = ring.read_block()
+    events.extend(detector.flush())
+    elapsed = time.time() - start
+    logging.info('Analyzed %.0fs of audio in %.3fs', detector.elapsed,
+                 elapsed)
+    return {'audio_seconds': detector.elapsed,
+            'processing_seconds': elapsed,
+            'realtime_factor': detector.elapsed / elapsed if elapsed else None,
+            'overflows': ring.overflows,
+            'events': events}
+
+
+def generate_chirp(duration=0.5, rate=48000, start_frequency=100.0,
+                   end_frequency=10000.0, amplitude=0.5):
+    """Generates a logarithmic sine sweep.
+    A sweep has a sharp autocorrelation peak, which makes it a good probe
+    for delay measurements.
+    @param duration: Length in seconds.
+    @param rate: Sampling rate in Hz.
+    @param start_frequency: Frequency at the start in Hz.
+    @param end_frequency: Frequency at the end in Hz.
+    @param amplitude: Peak amplitude, 1.0 being full scale.
+    @returns: A numpy array of shape (frames,).
+    """
+    times = numpy.arange(int(duration * rate)) / float(rate)
+    ratio = numpy.log(end_frequency / start_frequency)
+    phase = (2 * numpy.pi * start_frequency * duration / ratio *
+             (numpy.exp(times * ratio / duration) - 1))
+    chirp = amplitude * numpy.sin(phase)
+    # Fade in and out to avoid clicks at the edges.
+    fade = min(len(chirp) // 10, int(0.005 * rate))
+    if fade:
+        ramp = numpy.linspace(0, 1, fade)
+        chirp[:fade] *= ramp
+        chirp[-fade:] *= ramp[::-1]
+    return chirp
+
+
+def generate_mls(order=15, amplitude=0.5):
+    """Generates a maximum length sequence.
+    @param order: Order of the sequence, which has 2 ** order - 1 samples.
+    @param amplitude: Amplitude of the +/- levels.
+    @returns: A numpy array of shape (2 ** order - 1,).
+    """
+    # Taps of primitive polynomials, counted from 1.
+    taps = {10: (10, 7), 11: (11, 9), 12: (12, 11, 10, 4), 13: (13, 12, 11, 8),
+            14: (14, 13, 12, 2), 15: (15, 14), 16: (16, 15, 13, 4),
+            17: (17, 14), 18: (18, 11)}
+    if order not in taps:
+        raise ValueError('MLS order must be one of %s' % sorted(taps))
+    state = [1] * order
+    length = 2 ** order - 1
+    sequence = numpy.empty(length)
+    for index in range(length):
+        sequence[index] = state[-1]
+        feedback = 0
+        for tap in taps[order]:
+            feedback ^= state[tap - 1]
+        state = [feedback] + state[:-1]
+    return amplitude * (2 * sequence - 1)
+
+
+def estimate_delay(probe, recorded, rate):
+    """Finds the delay of probe within recorded by cross-correlation.
+    The correlation is computed with FFTs, so long recordings stay cheap.
+    @param probe: The played signal, a numpy array of shape (frames,).
+    @param recorded: The captured signal, shape (frames,) or
+                     (frames, channels). Channels are averaged.
+    @param rate: Sampling rate in Hz.
+    @returns: A tuple (delay, quality) where delay is in seconds and
+              quality is the ratio of the correlation peak to the RMS of
+              the correlation. A low quality means the probe was not found.
+    """
+    recorded = numpy.mean(numpy.atleast_2d(recorded.T).T, axis=1)
+    size = len(recorded) + len(probe) - 1
+    fft_size = 1 << int(numpy.ceil(numpy.log2(size)))
+    correlation = numpy.fft.irfft(
+            numpy.fft.rfft(recorded, fft_size) *
+            numpy.conj(numpy.fft.rfft(probe, fft_size)), fft_size)
+    # Only non negative lags are meaningful, the probe can not be captured
+    # before it is played.
+    correlation = numpy.abs(correlation[:len(recorded)])
+    lag = int(numpy.argmax(correlation))
+    rms = numpy.sqrt(numpy.mean(numpy.square(correlation)))
+    quality = float(correlation[lag] / rms) if rms else 0.0
+    return lag / float(rate), quality
+
+
+def write_delayed_probe_wav(wav_file, probe, rate, delay, length=None,
+                            noise_level=0.001, gain=0.5, channels=2):
+    """Writes a synthetic capture of probe arriving after delay.
+    This is an offline stand-in for the recording of a latency trial.
+    @param wav_file: Path of the WAV file to write.
+    @param probe: The played signal, a numpy array of shape (frames,).
+    @param rate: Sampling rate in Hz.
+    @param delay: Delay of the probe in seconds.
+    @param length: Length of the capture in seconds. Defaults to the delay
+                   plus the probe plus 100 ms.
+    @param noise_level: RMS of the added white noise.
+    @param gain: Gain applied to the probe.
+    @param channels: Number of channels written.
+    """
+    offset = int(round(delay * rate))
+    if length is None:
+        frames = offset + len(probe) + rate // 10
+    else:
+        frames = int(length * rate)
+    capture = numpy.random.normal(0, noise_level, frames)
+    end = min(frames, offset + len(probe))
+    capture[offset:end] += gain * probe[:end - offset]
+    write_wav_file(wav_file, numpy.repeat(capture[:, numpy.newaxis],
+                                          channels, axis=1), rate)
@@ -0,0 +1,568 @@
+# Lint as: python2, python3
+"""
+Screenshot comparison helpers.
+
+PNG files are decoded with the simplified API of libpng through ctypes, or
+with zlib and numpy where libpng is missing, reduced by area averaging and
+compared to a golden image with a perceptual hash and a per-region
+difference score. Areas that change on their own, like the clock in the
+status tray, are masked out.
+"""
+# pylint: disable=missing-docstring
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import time
+import zlib
+
+import numpy
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Channels of each PNG color type with a bit depth of 8.
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# Width in pixels of the images compared.
+COMPARE_WIDTH = 480
+# Masks are (left, top, right, bottom) rectangles in fractions of the image.
+# The status tray with the clock in the bottom right corner of the shelf.
+STATUS_TRAY_MASK = (0.75, 0.94, 1.0, 1.0)
+DEFAULT_MASKS = (STATUS_TRAY_MASK,)
+# Hamming distance of the perceptual hashes above which the images are
+# different without comparing the regions.
+HASH_THRESHOLD = 10
+# Mean absolute difference of a region, in [0, 1], above which it changed.
+REGION_THRESHOLD = 0.02
+# Gray level weights of ITU-R BT.601.
+_GRAY_WEIGHTS = numpy.array([0.299, 0.587, 0.114], dtype=numpy.float32)
+# libpng converts the colors of images with these chunks, which are then
+# decoded with numpy to keep the stored bytes.
+_COLOR_CHUNKS = frozenset([b'tRNS', b'gAMA', b'cHRM', b'iCCP'])
+# PNG_FORMAT_GRAY, _GA, _RGB and _RGBA of png.h by number of channels.
+_LIBPNG_FORMATS = {1: 0, 2: 1, 3: 2, 4: 3}
+_PNG_IMAGE_VERSION = 1
+# The libpng library, loaded at the first decode, False if it is missing.
+_LIBPNG = None
+
+
+class _PngImage(ctypes.Structure):
+    """png_image of png.h."""
+    _fields_ = [('opaque', ctypes.c_void_p),
+                ('version', ctypes.c_uint32),
+                ('width', ctypes.c_uint32),
+                ('height', ctypes.c_uint32),
+                ('format', ctypes.c_uint32),
+                ('flags', ctypes.c_uint32),
+                ('colormap_entries', ctypes.c_uint32),
+                ('warning_or_error', ctypes.c_uint32),
+                ('message', ctypes.c_char * 64)]
+
+
+def _get_libpng():
+    """Returns libpng 1.6, None if it is not installed."""
+    global _LIBPNG
+    if _LIBPNG is None:
+        try:
+            lib = ctypes.CDLL(ctypes.util.find_library('png16') or
+                              'libpng16.so.16')
+            begin = lib.png_image_begin_read_from_memory
+            finish = lib.png_image_finish_read
+        except (OSError, AttributeError):
+            logging.info('libpng not found, PNG files are decoded with numpy')
+            _LIBPNG = False
+            return None
+        begin.argtypes = [ctypes.POINTER(_PngImage), ctypes.c_char_p,
+                          ctypes.c_size_t]
+        finish.argtypes = [ctypes.POINTER(_PngImage), ctypes.c_void_p,
+                           ctypes.c_void_p, ctypes.c_int32, ctypes.c_void_p]
+        lib.png_image_free.argtypes = [ctypes.POINTER(_PngImage)]
+        lib.png_image_free.restype = None
+        _LIBPNG = lib
+    return _LIBPNG or None
+
+
+def _decode_libpng(lib, data, height, width, channels):
+    """Decodes a PNG file in memory with libpng.
+    @param lib: The libpng library.
+    @param data: Content of the PNG file.
+    @param channels: Channels of the output, 3 for palette images.
+    @returns: A uint8 array of shape (height, width, channels).
+    @raises: ValueError if libpng fails to decode the file.
+    """
+    image = _PngImage(version=_PNG_IMAGE_VERSION)
+    pixels = numpy.empty((height, width, channels), dtype=numpy.uint8)
+    try:
+        if (not lib.png_image_begin_read_from_memory(ctypes.byref(image), data,
+                                                     len(data)) or
+                image.width != width or image.height != height):
+            raise ValueError('libpng: %s' % image.message.decode('ascii',
+                                                                 'replace'))
+        image.format = _LIBPNG_FORMATS[channels]
+        if not lib.png_image_finish_read(ctypes.byref(image), None,
+                                         pixels.ctypes.data, width * channels,
+                                         None):
+            raise ValueError('libpng: %s' % image.message.decode('ascii',
+                                                                 'replace'))
+    finally:
+        lib.png_image_free(ctypes.byref(image))
+    return pixels
+
+
+def _paeth(a, b, c):
+    """Paeth predictor of int16 arrays of the left, up and up left bytes."""
+    da = a - c
+    db = b - c
+    pa = numpy.abs(db)
+    pb = numpy.abs(da)
+    pc = numpy.abs(da + db)
+    return numpy.where((pa <= pb) & (pa <= pc), a, numpy.where(pb <= pc, b, c))
+
+
+def _diagonals(skewed, count, width, offset=0):
+    """Returns a view of the rows of an array laid out by diagonals.
+    @param skewed: Array of shape (width + count - 1 + offset, count +
+                   offset, bpp) holding pixel p of row i at [i + p + offset,
+                   i + offset].
+    @returns: A view of shape (count, width, bpp).
+    """
+    columns, bpp = skewed.shape[1:]
+    return numpy.lib.stride_tricks.as_strided(
+            skewed[offset:, offset:], shape=(count, width, bpp),
+            strides=((columns + 1) * bpp, columns * bpp, 1))
+
+
+def _skew(rows, bpp):
+    """Lays out rows so that pixel p of row i is at [i + p, i]."""
+    count, stride = rows.shape
+    width = stride // bpp
+    skewed = numpy.zeros((width + count - 1, count, bpp), dtype=numpy.uint8)
+    _diagonals(skewed, count, width)[:] = rows.reshape(count, width, bpp)
+    return skewed
+
+
+def _unfilter_serial(out, raw, filters, serial, bpp):
+    """Reverts the Average and Paeth rows.
+    A byte of these rows depends on the decoded bytes on its left, above
+    and above left, so all the pixels of an anti-diagonal (row + column)
+    are independent and are decoded at once, one numpy step per diagonal.
+    The None and Sub rows must be decoded already. Up rows between two
+    serial rows only add their raw bytes to the prior row, they are summed
+    beforehand and left out of the diagonals.
+    @param out: The uint8 output array of shape (height, stride).
+    @param raw: The filtered rows.
+    @param filters: The filter type of every row.
+    @param serial: Indices of the Average and Paeth rows, in order.
+    @param bpp: Bytes per pixel.
+    """
+    count = len(serial)
+    stride = out.shape[1]
+    width = stride // bpp
+    # The prior row of a serial row is a base row, plus the previous serial
+    # row for chained rows.
+    bases = numpy.zeros((count, stride), dtype=numpy.uint8)
+    chained = numpy.zeros((count, 1), dtype=numpy.uint8)
+    for i, y in enumerate(serial):
+        above = y - 1
+        while above >= 0 and filters[above] == 2:
+            above -= 1
+        if above + 1 < y:
+            bases[i] = raw[above + 1:y].sum(axis=0, dtype=numpy.uint8)
+        if above >= 0 and filters[above] <= 1:
+            bases[i] += out[above]
+        elif above >= 0:
+            chained[i] = 1
+    skewed_raw = _skew(raw[serial], bpp)
+    skewed_bases = _skew(bases, bpp) if bases.any() else None
+    zero = numpy.zeros((count, bpp), dtype=numpy.uint8)
+    # decoded[d + 1, i + 1] is pixel d - i of serial row i, row and column
+    # 0 are the zero bytes before the first row and the first pixel.
+    decoded = numpy.zeros((width + count, count + 1, bpp), dtype=numpy.uint8)
+    average = filters[serial] == 3
+    mixed = average.any() and not average.all()
+    # Row 0 of decoded is zero, so the first row needs no mask.
+    masked = not chained[1:].all()
+    for d in range(width + count - 1):
+        y0 = max(0, d - width + 1)
+        y1 = min(count, d + 1)
+        up = decoded[d, y0:y1]
+        up_left = decoded[d - 1, y0:y1] if d else zero[y0:y1]
+        if masked:
+            up = up * chained[y0:y1]
+            up_left = up_left * chained[y0:y1]
+        if skewed_bases is not None:
+            up = up + skewed_bases[d, y0:y1]
+            if d:
+                up_left = up_left + skewed_bases[d - 1, y0:y1]
+        a = decoded[d, y0 + 1:y1 + 1].astype(numpy.int16)
+        b = up.astype(numpy.int16)
+        if mixed:
+            predictor = numpy.where(average[y0:y1, numpy.newaxis],
+                                    (a + b) >> 1,
+                                    _paeth(a, b, up_left.astype(numpy.int16)))
+        elif average[0]:
+            predictor = (a + b) >> 1
+        else:
+            predictor = _paeth(a, b, up_left.astype(numpy.int16))
+        decoded[d + 1, y0 + 1:y1 + 1] = (skewed_raw[d, y0:y1] +
+                                         predictor) & 0xff
+    out[serial] = _diagonals(decoded, count, width, 1).reshape(count, stride)
+
+
+def _unfilter(data, height, stride, bpp):
+    """Reverts the PNG scanline filters without libpng.
+    None and Sub rows are reverted first, all at once, then the Average and
+    Paeth rows by diagonals in _unfilter_serial, and last the Up rows, each
+    added to the row above in one numpy call.
+    @returns: A uint8 array of shape (height, stride).
+    """
+    rows = numpy.frombuffer(data, dtype=numpy.uint8,
+                            count=height * (stride + 1))
+    rows = rows.reshape(height, stride + 1)
+    filters = rows[:, 0]
+    raw = rows[:, 1:]
+    if (filters > 4).any():
+        raise ValueError('Unknown PNG filter type')
+    out = numpy.empty((height, stride), dtype=numpy.uint8)
+    independent = filters <= 1
+    out[independent] = raw[independent]
+    sub = numpy.flatnonzero(filters == 1)
+    if len(sub):
+        out[sub] = numpy.cumsum(raw[sub].reshape(len(sub), -1, bpp), axis=1,
+                                dtype=numpy.uint8).reshape(len(sub), stride)
+    serial = numpy.flatnonzero(filters >= 3)
+    if len(serial):
+        _unfilter_serial(out, raw, filters, serial, bpp)
+    zero = numpy.zeros(stride, dtype=numpy.uint8)
+    for y in numpy.flatnonzero(filters == 2):
+        numpy.add(out[y - 1] if y else zero, raw[y], out=out[y])
+    return out
+
+
+def read_png(path):
+    """Decodes a non-interlaced 8 bit PNG file.
+    libpng reverts the scanline filters in C, much faster than numpy can for
+    the Average and Paeth filters used by most screenshots. Without libpng,
+    or if the image has color conversion chunks, the file is decoded with
+    zlib and numpy.
+    @param path: Path of the PNG file.
+    @returns: A uint8 numpy array of shape (height, width, channels), RGB
+              for palette images.
+    @raises: ValueError if the file is not a supported PNG image.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:8] != _PNG_SIGNATURE:
+        raise ValueError('%s is not a PNG image' % path)
+    offset = 8
+    header = None
+    palette = None
+    idat = []
+    kinds = set()
+    while offset < len(data):
+        length, kind = struct.unpack('>I4s', data[offset:offset + 8])
+        chunk = data[offset + 8:offset + 8 + length]
+        offset += 12 + length
+        kinds.add(kind)
+        if kind == b'IHDR':
+            header = struct.unpack('>IIBBBBB', chunk)
+        elif kind == b'PLTE':
+            palette = numpy.frombuffer(chunk, dtype=numpy.uint8).reshape(-1, 3)
+        elif kind == b'IDAT':
+            idat.append(chunk)
+        elif kind == b'IEND':
+            break
+    if header is None:
+        raise ValueError('%s has no IHDR' % path)
+    width, height, depth, color_type, _, _, interlace = header
+    if depth != 8 or interlace or color_type not in _PNG_CHANNELS:
+        raise ValueError('%s: unsupported PNG depth %d, color type %d, '
+                         'interlace %d' % (path, depth, color_type, interlace))
+    channels = _PNG_CHANNELS[color_type]
+    lib = _get_libpng()
+    if lib and not kinds & _COLOR_CHUNKS:
+        return _decode_libpng(lib, data, height, width,
+                              3 if color_type == 3 else channels)
+    pixels = _unfilter(zlib.decompress(b''.join(idat)), height,
+                       width * channels, channels)
+    image = pixels.reshape(height, width, channels)
+    if color_type == 3:
+        image = palette[image[:, :, 0]]
+    return image
+
+
+def _filter(pixels, bpp, filter_type):
+    """Applies PNG scanline filters.
+    @param pixels: uint8 array of shape (height, stride).
+    @param bpp: Bytes per pixel.
+    @param filter_type: Filter of every row, or None to pick for every row
+                        the filter with the smallest sum of absolute
+                        differences, as libpng does.
+    @returns: A uint8 array of shape (height, stride + 1) starting every
+              row with its filter type.
+    """
+    height, stride = pixels.shape
+    x = pixels.astype(numpy.int16)
+    a = numpy.zeros_like(x)
+    a[:, bpp:] = x[:, :-bpp]
+    b = numpy.zeros_like(x)
+    b[1:] = x[:-1]
+    c = numpy.zeros_like(x)
+    c[1:, bpp:] = x[:-1, :-bpp]
+    predictors = [0, a, b, (a + b) >> 1, _paeth(a, b, c)]
+    if filter_type is None:
+        costs = [numpy.abs((x - predictor + 128) % 256 - 128).sum(axis=1)
+                 for predictor in predictors]
+        filters = numpy.argmin(costs, axis=0)
+    else:
+        filters = numpy.full(height, filter_type)
+    rows = numpy.empty((height, stride + 1), dtype=numpy.uint8)
+    rows[:, 0] = filters
+    for kind, predictor in enumerate(predictors):
+        selected = filters == kind
+        if selected.any():
+            rows[selected, 1:] = (x[selected] - (predictor[selected] if kind
+                                                 else 0)) & 0xff
+    return rows
+
+
+def write_png(path, image, level=1, filter_type=0):
+    """Encodes an image as PNG.
+    @param path: Path of the PNG file.
+    @param image: uint8 array of shape (height, width) or (height, width,
+                  channels) with 1 to 4 channels.
+    @param level: zlib compression level.
+    @param filter_type: Scanline filter of every row, 0 (None) to 4 (Paeth),
+                        or None to pick it for every row, as in the
+                        screenshots written by libpng.
+    """
+    if image.ndim == 2:
+        image = image[:, :, numpy.newaxis]
+    height, width, channels = image.shape
+    color_type = dict((v, k) for k, v in _PNG_CHANNELS.items() if k != 3)
+    rows = _filter(image.reshape(height, -1), channels, filter_type)
+
+    def chunk(kind, payload):
+        return (struct.pack('>I', len(payload)) + kind + payload +
+                struct.pack('>I', zlib.crc32(kind + payload) & 0xffffffff))
+
+    with open(path, 'wb') as f:
+        f.write(_PNG_SIGNATURE)
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8,
+                                           color_type[channels], 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), level)))
+        f.write(chunk(b'IEND', b''))
+
+
+def downscale(image, factor):
+    """Reduces an image by averaging factor x factor pixel blocks.
+    The image is cropped to a multiple of factor.
+    @param image: uint8 array of shape (height, width, channels).
+    @param factor: Integer reduction factor, up to 16.
+    @returns: A float32 array of shape (height // factor, width // factor,
+              channels) in the range [0, 255].
+    """
+    if factor == 1:
+        return image.astype(numpy.float32)
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    image = image[:height * factor, :width * factor]
+    # Block sums of up to 16 x 16 bytes fit in uint16. Adding strided rows
+    # and columns is much faster than summing over reshaped axes.
+    rows = image[0::factor].astype(numpy.uint16)
+    for i in range(1, factor):
+        rows += image[i::factor]
+    blocks = rows.reshape(height, width, factor, -1)
+    total = blocks[:, :, 0].copy()
+    for i in range(1, factor):
+        total += blocks[:, :, i]
+    return total.astype(numpy.float32) / (factor * factor)
+
+
+def to_gray(image):
+    """Converts an RGB(A) or gray float image to gray levels."""
+    if image.shape[2] < 3:
+        return image[:, :, 0]
+    return image[:, :, :3].dot(_GRAY_WEIGHTS)
+
+
+def _resize_area(gray, height, width):
+    """Area averages a gray image to height x width."""
+    rows = numpy.linspace(0, gray.shape[0], height + 1).astype(int)
+    cols = numpy.linspace(0, gray.shape[1], width + 1).astype(int)
+    sums = numpy.add.reduceat(numpy.add.reduceat(gray, rows[:-1], axis=0),
+                              cols[:-1], axis=1)
+    return sums / numpy.outer(numpy.diff(rows), numpy.diff(cols))
+
+
+def perceptual_hash(gray, size=8):
+    """Difference hash of a gray image.
+    @param gray: 2D float array.
+    @param size: The hash has size x size bits.
+    @returns: A bool array of size * size bits, set where a cell is brighter
+              than its right neighbour.
+    """
+    cells = _resize_area(gray, size, size + 1)
+    return (cells[:, :-1] > cells[:, 1:]).ravel()
+
+
+def apply_masks(image, reference, masks):
+    """Copies the masked rectangles of reference into image.
+    @param image: Array of shape (height, width, ...), changed in place.
+    @param reference: Array of the same shape.
+    @param masks: (left, top, right, bottom) rectangles in fractions.
+    """
+    height, width = image.shape[:2]
+    for left, top, right, bottom in masks:
+        rows = slice(int(top * height), int(numpy.ceil(bottom * height)))
+        cols = slice(int(left * width), int(numpy.ceil(right * width)))
+        image[rows, cols] = reference[rows, cols]
+
+
+def get_region_diffs(image, golden, grid=(8, 8)):
+    """Mean absolute difference of each region of a grid.
+    @param image: Gray float array in [0, 255].
+    @param golden: Gray float array of the same shape.
+    @param grid: Tuple (rows, columns) of regions.
+    @returns: A float array of shape grid with differences in [0, 1].
+    """
+    return _resize_area(numpy.abs(image - golden), grid[0], grid[1]) / 255
+
+
+class GoldenImage(object):
+    """A golden screenshot reduced once for repeated comparisons."""
+
+    def __init__(self, image, masks=DEFAULT_MASKS, width=COMPARE_WIDTH):
+        """@param image: uint8 array of shape (height, width, channels).
+        @param masks: Rectangles ignored in the comparisons.
+        @param width: Width in pixels the images are compared at.
+        """
+        self.shape = image.shape
+        self.masks = masks
+        self.factor = max(1, min(16, image.shape[1] // width))
+        self.gray = to_gray(downscale(image, self.factor))
+        self.hash = perceptual_hash(self.gray)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        return cls(read_png(path), **kwargs)
+
+    def compare(self, image, hash_threshold=HASH_THRESHOLD,
+                region_threshold=REGION_THRESHOLD, grid=(8, 8)):
+        """Compares a screenshot to the golden image.
+        The perceptual hashes are compared first, and the regions only if
+        the hashes are close, so large changes are reported early while
+        small ones are still found by the regions.
+        @param image: uint8 array of the golden shape.
+        @param hash_threshold: Hamming distance above which the images differ.
+        @param region_threshold: Difference above which a region changed.
+        @param grid: Tuple (rows, columns) of regions.
+        @returns: A dict with 'match', the 'hash_distance', the
+                  'region_diffs' array (None if not compared), the
+                  'max_region_diff' and the 'changed_regions' as a list of
+                  (row, column).
+        @raises: ValueError if the image and golden shapes differ.
+        """
+        if image.shape != self.shape:
+            raise ValueError('Image is %s, golden is %s' %
+                             (image.shape, self.shape))
+        gray = to_gray(downscale(image, self.factor))
+        apply_masks(gray, self.gray, self.masks)
+        distance = int(numpy.count_nonzero(perceptual_hash(gray) != self.hash))
+        result = {'match': False, 'hash_distance': distance,
+                  'region_diffs': None, 'max_region_diff': None,
+                  'changed_regions': []}
+        if distance > hash_threshold:
+            return result
+        diffs = get_region_diffs(gray, self.gray, grid)
+        changed = numpy.argwhere(diffs > region_threshold)
+        result.update({'match': not len(changed), 'region_diffs': diffs,
+                       'max_region_diff': float(diffs.max()),
+                       'changed_regions': [tuple(int(i) for i in region)
+                                           for region in changed]})
+        return result
+
+
+def compare_png_files(path, golden_path, **kwargs):
+    """Compares two PNG files, see GoldenImage.compare for kwargs."""
+    return GoldenImage.from_file(golden_path).compare(read_png(path), **kwargs)
+
+
+def benchmark_compare(width=3840, height=2160, iterations=10, png_file=None,
+                      filter_type=None):
+    """Times the decoding and comparison of a synthetic screenshot.
+    The screenshot has a gradient wallpaper, flat windows and text like
+    noise, and is filtered row by row like the screenshots of libpng.
+    @param width: Screenshot width.
+    @param height: Screenshot height.
+    @param iterations: Number of runs.
+    @param png_file: Path the synthetic PNG is written to, a file in the
+                     current directory by default.
+    @param filter_type: Scanline filter, see write_png.
+    @returns: A dict with the mean 'decode_ms' and 'compare_ms', the
+              number of rows of every PNG filter type in 'filters' and the
+              'decoder', 'libpng' or 'numpy'.
+    """
+    rng = numpy.random.RandomState(0)
+    image = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+    image[:, :, 3] = 255
+    rows, columns = numpy.mgrid[0:height, 0:width]
+    image[:, :, 0] = columns * 255 // width
+    image[:, :, 1] = rows * 255 // height
+    image[:, :, 2] = (rows + columns) * 255 // (height + width)
+    for _ in range(50):
+        top, left = rng.randint(0, height), rng.randint(0, width)
+        image[top:top + height // 8, left:left + width // 8, :3] = (
+                rng.randint(0, 256, 3))
+    for _ in range(20):
+        top, left = rng.randint(0, height), rng.randint(0, width)
+        text = image[top:top + height // 40, left:left + width // 4, :3]
+        text[rng.random_sample(text.shape[:2]) < 0.3] = 0
+    png_file = png_file or 'benchmark_compare.png'
+    write_png(png_file, image, filter_type=filter_type)
+    with open(png_file, 'rb') as f:
+        data = f.read()
+    golden = GoldenImage(image)
+    decode = compare = 0.0
+    try:
+        for _ in range(iterations):
+            start = time.time()
+            decoded = read_png(png_file)
+            decode += time.time() - start
+            start = time.time()
+            result = golden.compare(decoded)
+            compare += time.time() - start
+    finally:
+        os.remove(png_file)
+    stats = {'decode_ms': decode * 1000 / iterations,
+             'compare_ms': compare * 1000 / iterations,
+             'match': result['match'],
+             'filters': _get_filter_counts(data, width * 4),
+             'decoder': 'libpng' if _get_libpng() else 'numpy'}
+    logging.info('%dx%d screenshot: decode %.1f ms with %s, compare %.1f ms',
+                 width, height, stats['decode_ms'], stats['decoder'],
+                 stats['compare_ms'])
+    return stats
+
+
+def _get_filter_counts(data, stride):
+    """Counts the rows of every filter type of a PNG file written by
+    write_png, whose pixel data is in one IDAT chunk."""
+    length = struct.unpack('>I', data[33:37])[0]
+    rows = numpy.frombuffer(zlib.decompress(data[41:41 + length]),
+                            dtype=numpy.uint8).reshape(-1, stride + 1)
+    return numpy.bincount(rows[:, 0], minlength=5).tolist()
+
+
+def find_first_changed_frame(frames, baseline, level=64, min_changed=0.25):
+    """Finds the first frame where a region changed from a baseline.
+    All the frames are compared at once.
+    @param frames: Gray float array of shape (frames, height, width).
+    @param baseline: Gray float array of shape (height, width).
+    @param level: Gray level difference of a changed pixel.
+    @param min_changed: Fraction of changed pixels of a changed frame.
+    @returns: A tuple (index, fractions) with the index of the first changed
+              frame, None if none changed, and the changed fraction of every
+              frame.
+    """
+    fractions = (numpy.abs(frames - baseline) > level).mean(axis=(1, 2))
+    changed = numpy.flatnonzero(fractions >= min_changed)
+    return (int(changed[0]) if len(changed) else None), fractions
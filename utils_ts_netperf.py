@@ -0,0 +1,515 @@
+# Lint as: python2, python3
+"""
+Network throughput and latency measurement.
+
+A small server and the matching client measure TCP goodput with parallel
+streams, TCP round trip times and UDP goodput, loss, jitter and round trip
+times. The server only needs the standard library, so this file can be
+copied to any peer and started with:
+
+    python utils_ts_netperf.py --server [--port 5201]
+
+and run on loopback to test the client offline.
+
+Each TCP connection sends a header line "<mode> <argument>\\n":
+  send            the client sends until it shuts down its side, then the
+                  server replies with the bytes received and the seconds
+                  between the first and the last byte.
+  recv <seconds>  the server sends for that long and closes.
+  echo            the server echoes everything back.
+UDP datagrams sent to the same port are echoed back truncated to their
+sequence number and send time header.
+"""
+# pylint: disable=missing-docstring
+import argparse
+import logging
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+DEFAULT_PORT = 5201
+# Size of the payload file and of the receive buffers.
+_PAYLOAD_SIZE = 256 * 1024
+# TCP send result: bytes received and seconds from the first to last byte.
+_SEND_RESULT = struct.Struct('!Qd')
+# UDP header: sequence number and send time of the client.
+_UDP_HEADER = struct.Struct('!Id')
+_MODES = ('send', 'recv', 'echo')
+
+
+class _Payload(object):
+    """Random data sent without copying it for every send.
+
+    The data is kept in a file for socket.sendfile and, where sendfile is not
+    available, in a buffer sent through a memoryview.
+    """
+
+    def __init__(self, size=_PAYLOAD_SIZE):
+        data = bytearray(os.urandom(size))
+        self.size = size
+        self.view = memoryview(data)
+        self.file = tempfile.TemporaryFile()
+        self.file.write(data)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def send(self, sock):
+        """Sends the payload once.
+        @param sock: Connected TCP socket.
+        @returns: The number of bytes sent.
+        """
+        if hasattr(sock, 'sendfile'):
+            return sock.sendfile(self.file, 0, self.size)
+        sock.sendall(self.view)
+        return self.size
+
+    def send_for(self, sock, duration):
+        """Sends the payload repeatedly for duration seconds.
+        @returns: The number of bytes sent.
+        """
+        deadline = time.time() + duration
+        sent = 0
+        while time.time() < deadline:
+            sent += self.send(sock)
+        return sent
+
+
+def _drain(sock, view):
+    """Receives until the peer closes.
+    @param sock: Connected TCP socket.
+    @param view: memoryview of the receive buffer.
+    @returns: A tuple (bytes, first, last) with the times of the first and
+              last received bytes, None if nothing was received.
+    """
+    received = 0
+    first = last = None
+    while True:
+        count = sock.recv_into(view)
+        if not count:
+            return received, first, last
+        last = time.time()
+        if first is None:
+            first = last
+        received += count
+
+
+def _read_line(sock, limit=64):
+    line = b''
+    while not line.endswith(b'\n') and len(line) < limit:
+        data = sock.recv(1)
+        if not data:
+            break
+        line += data
+    return line.decode('ascii', 'replace').strip()
+
+
+class _TCPHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        fields = _read_line(sock).split()
+        if not fields or fields[0] not in _MODES:
+            logging.warning('netperf: bad request %r', fields)
+            return
+        view = memoryview(bytearray(_PAYLOAD_SIZE))
+        if fields[0] == 'send':
+            received, first, last = _drain(sock, view)
+            sock.sendall(_SEND_RESULT.pack(
+                    received, (last - first) if first else 0.0))
+        elif fields[0] == 'recv':
+            try:
+                self.server.payload.send_for(sock, float(fields[1]))
+            except socket.error:
+                pass
+        else:
+            while True:
+                count = sock.recv_into(view)
+                if not count:
+                    break
+                sock.sendall(view[:count])
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class NetperfServer(object):
+    """TCP and UDP measurement server, see the module docstring."""
+
+    def __init__(self, host='', port=DEFAULT_PORT):
+        """Binds the server sockets.
+        @param host: Address to listen on, '' for all.
+        @param port: TCP and UDP port, 0 to pick a free one.
+        """
+        self._tcp = _ThreadingTCPServer((host, port), _TCPHandler)
+        self._tcp.payload = _Payload()
+        self.port = self._tcp.server_address[1]
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind((host, self.port))
+        self._threads = []
+        self._running = False
+
+    def _serve_udp(self):
+        buf = bytearray(65536)
+        view = memoryview(buf)
+        self._udp.settimeout(0.2)
+        while self._running:
+            try:
+                count, address = self._udp.recvfrom_into(buf)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            if count >= _UDP_HEADER.size:
+                self._udp.sendto(view[:_UDP_HEADER.size], address)
+
+    def start(self):
+        """Serves in background threads."""
+        self._running = True
+        for target in (self._tcp.serve_forever, self._serve_udp):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """Stops serving and closes the sockets."""
+        self._running = False
+        self._tcp.shutdown()
+        for thread in self._threads:
+            thread.join()
+        self._tcp.server_close()
+        self._tcp.payload.close()
+        self._udp.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def _connect(host, port, mode, timeout):
+    sock = socket.create_connection((host, port), timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(mode.encode('ascii') + b'\n')
+    return sock
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error('connection closed after %d bytes' % len(data))
+        data += chunk
+    return data
+
+
+def get_percentiles(values, percentiles=(50, 95, 99)):
+    """Summarizes a list of measurements with percentiles.
+    Also used through utils_ts, it is kept here since this module runs
+    without the autotest libraries.
+    @param values: A sequence or numpy array of numbers. NaN values, e.g. of
+                   failed iterations, are ignored.
+    @param percentiles: The percentiles to compute.
+    @returns: A dict with 'count', 'min', 'max', 'mean' and a 'p<N>' entry
+              for every percentile. All but count are None without values.
+    """
+    # numpy is only needed on the client side, the server runs with the
+    # standard library.
+    import numpy
+    values = numpy.asarray(values, dtype=numpy.float64)
+    values = values[~numpy.isnan(values)]
+    result = {'count': len(values)}
+    keys = ['min', 'max', 'mean'] + ['p%g' % p for p in percentiles]
+    if not len(values):
+        result.update(dict.fromkeys(keys))
+        return result
+    result['min'] = float(numpy.min(values))
+    result['max'] = float(numpy.max(values))
+    result['mean'] = float(numpy.mean(values))
+    for percentile, value in zip(percentiles,
+                                 numpy.percentile(values, percentiles)):
+        result['p%g' % percentile] = float(value)
+    return result
+
+
+def _run_streams(target, streams):
+    """Runs target(index, results) in parallel threads.
+    @returns: The list of results filled by the threads.
+    @raises: The first exception of a thread.
+    """
+    results = [None] * streams
+    errors = []
+
+    def run(index):
+        try:
+            results[index] = target(index)
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def run_tcp_throughput(host, port=DEFAULT_PORT, duration=10, streams=1,
+                       direction='upload', timeout=10):
+    """Measures TCP goodput with parallel streams.
+    @param host: Address of the NetperfServer.
+    @param port: Port of the NetperfServer.
+    @param duration: Seconds each stream transfers.
+    @param streams: Number of parallel connections.
+    @param direction: 'upload' to send to the server, 'download' to receive.
+    @param timeout: Socket timeout in seconds.
+    @returns: A dict with the total bytes, the elapsed seconds, the goodput
+              in Mbit/s and the per-stream goodputs.
+    @raises: ValueError on an unknown direction.
+    """
+    if direction not in ('upload', 'download'):
+        raise ValueError('Unknown direction %s' % direction)
+    payload = _Payload() if direction == 'upload' else None
+
+    def upload(_):
+        sock = _connect(host, port, 'send', timeout)
+        try:
+            start = time.time()
+            payload.send_for(sock, duration)
+            sock.shutdown(socket.SHUT_WR)
+            received, elapsed = _SEND_RESULT.unpack(
+                    _recv_exactly(sock, _SEND_RESULT.size))
+            return received, elapsed, start, time.time()
+        finally:
+            sock.close()
+
+    def download(_):
+        sock = _connect(host, port, 'recv %s' % duration, timeout + duration)
+        try:
+            start = time.time()
+            received, first, last = _drain(
+                    sock, memoryview(bytearray(_PAYLOAD_SIZE)))
+            return (received, (last - first) if first else 0.0, start,
+                    time.time())
+        finally:
+            sock.close()
+
+    try:
+        results = _run_streams(upload if payload else download, streams)
+    finally:
+        if payload:
+            payload.close()
+    total = sum(result[0] for result in results)
+    elapsed = (max(result[3] for result in results) -
+               min(result[2] for result in results))
+    return {
+        'protocol': 'tcp',
+        'direction': direction,
+        'streams': streams,
+        'bytes': total,
+        'elapsed': elapsed,
+        'goodput_mbps': total * 8 / elapsed / 1e6 if elapsed else 0.0,
+        'stream_goodput_mbps': [received * 8 / seconds / 1e6 if seconds else 0.0
+                                for received, seconds, _, _ in results],
+    }
+
+
+def run_tcp_rtt(host, port=DEFAULT_PORT, count=100, size=64, timeout=10):
+    """Measures TCP round trip times with small echoed messages.
+    @param host: Address of the NetperfServer.
+    @param port: Port of the NetperfServer.
+    @param count: Number of messages.
+    @param size: Bytes per message.
+    @param timeout: Socket timeout in seconds.
+    @returns: A dict with the RTT percentiles in milliseconds.
+    """
+    message = memoryview(bytearray(os.urandom(size)))
+    rtts = []
+    sock = _connect(host, port, 'echo', timeout)
+    try:
+        for _ in range(count):
+            start = time.time()
+            sock.sendall(message)
+            _recv_exactly(sock, size)
+            rtts.append((time.time() - start) * 1000)
+    finally:
+        sock.close()
+    return {'protocol': 'tcp', 'rtt_ms': get_percentiles(rtts)}
+
+
+def _get_jitter(rtts):
+    """Interarrival jitter of RFC 3550 over the round trip times.
+    @param rtts: Round trip times in sequence order, NaN for lost packets.
+    """
+    jitter = 0.0
+    previous = None
+    for rtt in rtts:
+        if rtt != rtt:
+            continue
+        if previous is not None:
+            jitter += (abs(rtt - previous) - jitter) / 16
+        previous = rtt
+    return jitter
+
+
+def run_udp_test(host, port=DEFAULT_PORT, duration=10, streams=1,
+                 rate_mbps=10.0, packet_size=1400, timeout=1.0):
+    """Sends paced UDP datagrams and times their echoes.
+    @param host: Address of the NetperfServer.
+    @param port: Port of the NetperfServer.
+    @param duration: Seconds each stream sends.
+    @param streams: Number of parallel sockets.
+    @param rate_mbps: Offered load of each stream in Mbit/s.
+    @param packet_size: Bytes per datagram.
+    @param timeout: Seconds to wait for the last echoes.
+    @returns: A dict with the goodput in Mbit/s of the echoed datagrams, the
+              loss ratio, the jitter and the RTT percentiles in milliseconds.
+    """
+    interval = packet_size * 8 / (rate_mbps * 1e6)
+    packet = bytearray(os.urandom(packet_size))
+    view = memoryview(packet)
+
+    def stream(_):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((host, port))
+        sock.settimeout(timeout)
+        sent_times = []
+        rtts = {}
+        done = threading.Event()
+
+        def receive():
+            buf = bytearray(_UDP_HEADER.size)
+            while True:
+                try:
+                    sock.recv_into(buf)
+                except socket.timeout:
+                    if done.is_set():
+                        return
+                    continue
+                except socket.error:
+                    return
+                seq, sent = _UDP_HEADER.unpack(bytes(buf))
+                rtts[seq] = (time.time() - sent) * 1000
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        try:
+            start = time.time()
+            while time.time() - start < duration:
+                now = time.time()
+                _UDP_HEADER.pack_into(packet, 0, len(sent_times), now)
+                sock.send(view)
+                sent_times.append(now)
+                delay = start + len(sent_times) * interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            elapsed = time.time() - start
+            done.set()
+            receiver.join()
+        finally:
+            done.set()
+            sock.close()
+        return len(sent_times), [rtts.get(seq, float('nan'))
+                                 for seq in range(len(sent_times))], elapsed
+
+    results = _run_streams(stream, streams)
+    sent = sum(result[0] for result in results)
+    rtts = [rtt for result in results for rtt in result[1]]
+    received = sum(1 for rtt in rtts if rtt == rtt)
+    elapsed = max(result[2] for result in results)
+    return {
+        'protocol': 'udp',
+        'streams': streams,
+        'sent': sent,
+        'received': received,
+        'loss': 1 - float(received) / sent if sent else 0.0,
+        'goodput_mbps': received * packet_size * 8 / elapsed / 1e6,
+        'jitter_ms': max(_get_jitter(result[1]) for result in results),
+        'rtt_ms': get_percentiles(rtts),
+    }
+
+
+def run_netperf(host, port=DEFAULT_PORT, duration=10, streams=4,
+                udp_rate_mbps=10.0, rtt_count=100, record=None):
+    """Runs the TCP upload, download, RTT and UDP measurements.
+    @param host: Address of the NetperfServer.
+    @param port: Port of the NetperfServer.
+    @param duration: Seconds of each transfer.
+    @param streams: Number of parallel streams of the transfers.
+    @param udp_rate_mbps: Offered UDP load of each stream in Mbit/s.
+    @param rtt_count: Number of TCP RTT samples.
+    @param record: WifiConnectRecord of the link under test, copied into
+                   the result so it can be told which connection it measured.
+    @returns: A dict with the results of each measurement.
+    """
+    result = {
+        'tcp_upload': run_tcp_throughput(host, port, duration, streams,
+                                         'upload'),
+        'tcp_download': run_tcp_throughput(host, port, duration, streams,
+                                           'download'),
+        'tcp_rtt': run_tcp_rtt(host, port, rtt_count),
+        'udp': run_udp_test(host, port, duration, streams, udp_rate_mbps),
+        'connection': record._asdict() if record is not None else None,
+    }
+    logging.info('netperf %s: upload %.1f Mbit/s, download %.1f Mbit/s, '
+                 'RTT p50 %.2f ms, UDP loss %.3f jitter %.2f ms', host,
+                 result['tcp_upload']['goodput_mbps'],
+                 result['tcp_download']['goodput_mbps'],
+                 result['tcp_rtt']['rtt_ms']['p50'], result['udp']['loss'],
+                 result['udp']['jitter_ms'])
+    return result
+
+
+def benchmark_loopback(duration=2, streams=4, udp_rate_mbps=100.0):
+    """Runs run_netperf against a NetperfServer on loopback.
+    @returns: The run_netperf result.
+    """
+    with NetperfServer('127.0.0.1', 0) as server:
+        return run_netperf('127.0.0.1', server.port, duration, streams,
+                           udp_rate_mbps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--server', action='store_true',
+                        help='serve until interrupted')
+    parser.add_argument('--host', default='',
+                        help='address to listen on, or server to measure')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--streams', type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.server:
+        server = NetperfServer(args.host, args.port).start()
+        logging.info('netperf server on port %d', server.port)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.stop()
+    else:
+        run_netperf(args.host or '127.0.0.1', args.port, args.duration,
+                    args.streams)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+# Lint as: python2, python3
+"""
+WebM (Matroska) container parsing.
+
+The recording is memory mapped and only the EBML element headers, the track
+descriptions and the block headers are read, frame payloads are skipped.
+This gives the frame timestamps of a recording of several GB in seconds,
+without decoding the video.
+"""
+# pylint: disable=missing-docstring
+import logging
+import mmap
+import struct
+
+import numpy
+
+# EBML element ids, with their length marker bits.
+EBML_HEADER = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_TYPE = 0x83
+CODEC_ID = 0x86
+DEFAULT_DURATION = 0x23E383
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+CLUSTER = 0x1F43B675
+TIMECODE = 0xE7
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+# Elements whose children are parsed. They are entered rather than skipped,
+# which also handles the unknown sizes of live recordings, where Chrome does
+# not know the Segment and Cluster sizes while writing them.
+_MASTERS = frozenset([SEGMENT, INFO, TRACKS, TRACK_ENTRY, VIDEO, CLUSTER,
+                      BLOCK_GROUP])
+TRACK_TYPES = {1: 'video', 2: 'audio', 17: 'subtitle'}
+# Default TimecodeScale, timestamps are in ms.
+_DEFAULT_TIMECODE_SCALE = 1000000
+
+
+def _read_vint(data, offset, keep_marker=False):
+    """Reads an EBML variable size integer.
+    @param data: The mapped file.
+    @param offset: Position of the integer.
+    @param keep_marker: True for element ids, which keep the marker bit.
+    @returns: A tuple (value, length), value None for an unknown size.
+    @raises: ValueError on an invalid first byte.
+    """
+    first = data[offset]
+    if isinstance(first, str):
+        first = ord(first)
+    if not first:
+        raise ValueError('Invalid EBML integer at %d' % offset)
+    length = 1
+    mask = 0x80
+    while not first & mask:
+        mask >>= 1
+        length += 1
+    value = first if keep_marker else first & (mask - 1)
+    unknown = value == mask - 1
+    for byte in bytearray(data[offset + 1:offset + length]):
+        value = (value << 8) | byte
+        unknown = unknown and byte == 0xff
+    if unknown and not keep_marker:
+        return None, length
+    return value, length
+
+
+def _read_uint(data):
+    value = 0
+    for byte in bytearray(data):
+        value = (value << 8) | byte
+    return value
+
+
+def _read_float(data):
+    if len(data) == 4:
+        return struct.unpack('>f', data)[0]
+    if len(data) == 8:
+        return struct.unpack('>d', data)[0]
+    return 0.0
+
+
+def parse_webm(path):
+    """Reads the tracks and block timestamps of a WebM file.
+    @param path: Path of the WebM file.
+    @returns: A dict with the 'duration' in seconds from the Info element
+              (None if missing, as in live recordings), the 'size' in bytes
+              and the 'tracks' by track number. Each track is a dict with its
+              'type', 'codec', 'width', 'height', 'default_duration' in
+              seconds, the 'frames' and 'keyframes' counts, the payload
+              'bytes' and the block 'timestamps' in seconds as a numpy
+              array in file order.
+    @raises: ValueError if the file is not a WebM or Matroska file.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _parse(data)
+    finally:
+        data.close()
+
+
+def _parse(data):
+    size = len(data)
+    if size < 4 or _read_vint(data, 0, True)[0] != EBML_HEADER:
+        raise ValueError('Not a WebM file')
+    scale = _DEFAULT_TIMECODE_SCALE
+    duration = None
+    tracks = {}
+    track = None
+    timestamps = {}
+    cluster_time = 0
+    offset = 0
+    while offset < size:
+        try:
+            element, id_length = _read_vint(data, offset, True)
+            length, size_length = _read_vint(data, offset + id_length)
+        except (ValueError, IndexError):
+            # A recording cut short, keep what was read.
+            logging.warning('Truncated WebM element at %d', offset)
+            break
+        start = offset + id_length + size_length
+        if element in _MASTERS:
+            if element == TRACK_ENTRY:
+                track = {'type': None, 'codec': None, 'width': None,
+                         'height': None, 'default_duration': None,
+                         'frames': 0, 'keyframes': 0, 'bytes': 0}
+            offset = start
+            continue
+        if length is None:
+            logging.warning('Unknown size element 0x%x at %d', element, offset)
+            break
+        end = start + length
+        if element in (SIMPLE_BLOCK, BLOCK):
+            number, number_length = _read_vint(data, start)
+            header = start + number_length
+            relative, flags = struct.unpack('>hB', data[header:header + 3])
+            frames = 1
+            if flags & 0x06:
+                frames = bytearray(data[header + 3:header + 4])[0] + 1
+            info = tracks.get(number)
+            if info is not None:
+                info['frames'] += frames
+                info['bytes'] += end - header - 3
+                if element == SIMPLE_BLOCK and flags & 0x80:
+                    info['keyframes'] += 1
+                timestamps[number].append(cluster_time + relative)
+        elif element == TIMECODE:
+            cluster_time = _read_uint(data[start:end])
+        elif element == TIMECODE_SCALE:
+            scale = _read_uint(data[start:end])
+        elif element == DURATION:
+            duration = _read_float(data[start:end])
+        elif track is not None and element == TRACK_NUMBER:
+            number = _read_uint(data[start:end])
+            tracks[number] = track
+            timestamps[number] = []
+        elif track is not None and element == TRACK_TYPE:
+            track['type'] = TRACK_TYPES.get(_read_uint(data[start:end]))
+        elif track is not None and element == CODEC_ID:
+            track['codec'] = data[start:end].decode('ascii', 'replace')
+        elif track is not None and element == DEFAULT_DURATION:
+            track['default_duration'] = _read_uint(data[start:end]) / 1e9
+        elif track is not None and element == PIXEL_WIDTH:
+            track['width'] = _read_uint(data[start:end])
+        elif track is not None and element == PIXEL_HEIGHT:
+            track['height'] = _read_uint(data[start:end])
+        offset = end
+    for number, track in tracks.items():
+        track['timestamps'] = numpy.array(timestamps[number],
+                                          dtype=numpy.float64) * scale / 1e9
+    return {'duration': duration * scale / 1e9 if duration else None,
+            'size': size, 'tracks': tracks}
+
+
+def get_video_stats(path, expected_fps=None, gap_ratio=1.5):
+    """Frame statistics of the first video track of a WebM file.
+    A gap between two frames longer than gap_ratio frame intervals counts
+    the missing frames as dropped.
+    @param path: Path of the WebM file.
+    @param expected_fps: Frame rate of the recording, the median frame
+                         interval is used by default.
+    @param gap_ratio: Frame intervals from which a gap has dropped frames.
+    @returns: A dict with the 'duration' in seconds, the 'frame_count',
+              the 'avg_interval', 'min_interval' and 'max_interval' in
+              seconds, the 'fps', the video 'bitrate' and total
+              'file_bitrate' in bit/s, the 'dropped_frames' and the
+              'drop_rate' and the video 'width' and 'height'.
+    @raises: ValueError if there is no video track.
+    """
+    parsed = parse_webm(path)
+    videos = [track for _, track in sorted(parsed['tracks'].items())
+              if track['type'] == 'video']
+    if not videos:
+        raise ValueError('%s has no video track' % path)
+    video = videos[0]
+    times = numpy.sort(video['timestamps'])
+    intervals = numpy.diff(times)
+    if expected_fps:
+        interval = 1.0 / expected_fps
+    elif len(intervals):
+        interval = float(numpy.median(intervals))
+    else:
+        interval = video['default_duration'] or 0.0
+    if len(times):
+        duration = float(times[-1] - times[0] + interval)
+    else:
+        duration = 0.0
+    if parsed['duration']:
+        duration = parsed['duration']
+    dropped = 0
+    if interval and len(intervals):
+        gaps = intervals[intervals > gap_ratio * interval]
+        dropped = int(numpy.round(gaps / interval).sum() - len(gaps))
+    frames = video['frames']
+    return {
+        'duration': duration,
+        'frame_count': frames,
+        'avg_interval': float(intervals.mean()) if len(intervals) else None,
+        'min_interval': float(intervals.min()) if len(intervals) else None,
+        'max_interval': float(intervals.max()) if len(intervals) else None,
+        'fps': frames / duration if duration else None,
+        'bitrate': video['bytes'] * 8 / duration if duration else None,
+        'file_bitrate': parsed['size'] * 8 / duration if duration else None,
+        'dropped_frames': dropped,
+        'drop_rate': (float(dropped) / (frames + dropped)
+                      if frames + dropped else 0.0),
+        'width': video['width'],
+        'height': video['height'],
+    }
@@ -1,28 +1,1250 @@
 #!/usr/bin/python3
 
+import collections
+
+import json
+
 import logging
 
-import os,time
+import os,time
+
+import random
+
+import shutil
+
+import socket
+
+import struct
+
+import subprocess
+
+import tempfile
+
+import numpy
+
+from autotest_lib.client.bin import test,utils
+
+from autotest_lib.client.common_lib import error
+
+from autotest_lib.client.common_lib.cros import chrome
+
+from autotest_lib.client.cros.networking.chrome_testing import test_utils
+
+from autotest_lib.client.cros.networking.chrome_testing import chrome_networking_test_context as cntc
+
+from autotest_lib.client.cros.enterprise import enterprise_network_api as ena
+
+from autotest_lib.client.cros.networking import wifi_proxy
+
+from autotest_lib.client.cros.networking.chrome_testing import chrome_networking_test_api as cnta
+
+import utils_ts
+
+import utils_ts_netperf
+
+# Phases of a Wi-Fi connection, in order. Each phase ends when shill reports
+# the matching service state: scan when the service is visible, association
+# when shill starts associating, authentication when the link is up and
+# shill moves to configuration, ip_configured when the service is ready and
+# portal_check when the connectivity check has a result.
+WIFI_CONNECT_PHASES = ('scan', 'association', 'authentication',
+                       'ip_configured', 'portal_check')
+
+WIFI_CONNECTED_STATES = ('ready', 'portal', 'no-connectivity',
+                         'redirect-found', 'portal-suspected', 'online')
+
+WIFI_PORTAL_STATES = ('online', 'portal', 'no-connectivity', 'redirect-found',
+                      'portal-suspected')
+
+# Structured result of WifiConnectionManager.connect. The phase fields hold
+# the duration of each phase in seconds, None if the phase was not reached.
+WifiConnectRecord = collections.namedtuple(
+        'WifiConnectRecord',
+        ['ssid', 'security', 'success', 'reason', 'state', 'start'] +
+        list(WIFI_CONNECT_PHASES) + ['total'])
+
+
+class ShillWifiBackend(object):
+
+        """Drives Wi-Fi connections through the shill D-Bus API."""
+
+        def __init__(self, proxy=None):
+
+                self._proxy = proxy or wifi_proxy.WifiProxy()
+
+        def request_scan(self):
+
+                """Starts a Wi-Fi scan, the services show up as it finds them."""
+
+                self._proxy.manager.RequestScan('wifi')
+
+        def find_service(self, ssid, security):
+
+                """Returns the service of ssid known to shill, or None.
+
+                @param security: security class of the service, None for any.
+
+                """
+
+                properties = {'Type': 'wifi', 'Name': ssid}
+
+                if security:
+
+                        properties['SecurityClass'] = security
+
+                return self._proxy.find_matching_service(properties)
+
+        def connect(self, service, ssid, passphrase, security):
+
+                """Configures the credentials of ssid and starts connecting."""
+
+                config = {'Type': 'wifi', 'Mode': 'managed', 'SSID': ssid,
+                          'SecurityClass': security}
+
+                if passphrase:
+
+                        config['Passphrase'] = passphrase
+
+                self._proxy.configure_service(config)
+
+                service.Connect()
+
+        def get_state(self, service):
+
+                """Returns the State property of service."""
+
+                properties = self._proxy.dbus2primitive(service.GetProperties())
+
+                return properties.get('State')
+
+        def get_error(self, service):
+
+                """Returns the Error property of service."""
+
+                properties = self._proxy.dbus2primitive(service.GetProperties())
+
+                return properties.get('Error')
+
+        def disconnect(self, service):
+
+                """Starts disconnecting service."""
+
+                service.Disconnect()
+
+        def is_connected(self):
+
+                """Returns True if any Wi-Fi service is connected."""
+
+                return self._proxy.find_matching_service(
+                        {'Type': 'wifi', 'IsConnected': True}) is not None
+
+
+class FakeWifiBackend(object):
+
+        """Offline stand-in of ShillWifiBackend for unit tests and benchmarks.
+
+        The service walks through the shill states with the configured delays,
+        optionally with random jitter, and can be made to fail in any phase.
+
+        """
+
+        def __init__(self, delays=None, jitter=0.0, fail_phase=None,
+                     portal_state='online', seed=None):
+
+                """
+                @param delays: dict from phase name to its duration in seconds.
+
+                @param jitter: standard deviation of the relative random jitter
+                added to every delay.
+
+                @param fail_phase: phase in WIFI_CONNECT_PHASES which never
+                completes, None to always succeed.
+
+                @param portal_state: state reported after the portal check.
+
+                @param seed: seed of the jitter generator.
+
+                """
+
+                self.delays = {'scan': 0.002, 'association': 0.002,
+                               'authentication': 0.002, 'ip_configured': 0.002,
+                               'portal_check': 0.002}
+
+                self.delays.update(delays or {})
+
+                self.jitter = jitter
+
+                self.fail_phase = fail_phase
+
+                self.portal_state = portal_state
+
+                self._random = random.Random(seed)
+
+                self._deadlines = []
+
+                self._scan_deadline = 0.0
+
+                self.connected_ssid = None
+
+        def _delay(self, phase):
+
+                delay = self.delays[phase]
+
+                if self.jitter:
+
+                        delay *= max(0.0, self._random.gauss(1.0, self.jitter))
+
+                return delay
+
+        def request_scan(self):
+
+                self._scan_deadline = time.time() + self._delay('scan')
+
+        def find_service(self, ssid, security):
+
+                if self.fail_phase == 'scan' or time.time() < self._scan_deadline:
+
+                        return None
+
+                return ssid
+
+        def connect(self, service, ssid, passphrase, security):
+
+                deadline = time.time()
+
+                self._deadlines = []
+
+                for phase in WIFI_CONNECT_PHASES[1:]:
+
+                        deadline += self._delay(phase)
+
+                        self._deadlines.append(deadline)
+
+                self.connected_ssid = None
+
+        def get_state(self, service):
+
+                states = ('association', 'configuration', 'ready',
+                          self.portal_state)
+
+                now = time.time()
+
+                state = 'idle'
+
+                for phase, deadline, next_state in zip(
+                                WIFI_CONNECT_PHASES[1:], self._deadlines, states):
+
+                        if now < deadline:
+
+                                break
+
+                        if phase == self.fail_phase:
+
+                                return 'failure'
+
+                        state = next_state
+
+                if state in WIFI_CONNECTED_STATES:
+
+                        self.connected_ssid = service
+
+                return state
+
+        def get_error(self, service):
+
+                return '%s-failed' % self.fail_phase if self.fail_phase else ''
+
+        def disconnect(self, service):
+
+                self._deadlines = []
+
+                self.connected_ssid = None
+
+        def is_connected(self):
+
+                return self.connected_ssid is not None
+
+
+class WifiConnectionManager(object):
+
+        """Connects and disconnects Wi-Fi networks with phase timings.
+
+        Replaces running the ./wifi script from the autotest scripts folder: no
+        shell and no change of the working directory, every phase has a timeout
+        and the result is a WifiConnectRecord.
+
+        """
+
+        def __init__(self, backend=None, poll_interval=0.02):
+
+                """
+                @param backend: ShillWifiBackend by default, FakeWifiBackend to
+                run offline.
+
+                @param poll_interval: seconds between two service state reads.
+
+                """
+
+                self.backend = backend or ShillWifiBackend()
+
+                self.poll_interval = poll_interval
+
+                self._services = {}
+
+        def connect(self, ssid, passphrase='', security='psk', scan_timeout=15,
+                    connect_timeout=30, portal_timeout=10):
+
+                """Connects to ssid and times every phase.
+
+                @param ssid: name of the network.
+
+                @param passphrase: password, '' for open networks.
+
+                @param security: shill security class, e.g. 'psk' or 'none'.
+
+                @param scan_timeout: seconds to find the network.
+
+                @param connect_timeout: seconds from the connect request to an
+                IP configuration.
+
+                @param portal_timeout: seconds for the portal check once the
+                service is ready.
+
+                @returns a WifiConnectRecord.
+
+                """
+
+                phases = dict.fromkeys(WIFI_CONNECT_PHASES)
+
+                start = time.time()
+
+                # One scan is requested, more requests would queue scans that
+                # slow down this one and the next phases.
+                self.backend.request_scan()
+
+                service = self.backend.find_service(ssid, security)
+
+                while service is None and time.time() - start < scan_timeout:
+
+                        time.sleep(self.poll_interval)
+
+                        service = self.backend.find_service(ssid, security)
+
+                if service is None:
+
+                        return self._record(ssid, security, False, 'not found',
+                                            None, start, phases)
+
+                scanned = time.time()
+
+                phases['scan'] = scanned - start
+
+                self._services[ssid] = service
+
+                self.backend.connect(service, ssid, passphrase, security)
+
+                # Time at which each state was first seen.
+                seen = {'connect': scanned}
+
+                state = None
+
+                deadline = scanned + connect_timeout
+
+                while True:
+
+                        state = self.backend.get_state(service)
+
+                        now = time.time()
+
+                        if state == 'failure':
+
+                                return self._record(
+                                        ssid, security, False,
+                                        self.backend.get_error(service) or state,
+                                        state, start, phases)
+
+                        if state == 'association':
+
+                                seen.setdefault('association', now)
+
+                        elif state == 'configuration':
+
+                                seen.setdefault('association', now)
+
+                                seen.setdefault('configuration', now)
+
+                        elif state in WIFI_CONNECTED_STATES:
+
+                                seen.setdefault('association', now)
+
+                                seen.setdefault('configuration', now)
+
+                                seen.setdefault('ready', now)
+
+                                if state in WIFI_PORTAL_STATES:
+
+                                        seen.setdefault('portal', now)
+
+                                        break
+
+                                deadline = min(deadline, seen['ready'] + portal_timeout)
+
+                        if now > deadline:
+
+                                break
+
+                        time.sleep(self.poll_interval)
+
+                marks = ['connect', 'association', 'configuration', 'ready', 'portal']
+
+                for phase, begin, end in zip(WIFI_CONNECT_PHASES[1:], marks, marks[1:]):
+
+                        if begin in seen and end in seen:
+
+                                phases[phase] = seen[end] - seen[begin]
+
+                success = 'ready' in seen
+
+                if success:
+
+                        reason = '' if 'portal' in seen else 'portal check timeout'
+
+                else:
+
+                        reason = '%s timeout' % (state or 'connect')
+
+                return self._record(ssid, security, success, reason, state,
+                                    start, phases)
+
+        def disconnect(self, ssid, timeout=10):
+
+                """Disconnects from ssid.
+
+                @param ssid: name of the network.
+
+                @param timeout: seconds to wait for the service to leave the
+                connected states.
+
+                @returns a dict with 'success', 'duration' and 'state'.
+
+                """
+
+                service = self._services.get(ssid)
+
+                if service is None:
+
+                        service = self.backend.find_service(ssid, None)
+
+                if service is None:
+
+                        return {'success': False, 'duration': 0.0, 'state': None}
+
+                start = time.time()
+
+                self.backend.disconnect(service)
+
+                state = self.backend.get_state(service)
+
+                while state in WIFI_CONNECTED_STATES and time.time() - start < timeout:
+
+                        time.sleep(self.poll_interval)
+
+                        state = self.backend.get_state(service)
+
+                return {'success': state not in WIFI_CONNECTED_STATES,
+                        'duration': time.time() - start, 'state': state}
+
+        def _record(self, ssid, security, success, reason, state, start, phases):
+
+                record = WifiConnectRecord(ssid=ssid, security=security,
+                                           success=success, reason=reason,
+                                           state=state, start=start,
+                                           total=time.time() - start, **phases)
+
+                logging.info('Wi-Fi connect %s: %s', ssid, record)
+
+                return record
+
+
+def run_wifi_cycle_benchmark(configs, cycles=10, manager=None,
+                             result_file=None, build=None):
+
+        """Runs connect/disconnect cycles and reports phase percentiles.
+
+        @param configs: list of dicts with 'ssid' and optionally 'passphrase'
+        and 'security' ('psk' by default).
+
+        @param cycles: number of connect/disconnect cycles per config.
+
+        @param manager: WifiConnectionManager to use, a new one by default.
+
+        @param result_file: path of a JSON file the result is written to.
+
+        @param build: build name stored in the result, the
+        CHROMEOS_RELEASE_VERSION of the DUT by default.
+
+        @returns dict with the build and, per '<ssid>/<security>' config, the
+        percentiles of every phase and of the total connect time, the
+        failure rate, the failure reasons, and per cycle the phase timings
+        (NaN for failed cycles) and failure reason ('' for success).
+
+        """
+
+        manager = manager or WifiConnectionManager()
+
+        if build is None:
+
+                build = utils_ts.get_board_property('CHROMEOS_RELEASE_VERSION')
+
+        fields = list(WIFI_CONNECT_PHASES) + ['total']
+
+        result = {'build': build, 'timestamp': time.time(), 'cycles': cycles,
+                  'configs': {}}
+
+        for config in configs:
+
+                security = config.get('security', 'psk')
+
+                timings = numpy.full((cycles, len(fields)), numpy.nan)
+
+                reasons = collections.Counter()
+
+                cycle_reasons = [''] * cycles
+
+                for cycle in range(cycles):
+
+                        record = manager.connect(config['ssid'],
+                                                 config.get('passphrase', ''),
+                                                 security)
+
+                        if record.success:
+
+                                timings[cycle] = [numpy.nan if value is None else value
+                                                  for value in (getattr(record, field)
+                                                                for field in fields)]
+
+                        else:
+
+                                reasons[record.reason] += 1
+
+                                cycle_reasons[cycle] = record.reason
+
+                        manager.disconnect(config['ssid'])
+
+                failures = sum(reasons.values())
+
+                summary = {'ssid': config['ssid'], 'security': security,
+                           'failure_rate': failures / float(cycles),
+                           'failure_reasons': dict(reasons),
+                           'timings': timings.tolist(),
+                           'cycle_failures': cycle_reasons,
+                           'phases': {}}
+
+                for index, field in enumerate(fields):
+
+                        summary['phases'][field] = utils_ts.get_percentiles(
+                                timings[:, index])
+
+                logging.info('%s/%s: p50 %s s, p95 %s s, failure rate %.2f',
+                             config['ssid'], security,
+                             summary['phases']['total']['p50'],
+                             summary['phases']['total']['p95'],
+                             summary['failure_rate'])
+
+                result['configs']['%s/%s' % (config['ssid'], security)] = summary
+
+        if result_file:
+
+                with open(result_file, 'w') as f:
+
+                        json.dump(_nan_to_none(result), f, indent=1, sort_keys=True)
+
+        return result
+
+
+def _nan_to_none(value):
+
+        """Replaces NaN in nested lists and dicts by None for strict JSON."""
+
+        if isinstance(value, dict):
+
+                return dict((key, _nan_to_none(item)) for key, item in value.items())
+
+        if isinstance(value, list):
+
+                return [_nan_to_none(item) for item in value]
+
+        if isinstance(value, float) and value != value:
+
+                return None
+
+        return value
+
+
+def compare_wifi_benchmarks(baseline_file, result_file, threshold=0.1,
+                            statistics=('p50', 'p95')):
+
+        """Compares two results of run_wifi_cycle_benchmark.
+
+        @param baseline_file: JSON result of the reference build.
+
+        @param result_file: JSON result of the build under test.
+
+        @param threshold: relative slowdown reported as regression.
+
+        @param statistics: percentiles compared for every phase.
+
+        @returns list of (config, phase, statistic, baseline, current) for
+        every regression, including failure rate increases as phase
+        'failure_rate'.
+
+        """
+
+        with open(baseline_file) as f:
+
+                baseline = json.load(f)
+
+        with open(result_file) as f:
+
+                current = json.load(f)
+
+        regressions = []
+
+        for name, summary in current['configs'].items():
+
+                reference = baseline['configs'].get(name)
+
+                if reference is None:
+
+                        continue
+
+                if summary['failure_rate'] > reference['failure_rate']:
+
+                        regressions.append((name, 'failure_rate', None,
+                                            reference['failure_rate'],
+                                            summary['failure_rate']))
+
+                for phase, stats in summary['phases'].items():
+
+                        for statistic in statistics:
+
+                                old = reference['phases'].get(phase, {}).get(statistic)
+
+                                new = stats.get(statistic)
+
+                                if old and new and new > old * (1 + threshold):
+
+                                        regressions.append((name, phase, statistic,
+                                                            old, new))
+
+        for regression in regressions:
+
+                logging.warning('Wi-Fi regression %s %s %s: %s -> %s', *regression)
+
+        return regressions
+
+
+def benchmark_wifi_cycles(cycles=20, delays=None, jitter=0.1, slowdown=1.5):
+
+        """Runs the cycle benchmark and its comparison offline.
+
+        A baseline and a build whose connection phases are slowdown times
+        slower are benchmarked against FakeWifiBackend and compared.
+
+        @param cycles: number of connect/disconnect cycles of each build.
+
+        @param delays: dict from phase name to its duration in seconds.
+
+        @param jitter: relative random jitter of the delays.
+
+        @param slowdown: factor applied to the delays of the slower build.
+
+        @returns dict with the 'baseline' and 'slow' results, 'errors' the
+        relative error of every measured phase median of the baseline to its
+        delay, and the 'regressions' found by compare_wifi_benchmarks.
+
+        """
+
+        delays = delays or {'scan': 0.01, 'association': 0.02,
+                            'authentication': 0.04, 'ip_configured': 0.02,
+                            'portal_check': 0.01}
+
+        work_dir = tempfile.mkdtemp()
+
+        results = {}
+
+        try:
+
+                for name, factor in (('baseline', 1.0), ('slow', slowdown)):
+
+                        backend = FakeWifiBackend(
+                                delays=dict((phase, delay * factor)
+                                            for phase, delay in delays.items()),
+                                jitter=jitter, seed=cycles)
+
+                        manager = WifiConnectionManager(backend, poll_interval=0.001)
+
+                        results[name] = run_wifi_cycle_benchmark(
+                                [{'ssid': 'fake', 'passphrase': 'fake'}], cycles,
+                                manager, os.path.join(work_dir, name + '.json'),
+                                build=name)
+
+                regressions = compare_wifi_benchmarks(
+                        os.path.join(work_dir, 'baseline.json'),
+                        os.path.join(work_dir, 'slow.json'))
+
+        finally:
+
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        phases = results['baseline']['configs']['fake/psk']['phases']
+
+        errors = dict((phase, phases[phase]['p50'] / delay - 1)
+                      for phase, delay in delays.items())
+
+        logging.info('Fake Wi-Fi cycles: phase median errors %s, %d regressions',
+                     errors, len(regressions))
+
+        return {'baseline': results['baseline'], 'slow': results['slow'],
+                'errors': errors, 'regressions': regressions}
+
+
+def measure_wifi_link(config, server, port=utils_ts_netperf.DEFAULT_PORT,
+                      duration=10, streams=4, udp_rate_mbps=10.0,
+                      manager=None, disconnect=True):
+
+        """Connects to a network and measures the link throughput and latency.
+
+        @param config: dict with 'ssid' and optionally 'passphrase' and
+        'security' ('psk' by default).
+
+        @param server: address of a peer running utils_ts_netperf.py --server.
+
+        @param port: port of the server.
+
+        @param duration: seconds of each transfer.
+
+        @param streams: number of parallel streams.
+
+        @param udp_rate_mbps: offered UDP load of each stream in Mbit/s.
+
+        @param manager: WifiConnectionManager to use, a new one by default.
+
+        @param disconnect: True to disconnect after the measurement.
+
+        @returns the utils_ts_netperf.run_netperf result, its 'connection'
+        being the WifiConnectRecord of the connection it measured.
+
+        @raises error.TestFail if the connection failed.
+
+        """
+
+        manager = manager or WifiConnectionManager()
+
+        record = manager.connect(config['ssid'], config.get('passphrase', ''),
+                                 config.get('security', 'psk'))
+
+        if not record.success:
+
+                raise error.TestFail('Failed to connect to %s: %s' %
+                                     (record.ssid, record.reason))
+
+        try:
+
+                return utils_ts_netperf.run_netperf(server, port, duration, streams,
+                                                    udp_rate_mbps, record=record)
+
+        finally:
+
+                if disconnect:
+
+                        manager.disconnect(config['ssid'])
+
+
+WLAN_COREDUMP_CONTROL = '/sys/class/remoteproc/remoteproc0/coredump'
+
+WLAN_SIMULATE_FW_CRASH = '/sys/kernel/debug/ath11k/wcn6750 hw1.0/simulate_fw_crash'
+
+WLAN_CRASH_PATTERN = r'crash detected|firmware crashed'
+
+WLAN_RECOVERY_PATTERN = r'0\.wifi: pdev 0 successfully recovered'
+
+
+def run_ssr_iterations(trigger, log_milestones, conditions=(), iterations=1,
+                       timeout=20, condition_timeout=60, after_milestones=None,
+                       log_path='/dev/kmsg', poll_interval=0.1):
+
+        """Runs subsystem restarts and times their recovery.
+
+        For every iteration a kernel log cursor is opened, the restart is
+        triggered and the log milestones are awaited in order. Their latencies
+        are the differences of the kernel timestamps to the first milestone.
+        Then the conditions are polled, and their latencies are counted from
+        the first milestone as well. after_milestones runs last, so its work,
+        like copying a dump, is not counted in the latencies.
+
+        @param trigger: callable starting the restart.
+
+        @param log_milestones: list of (name, pattern) kernel log lines, in
+        order, the first one being the crash.
+
+        @param conditions: list of (name, callable) polled in order once all
+        log milestones were seen, each done when the callable returns True.
+
+        @param iterations: number of restarts.
+
+        @param timeout: seconds to wait for each log milestone.
+
+        @param condition_timeout: seconds to wait for each condition.
+
+        @param after_milestones: callable returning a dict of extra numeric
+        values of the iteration, called once the log milestones were seen
+        and the conditions polled.
+
+        @param log_path: kernel log to stream, a file to replay offline.
+
+        @param poll_interval: seconds between two checks of a condition.
+
+        @returns dict with 'latencies', a numpy array per milestone and
+        condition (NaN when missed), 'stats' with their percentiles, 'extra'
+        with arrays of the after_milestones values and 'failures', the
+        number of incomplete iterations.
+
+        """
+
+        names = ([name for name, _ in log_milestones[1:]] +
+                 [name for name, _ in conditions])
+
+        latencies = dict((name, numpy.full(iterations, numpy.nan)) for name in names)
+
+        extra = collections.defaultdict(lambda: numpy.full(iterations, numpy.nan))
+
+        failures = 0
+
+        for iteration in range(iterations):
+
+                cursor = utils_ts.KernelLogCursor(log_path)
+
+                try:
+
+                        trigger()
+
+                        records = []
+
+                        for name, pattern in log_milestones:
+
+                                record = cursor.wait_for(pattern, timeout)
+
+                                if record is None:
+
+                                        logging.warning('SSR %d: no %s in the kernel log',
+                                                        iteration, name)
+
+                                        break
+
+                                records.append(record)
+
+                                if len(records) > 1:
+
+                                        latencies[name][iteration] = (
+                                                record.timestamp - records[0].timestamp)
+
+                        seen_at = time.time()
+
+                finally:
+
+                        cursor.close()
+
+                if len(records) < len(log_milestones):
+
+                        failures += 1
+
+                        continue
+
+                # Conditions are timed from the last milestone, which was seen
+                # at seen_at, so its log latency is added.
+                offset = records[-1].timestamp - records[0].timestamp
+
+                for name, condition in conditions:
+
+                        deadline = time.time() + condition_timeout
+
+                        while not condition() and time.time() < deadline:
+
+                                time.sleep(poll_interval)
 
-import subprocess
+                        if not condition():
 
-from autotest_lib.client.bin import test,utils
+                                logging.warning('SSR %d: no %s', iteration, name)
 
-from autotest_lib.client.common_lib import error
+                                failures += 1
 
-from autotest_lib.client.common_lib.cros import chrome
+                                break
 
-from autotest_lib.client.cros.networking.chrome_testing import test_utils
+                        latencies[name][iteration] = offset + time.time() - seen_at
 
-from autotest_lib.client.cros.networking.chrome_testing import chrome_networking_test_context as cntc
+                if after_milestones:
 
-from autotest_lib.client.cros.enterprise import enterprise_network_api as ena
+                        for key, value in after_milestones().items():
 
-from autotest_lib.client.cros.networking import wifi_proxy
+                                extra[key][iteration] = numpy.nan if value is None else value
 
-from autotest_lib.client.cros.networking.chrome_testing import chrome_networking_test_api as cnta
+                logging.info('SSR %d: %s', iteration, dict(
+                        (name, latencies[name][iteration]) for name in names))
+
+        return {'latencies': latencies,
+                'stats': dict((name, utils_ts.get_percentiles(values))
+                              for name, values in latencies.items()),
+                'extra': dict(extra),
+                'failures': failures}
+
+
+# Vendor specific HCI command crashing the Qualcomm controller firmware, what
+# "hcitool cmd 0x3f 0x0c 0x26" sends.
+BT_SSR_COMMAND = (0x3f, 0x0c, b'\x26')
+
+BT_RESET_PATTERN = r'Bluetooth: hci\d+: .*(hardware error|[Cc]ontroller [Rr]eset|SSR|memdump)'
+
+BT_INIT_PATTERN = r'Bluetooth: hci\d+: .*(setup on UART is completed|[Ss]etup complete)'
+
+_HCI_COMMAND_PKT = 0x01
+
+
+def send_hci_command(ogf, ocf, params=b'', dev_id=0):
+
+        """Sends an HCI command on a raw HCI socket, like hcitool cmd.
+
+        @param ogf: opcode group field.
+
+        @param ocf: opcode command field.
+
+        @param params: bytes of the command parameters.
+
+        @param dev_id: index of the controller, 0 for hci0.
+
+        @raises error.TestError if the command could not be sent.
+
+        """
+
+        opcode = (ogf << 10) | ocf
+
+        packet = struct.pack('<BHB', _HCI_COMMAND_PKT, opcode, len(params)) + params
+
+        try:
+
+                sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW,
+                                     socket.BTPROTO_HCI)
+
+        except (AttributeError, socket.error) as e:
+
+                raise error.TestError('Can not open an HCI socket: %s' % e)
+
+        try:
+
+                sock.bind((dev_id,))
+
+                sock.send(packet)
+
+        except socket.error as e:
+
+                raise error.TestError('Can not send HCI command 0x%04x: %s' %
+                                      (opcode, e))
+
+        finally:
+
+                sock.close()
+
+
+class BluezBackend(object):
+
+        """Bluetooth adapter and device state from BlueZ over D-Bus."""
+
+        def __init__(self, adapter='hci0'):
+
+                try:
+
+                        import dbus
+
+                except ImportError as e:
+
+                        logging.exception(
+                                'Can not import dbus: %s. This method should only be '
+                                'called on Cros device.', e)
+
+                        raise
+
+                self._dbus = dbus
+
+                self._bus = dbus.SystemBus()
+
+                self.adapter = adapter
+
+        def trigger_ssr(self):
+
+                """Crashes the controller firmware."""
+
+                ogf, ocf, params = BT_SSR_COMMAND
+
+                send_hci_command(ogf, ocf, params, int(self.adapter[len('hci'):]))
+
+        def _objects(self):
+
+                manager = self._dbus.Interface(
+                        self._bus.get_object('org.bluez', '/'),
+                        'org.freedesktop.DBus.ObjectManager')
+
+                return manager.GetManagedObjects()
+
+        def is_powered(self):
+
+                """Returns True if the adapter is powered."""
+
+                try:
+
+                        objects = self._objects()
+
+                except self._dbus.DBusException:
+
+                        return False
+
+                adapter = objects.get('/org/bluez/' + self.adapter, {})
+
+                return bool(adapter.get('org.bluez.Adapter1', {}).get('Powered'))
+
+        def is_connected(self, device):
+
+                """Returns True if device, a name or an address, is connected."""
+
+                try:
+
+                        objects = self._objects()
+
+                except self._dbus.DBusException:
+
+                        return False
+
+                for path, interfaces in objects.items():
+
+                        properties = interfaces.get('org.bluez.Device1')
+
+                        if (properties and path.startswith('/org/bluez/' + self.adapter) and
+                            device in (properties.get('Name'), properties.get('Address'))):
+
+                                return bool(properties.get('Connected'))
+
+                return False
+
+
+class FakeBluetoothBackend(object):
+
+        """Stand-in of BluezBackend for offline runs.
+
+        The adapter powers up and the devices connect back the given delays
+        after trigger_ssr. Use it with a captured kernel log as log_path.
+
+        """
+
+        def __init__(self, power_delay=0.5, reconnect_delay=1.0, devices=()):
+
+                self.power_delay = power_delay
+
+                self.reconnect_delay = reconnect_delay
+
+                self.devices = set(devices)
+
+                self.triggered = None
+
+        def trigger_ssr(self):
+
+                self.triggered = time.time()
+
+        def _elapsed(self):
+
+                return float('inf') if self.triggered is None else time.time() - self.triggered
+
+        def is_powered(self):
+
+                return self._elapsed() >= self.power_delay
+
+        def is_connected(self, device):
+
+                return device in self.devices and self._elapsed() >= self.reconnect_delay
+
+
+# chrome.networkingPrivate queries a NetworkingFacade can batch, as the
+# function and its arguments before the callback.
+NETWORKING_QUERIES = {
+        'enabled_devices': ('getEnabledNetworkTypes', ''),
+        'device_states': ('getDeviceStates', ''),
+        'visible_networks': ('getNetworks', '{networkType: "All", visible: true}, '),
+        'wifi_networks': ('getNetworks', '{networkType: "WiFi", visible: true}, '),
+}
+
+_NETWORKING_BATCH_JS = '''
+(function() {
+  var batch = window.__tsNetworkingBatch = {pending: %(count)d, results: {},
+                                            errors: {}};
+  function done(name) {
+    return function(value) {
+      if (chrome.runtime.lastError)
+        batch.errors[name] = chrome.runtime.lastError.message;
+      else
+        batch.results[name] = value;
+      batch.pending--;
+    };
+  }
+  %(calls)s
+})();
+'''
+
+
+class NetworkingFacade(object):
+
+        """Batched and cached access to chrome.networkingPrivate.
+
+        Several queries are run in a single evaluation in the networking test
+        extension instead of one call_test_function round trip each. The
+        results are cached for ttl seconds, and the state changes made
+        through the facade drop the cache so they are seen at once.
+
+        """
+
+        def __init__(self, chrome_testing, ttl=2.0, poll_interval=0.02):
+
+                """@param chrome_testing: ChromeNetworkingTestContext with the
+                networking test extension loaded.
+
+                @param ttl: seconds a query result stays valid.
+
+                @param poll_interval: seconds between two checks of a batch.
+
+                """
+
+                self._chrome_testing = chrome_testing
+
+                self.ttl = ttl
+
+                self.poll_interval = poll_interval
+
+                self._cache = {}
+
+                self.round_trips = 0
+
+        def _extension(self):
+
+                return self._chrome_testing._extension
+
+        def invalidate(self, names=None):
+
+                """Drops the cached results of names, all by default."""
+
+                if names is None:
+
+                        self._cache.clear()
+
+                for name in names or ():
+
+                        self._cache.pop(name, None)
+
+        def get_many(self, names, timeout=20, max_age=None):
+
+                """Returns the results of several queries.
+
+                The cached results not older than max_age are reused and all
+                the others are fetched in one batch.
+
+                @param names: keys of NETWORKING_QUERIES.
+
+                @param timeout: seconds to wait for the batch.
+
+                @param max_age: seconds a cached result may have, the ttl by
+                default and 0 to fetch all.
+
+                @returns dict of query name to result.
+
+                @raises error.TestFail if a query failed or timed out.
+
+                """
+
+                max_age = self.ttl if max_age is None else max_age
+
+                now = time.time()
+
+                stale = [name for name in names
+                         if name not in self._cache or
+                         now - self._cache[name][0] > max_age]
+
+                if stale:
+
+                        self._fetch(stale, timeout)
+
+                return dict((name, self._cache[name][1]) for name in names)
+
+        def get(self, name, timeout=20, max_age=None):
+
+                """Returns the result of one query, see get_many."""
+
+                return self.get_many([name], timeout, max_age)[name]
+
+        def _fetch(self, names, timeout):
+
+                calls = '\n  '.join(
+                        'chrome.networkingPrivate.%s(%sdone("%s"));' %
+                        (NETWORKING_QUERIES[name] + (name,)) for name in names)
+
+                extension = self._extension()
+
+                start = time.time()
+
+                extension.ExecuteJavaScript(_NETWORKING_BATCH_JS % {
+                        'count': len(names), 'calls': calls})
+
+                self.round_trips += 1
+
+                while True:
+
+                        batch = extension.EvaluateJavaScript('window.__tsNetworkingBatch')
+
+                        if batch['pending'] <= 0:
+
+                                break
+
+                        if time.time() - start > timeout:
+
+                                raise error.TestFail('networkingPrivate %s timed out after %s s'
+                                                     % (', '.join(names), timeout))
+
+                        time.sleep(self.poll_interval)
+
+                if batch['errors']:
+
+                        raise error.TestFail('networkingPrivate failed: %s' % batch['errors'])
+
+                now = time.time()
+
+                for name in names:
+
+                        self._cache[name] = (now, batch['results'][name])
+
+                logging.debug('networkingPrivate %s in %.3f s', names, now - start)
+
+        def set_device_enabled(self, network, enabled):
+
+                """Starts enabling or disabling a network type.
+
+                @param network: 'WiFi', 'Cellular' or 'Ethernet'.
+
+                @param enabled: True to enable, False to disable.
+
+                """
+
+                self.invalidate()
+
+                self._extension().ExecuteJavaScript(
+                        'chrome.networkingPrivate.%s(%s);' % (
+                                'enableNetworkType' if enabled else 'disableNetworkType',
+                                json.dumps(network)))
 
-import utils_ts
 
 class ChromeEnterpriseNetworkContext(object):
 
@@ -30,7 +1252,9 @@ class ChromeEnterpriseNetworkContext(object):
 
         LONG_TIMEOUT = 120
 
-        def __init__(self, browser=None):
+        def __init__(self, browser=None, wifi_manager=None):
+
+                self._wifi_manager = wifi_manager
 
                 testing_context = cntc.ChromeNetworkingTestContext()
 
@@ -38,25 +1262,34 @@ class ChromeEnterpriseNetworkContext(object):
 
                 self.chrome_net_context = cnta.ChromeNetworkProvider(testing_context)
 
+                self.networking = NetworkingFacade(testing_context)
+
                 #nws=self.chrome_net_context.get_wifi_networks()
 
                
 
                 #self.enable_wifi_on_dut()
 
-        def disable_network_device(self, network):
+        def disable_network_device(self, network, timeout=SHORT_TIMEOUT):
 
-                logging.info('Disabling: %s', network)
+                """Disable given network device and wait until it is disabled.
+
+                @param network: string name of the network device to be disabled.
+                Options include 'WiFi', 'Cellular' and 'Ethernet'.
 
-                disable_network_result = self.chrome_net_context.\
+                @param timeout: seconds to wait for the device to be disabled.
 
-                _chrome_testing.call_test_function_async(
+                @returns the measured transition time in seconds.
 
-                    'disableNetworkDevice',
+                """
+
+                logging.info('Disabling: %s', network)
 
-                    '"' + network + '"')
+                start = time.time()
 
-                return True
+                self.networking.set_device_enabled(network, False)
+
+                return self._wait_for_device_state(network, False, timeout, start)
 
         def enable_wifi_on_dut(self):
 
@@ -70,109 +1303,130 @@ class ChromeEnterpriseNetworkContext(object):
 
                 return True
 
-        def enable_network_device(self, network):
+        def enable_network_device(self, network, timeout=SHORT_TIMEOUT):
 
-                """Enable given network device.
+                """Enable given network device and wait until it is enabled.
 
                 @param network: string name of the network device to be enabled. Options
 
                 include 'WiFi', 'Cellular' and 'Ethernet'.
 
+                @param timeout: seconds to wait for the device to be enabled.
+
+                @returns the measured transition time in seconds.
+
                 """
 
                 logging.info('Enabling: %s', network)
 
-                enable_network_result = self.chrome_net_context._chrome_testing.call_test_function_async(
+                start = time.time()
 
-                'enableNetworkDevice',
+                self.networking.set_device_enabled(network, True)
 
-                '"' + network + '"')
+                return self._wait_for_device_state(network, True, timeout, start)
 
-                # Allow enough time for the DUT to fully transition into enabled state.
+        def _wait_for_device_state(self, network, enabled, timeout, start,
+                                   interval=0.05, max_interval=1.0):
 
-                time.sleep(self.SHORT_TIMEOUT)
+                """Polls the enabled devices until network reaches the state.
 
-                return True
+                The poll interval doubles after every poll up to max_interval,
+                so fast transitions are seen quickly without flooding the
+                networking API during slow ones.
 
-        def get_enabled_devices(self):
+                @param network: string name of the network device.
 
- 
+                @param enabled: True to wait for enabled, False for disabled.
 
-                enabled_network_types = self.chrome_net_context._chrome_testing.call_test_function(test_utils.LONG_TIMEOUT,'getEnabledNetworkDevices')
+                @param timeout: seconds to wait from start.
 
-                for key, value in enabled_network_types.items():
+                @param start: time.time() when the transition was requested.
 
-                        if key == 'result':
+                @returns the transition time in seconds.
 
-                                logging.info('Enabled Network Devices: %s', value)
+                @raises error.TestFail if the state is not reached in time.
 
-                                return value
+                """
 
-        def check_WiFi_status(self):
+                while True:
 
-                result={}
+                        devices = self.get_enabled_devices(self.SHORT_TIMEOUT, max_age=0) or []
 
-                result["WiFi-interface"]=''
+                        now = time.time()
 
-                enabled_interfaces=self.get_enabled_devices()
+                        if (network in devices) == enabled:
 
-                for interface in enabled_interfaces:
+                                elapsed = now - start
 
-                        if interface=="WiFi":
+                                logging.info('%s %s after %.3f s', network,
+                                             'enabled' if enabled else 'disabled',
+                                             elapsed)
 
-                                pass
+                                return elapsed
 
-                        else:
+                        if now - start > timeout:
 
-                                self.enable_network_device("WiFi")               
+                                raise error.TestFail('%s not %s after %s s' % (
+                                        network, 'enabled' if enabled else 'disabled',
+                                        timeout))
 
-                result["WiFi-interface"]="enabled"
+                        time.sleep(min(interval, max(0, start + timeout - now)))
 
-                return result
+                        interval = min(interval * 2, max_interval)
 
-        def disconnect_from_network(self,SSID):
+        def get_enabled_devices(self, timeout=test_utils.LONG_TIMEOUT, max_age=None):
 
-                """
+                """Returns the enabled network types, cached for a short time.
 
-                        fun to disconnect from SSID
+                @param timeout: seconds to wait for the networking API.
 
-                        @params SSID name of the Network
+                @param max_age: seconds a cached result may have, 0 to query.
 
                 """
 
-                script_path="/usr/local/autotest/cros/scripts"
+                value = self.networking.get('enabled_devices', timeout, max_age)
 
-                # os.chdir() is used to change dir to wifi script path
+                logging.info('Enabled Network Devices: %s', value)
 
-                change_dir = os.chdir(script_path)
+                return value
 
- 
+        def check_WiFi_status(self):
 
-                Disconnect_cmd="./wifi disconnect "+ SSID
+                result={}
 
- 
+                result["WiFi-interface"]=''
 
-        	get_output=subprocess.Popen(Disconnect_cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE,shell=True)
+                result["transition_time"]=0.0
 
- 
+                status = self.networking.get_many(['enabled_devices', 'device_states'],
+                                                  self.SHORT_TIMEOUT)
 
-                time.sleep(self.SHORT_TIMEOUT)
+                if "WiFi" not in (status['enabled_devices'] or []):
 
- 
+                        result["transition_time"]=self.enable_network_device("WiFi")
 
-                print("output ",get_output.stderr.readlines())
+                result["WiFi-interface"]="enabled"
 
- 
+                # Served from the cache unless WiFi had to be enabled.
+                result["device_states"] = dict(
+                        (device['Type'], device['State'])
+                        for device in self.networking.get('device_states', self.SHORT_TIMEOUT))
 
-                output_list=get_output.stdout.readlines()
+                return result
 
- 
+        def disconnect_from_network(self,SSID):
 
-                output_list.extend(get_output.stderr.readlines())       
+                """
 
-               
+                        fun to disconnect from SSID
 
-                return output_list
+                        @params SSID name of the Network
+
+                        @returns dict with success, duration and state of the service
+
+                """
+
+                return self.wifi_manager.disconnect(SSID, self.SHORT_TIMEOUT)
 
         def connect_to_wifi_network(self,SSID,Passphrase,security_mode):
 
@@ -186,80 +1440,103 @@ class ChromeEnterpriseNetworkContext(object):
 
                         @params security_mode -- security property
 
+                        @returns WifiConnectRecord with the duration of every phase
+
                 """
 
-                #default path to connect wifi
+                return self.wifi_manager.connect(SSID, Passphrase, security_mode,
+                                                 connect_timeout=self.SHORT_TIMEOUT)
 
-                script_path="/usr/local/autotest/cros/scripts"
+        @property
 
-                # os.chdir() is used to change dir to wifi script path
+        def wifi_manager(self):
 
-                change_dir = os.chdir(script_path)
+                """WifiConnectionManager used for connect and disconnect."""
 
- 
+                if self._wifi_manager is None:
 
-                #cmd is used to connect to SSID with/without passphrase
+                        self._wifi_manager = WifiConnectionManager()
 
-                connect_cmd="./wifi connect "+ SSID +" "+Passphrase +" "+ security_mode +" >" + "status.txt"
+                return self._wifi_manager
 
- 
+        def validate_output(self,output,string):
 
-                #Popen then cmd and get th output to validate whether is connected or not
+                for ele in output:
 
-        	get_output=subprocess.Popen(connect_cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE,shell=True) 
+                        if string in ele:
 
- 
+                                return True
 
-                output_list=get_output.stdout.readlines()
+                        else:
 
- 
+                                pass
 
-                output_list.extend(get_output.stderr.readlines())
+                return
 
  
 
-                return output_list
+        def check_wlan_ssr(self, iterations=1, recovery_timeout=SHORT_TIMEOUT,
+                           reconnect_timeout=LONG_TIMEOUT,
+                           results_dir='/usr/local/autotest/results/default',
+                           log_path='/dev/kmsg'):
 
- 
+                """Crashes the WLAN firmware and measures the recovery.
 
-        def validate_output(self,output,string):
+                A kernel log cursor is opened before the crash is triggered and
+                the new records are streamed until the recovery line shows up,
+                instead of sleeping and searching the whole dmesg.
 
-                for ele in output:
+                @param iterations: number of subsystem restarts.
 
-                        if string in ele:
+                @param recovery_timeout: seconds to wait for each log line.
 
-                                return True
+                @param reconnect_timeout: seconds to wait for Wi-Fi to reconnect
+                after the recovery.
 
-                        else:
+                @param results_dir: folder the firmware coredumps are saved to.
 
-                                pass
+                @param log_path: kernel log to stream, a file to replay offline.
 
-                return
+                @returns dict from run_ssr_iterations, with the crash to recovery
+                latency, the coredump size and the crash to reconnect time.
 
- 
+                @raises error.TestFail if the firmware did not recover.
 
-        def check_wlan_ssr(self):
+                """
 
-                utils_ts.command_exe('echo enabled > /sys/class/remoteproc/remoteproc0/coredump','/usr/local/autotest/results/default/coredump.txt')
+                def trigger():
 
-                utils_ts.command_exe('echo assert > /sys/kernel/debug/ath11k/wcn6750\ hw1.0/simulate_fw_crash','/usr/local/autotest/results/default/coredump.txt')
+                        with open(WLAN_COREDUMP_CONTROL, 'w') as f:
 
-                time.sleep(self.SHORT_TIMEOUT)
+                                f.write('enabled')
 
-        	utils_ts.command_exe('dmesg','/usr/local/autotest/results/default/reset_log.txt')
+                        with open(WLAN_SIMULATE_FW_CRASH, 'w') as f:
 
-        	return_status=utils.file_contains_pattern('/usr/local/autotest/results/default/reset_log.txt','0.wifi: pdev 0 successfully recovered')
+                                f.write('assert')
 
-                if return_status==True:
+                def collect_coredump():
 
-                        logging.debug('%s',return_status)
+                        return {'coredump_size': utils_ts.collect_devcoredump(
+                                results_dir, 'wlan_coredump')}
 
-                        logging.debug("wlan-ssr reset has been successfully done")
+                result = run_ssr_iterations(
+                        trigger,
+                        [('crash', WLAN_CRASH_PATTERN),
+                         ('recovery', WLAN_RECOVERY_PATTERN)],
+                        [('reconnect', self.wifi_manager.backend.is_connected)],
+                        iterations=iterations, timeout=recovery_timeout,
+                        condition_timeout=reconnect_timeout,
+                        after_milestones=collect_coredump, log_path=log_path)
 
-                if return_status==False:
+                if any(numpy.isnan(value) for value in
+                       result['latencies']['recovery']):
 
                         raise error.TestFail(" Failed to do Wlan SSR ")
 
+                logging.debug("wlan-ssr reset has been successfully done")
+
+                return result
+
         def verify_url(self,tab, correct_url):
 
                 _WAIT=5
@@ -270,19 +1547,61 @@ class ChromeEnterpriseNetworkContext(object):
 
  
 
-        def bluetooth_ssr(self):
+        def bluetooth_ssr(self, iterations=1, headset=None,
+                          reset_timeout=SHORT_TIMEOUT,
+                          reconnect_timeout=LONG_TIMEOUT,
+                          log_path='/dev/kmsg', backend=None):
 
-                #subprocess to run the Bluetooth ssr command
+                """Crashes the Bluetooth controller and measures the recovery.
 
-                output=subprocess.Popen("hcitool cmd 0x3f 0x0c 0x26",stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE,shell=True)
+                The vendor command is sent on an HCI socket, then the kernel log
+                is streamed for the controller reset and its new setup, and the
+                adapter and the headset are polled until they are back.
 
- 
+                @param iterations: number of subsystem restarts.
 
-                output_list=output.stdout.readlines()
+                @param headset: name or address of a paired headset expected to
+                reconnect, None to skip that check.
 
- 
+                @param reset_timeout: seconds to wait for each log line.
 
-                return output_list
+                @param reconnect_timeout: seconds to wait for the adapter to be
+                powered and for the headset to reconnect.
+
+                @param log_path: kernel log to stream, a file to replay offline.
+
+                @param backend: BluezBackend, or FakeBluetoothBackend offline.
+
+                @returns dict from run_ssr_iterations, with the reset to init,
+                reset to powered and reset to headset reconnect times.
+
+                @raises error.TestFail if the controller did not recover.
+
+                """
+
+                backend = backend or BluezBackend()
+
+                conditions = [('powered', backend.is_powered)]
+
+                if headset:
+
+                        conditions.append(('reconnect',
+                                           lambda: backend.is_connected(headset)))
+
+                result = run_ssr_iterations(
+                        backend.trigger_ssr,
+                        [('reset', BT_RESET_PATTERN), ('init', BT_INIT_PATTERN)],
+                        conditions, iterations=iterations, timeout=reset_timeout,
+                        condition_timeout=reconnect_timeout, log_path=log_path)
+
+                if result['failures']:
+
+                        raise error.TestFail("Bluetooth SSR failed in %d of %d iterations"
+                                             % (result['failures'], iterations))
+
+                logging.debug("Bluetooth ssr has been successfully done")
+
+                return result
 
         def connect_bluetooth_headset(self,ui,ui_list,BT_Device_name):
 
@@ -294,7 +1613,7 @@ class ChromeEnterpriseNetworkContext(object):
 
                 for new_tab in range(0,num_of_tabs):
 
-                        URL=https://chromium.googlesource.com/
+                        URL="https://chromium.googlesource.com/"
 
                         tab = cr.browser.tabs[new_tab]
 